@@ -0,0 +1,132 @@
+import sys, os, time
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
+import fire
+import interegular
+import syncode.common as common
+from syncode.dfa_mask_store import DFAs
+from syncode.parsers import create_base_parser
+from syncode.parsers.grammars.grammar import Grammar
+from syncode.token_trie import TokenTrie
+from typing import Iterable, List, Optional, Tuple
+
+
+# Reference implementations of the DFA walks on interegular.FSM (before the dense transition tables)
+def fsm_consume_input(dfa: interegular.FSM, input_str: str) -> Optional[int]:
+    state_id = dfa.initial
+    for symbol in input_str:
+        if not symbol in dfa.alphabet:
+            if not interegular.fsm.anything_else in dfa.alphabet:
+                return None
+            symbol = interegular.fsm.anything_else
+        if not (state_id in dfa.map and dfa.alphabet[symbol] in dfa.map[state_id]):
+            return None
+        state_id = dfa.map[state_id][dfa.alphabet[symbol]]
+    return state_id
+
+def fsm_consume_prefix(dfa: interegular.FSM, state_id: int, input_str: str) -> Tuple[bool, Optional[str]]:
+    longest_accept_index = 0 if state_id in dfa.finals else -1
+    for i, symbol in enumerate(input_str):
+        if not symbol in dfa.alphabet:
+            if not interegular.fsm.anything_else in dfa.alphabet:
+                state_id = None
+                break
+            symbol = interegular.fsm.anything_else
+        if not (state_id in dfa.map and dfa.alphabet[symbol] in dfa.map[state_id]):
+            state_id = None
+            break
+        state_id = dfa.map[state_id][dfa.alphabet[symbol]]
+        if state_id in dfa.finals:
+            longest_accept_index = i+1
+    if longest_accept_index != -1:
+        return (True, input_str[longest_accept_index:])
+    elif state_id != None and dfa.islive(state_id):
+        return (True, '')
+    return (False, None)
+
+def fsm_consume_prefix_trie(dfa: interegular.FSM, state_id: int, trie: TokenTrie) -> List[Tuple[int, str]]:
+    live_states = {s for s in dfa.states if dfa.islive(s)}
+    alphabet, anything_else = dfa.alphabet, interegular.fsm.anything_else
+    out = []
+    if state_id not in live_states:
+        return out
+    stack = [(trie.root, state_id, 0 if state_id in dfa.finals else -1)]
+    while stack:
+        node, state_id, longest_accept_index = stack.pop()
+        for idx in trie.ends_at[node]:
+            out.append((idx, trie.strings[idx][longest_accept_index:] if longest_accept_index != -1 else ''))
+        transitions = dfa.map.get(state_id, {})
+        for symbol, child in trie.children[node].items():
+            if not symbol in alphabet:
+                symbol = anything_else
+            next_state_id = transitions.get(alphabet[symbol]) if symbol in alphabet else None
+            if next_state_id is None or next_state_id not in live_states:
+                if longest_accept_index != -1:
+                    out.extend((idx, trie.strings[idx][longest_accept_index:]) for idx in trie.subtree_strings(child))
+                continue
+            stack.append((child, next_state_id, trie.depth[child] if next_state_id in dfa.finals else longest_accept_index))
+    return out
+
+
+def _time(f, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.time()
+        f()
+        best = min(best, time.time() - start_time)
+    return best
+
+def run_benchmarks(dfas: DFAs, vocab: Iterable[str], remainders: Iterable[str], repeat: int=3):
+    """
+    Times the DFA walks on the dense transition tables and on the interegular FSMs.
+    """
+    terminals = list(dfas._terminals_to_dfa.keys())
+    dfa_states = dfas.states()
+    tokens = [token for token in vocab if token]
+    trie = TokenTrie(enumerate(tokens))
+
+    def compute_dfa_states_fsm():
+        for remainder in remainders:
+            for terminal in terminals:
+                fsm_consume_input(dfas.dfa(terminal), remainder)
+
+    def consume_prefix_fsm():
+        for dfa_state in dfa_states:
+            dfa = dfas.dfa(dfa_state.terminal)
+            for token in tokens:
+                fsm_consume_prefix(dfa, dfa_state.state_id, token)
+
+    def consume_prefix_trie_fsm():
+        for dfa_state in dfa_states:
+            fsm_consume_prefix_trie(dfas.dfa(dfa_state.terminal), dfa_state.state_id, trie)
+
+    benchmarks = [
+        (f'compute_dfa_states ({len(remainders)} remainders)', lambda: [dfas.compute_dfa_states(remainder) for remainder in remainders], compute_dfa_states_fsm),
+        (f'consume_prefix ({len(dfa_states)} states x {len(tokens)} tokens)', lambda: [dfas.consume_prefix(dfa_state, token) for dfa_state in dfa_states for token in tokens], consume_prefix_fsm),
+        (f'consume_prefix_trie ({len(dfa_states)} states)', lambda: [dfas.consume_prefix_trie(dfa_state, trie) for dfa_state in dfa_states], consume_prefix_trie_fsm),
+    ]
+    for name, dense_f, fsm_f in benchmarks:
+        dense_time, fsm_time = _time(dense_f, repeat), _time(fsm_f, repeat)
+        print(f"{name}: dense {dense_time*1000:.1f}ms, interegular {fsm_time*1000:.1f}ms, speedup {fsm_time / dense_time:.1f}x")
+
+
+def bench_dfa(model='Salesforce/codegen-350M-multi', grammar='python', vocab_size=2000, repeat=3):
+    """
+    Microbenchmarks for the DFA walks of the mask store on the dense transition tables against the interegular FSMs.
+
+    vocab_size (int, optional): Only use the first vocab_size tokens of the vocabulary for consume_prefix. Defaults to 2000.
+    """
+    tokenizer = common.load_tokenizer(model)
+    vocab = common.get_vocab_from_tokenizer(tokenizer)[:vocab_size]
+    grammar = Grammar(grammar)
+    base_parser = create_base_parser(grammar)
+    dfas = DFAs(base_parser.terminals, grammar.simplifications())
+
+    # Remainders of different lengths, e.g. long strings and comments
+    remainders = [token.strip() for token in vocab if token.strip()][:1000]
+    remainders += ['"""' + 'Returns the sum of the elements in the list ' * k for k in range(1, 20)]
+    remainders += ['# ' + 'TODO: handle the empty case ' * k for k in range(1, 20)]
+    run_benchmarks(dfas, vocab, remainders, repeat=repeat)
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_dfa)
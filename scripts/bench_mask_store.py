@@ -0,0 +1,43 @@
+import sys, os, time
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
+import fire
+import syncode.common as common
+from syncode.dfa_mask_store import DFAMaskStore
+from syncode.parsers import create_base_parser
+from syncode.parsers.grammars.grammar import Grammar
+
+
+def bench_mask_store(model='Salesforce/codegen-350M-multi', grammar='python', mode='grammar_mask', vocab_size=None, naive=True, num_workers=1):
+    """
+    Compares the time taken for building the DFA mask store with the vocabulary trie and with the naive per token loop.
+
+    vocab_size (int, optional): Only use the first vocab_size tokens of the vocabulary. The naive construction takes more than 10 minutes for the full vocabulary of most tokenizers.
+    naive (bool, optional): Also time the naive construction. Defaults to True.
+    num_workers (int, optional): Number of worker processes for the trie construction. Defaults to 1.
+    """
+    tokenizer = common.load_tokenizer(model)
+    vocab = common.get_vocab_from_tokenizer(tokenizer)
+    if vocab_size is not None:
+        vocab = vocab[:vocab_size]
+    grammar = Grammar(grammar)
+    base_parser = create_base_parser(grammar)
+    special_token_ids = [tokenizer.eos_token_id] if tokenizer.eos_token_id < len(vocab) else []
+
+    def build(use_trie, num_workers=1):
+        start_time = time.time()
+        DFAMaskStore(base_parser.terminals, vocab, simplifications=grammar.simplifications(), special_token_ids=special_token_ids, mode=mode, ignore_terminals=base_parser.ignore_tokens, use_trie=use_trie, num_workers=num_workers)
+        return time.time() - start_time
+
+    trie_time = build(use_trie=True)
+    print(f"Time taken for building the mask store with vocabulary trie: {trie_time:.2f}s")
+    if num_workers > 1:
+        parallel_time = build(use_trie=True, num_workers=num_workers)
+        print(f"Time taken for building the mask store with vocabulary trie and {num_workers} workers: {parallel_time:.2f}s")
+    if naive:
+        naive_time = build(use_trie=False)
+        print(f"Time taken for building the mask store with naive loop: {naive_time:.2f}s")
+        print(f"Speedup: {naive_time / trie_time:.1f}x")
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_mask_store)
@@ -0,0 +1,86 @@
+import sys, os, time
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
+import fire
+import regex
+import syncode.common as common
+from syncode.parsers import create_parser
+from syncode.parsers.grammars.grammar import Grammar
+from typing import List, Tuple
+
+
+PYTHON_FUNCTION = '''def f{i}(numbers: list, threshold: float) -> bool:
+    """ Check if in given list of numbers, are any two numbers closer to each other than given threshold. """
+    for idx, elem in enumerate(numbers):
+        for idx2, elem2 in enumerate(numbers):
+            if idx != idx2:
+                distance = abs(elem - elem2)
+                if distance < threshold:
+                    return True
+    return False
+
+'''
+
+def python_completion(num_tokens: int, tokenizer=None) -> List[str]:
+    """
+    Returns a Python completion split into about num_tokens tokens. Without a tokenizer the code is split into words, whitespace and punctuation.
+    """
+    code, tokens, i = '', [], 0
+    while len(tokens) < num_tokens:
+        code += PYTHON_FUNCTION.format(i=i)
+        if tokenizer is not None:
+            token_ids = tokenizer(code, add_special_tokens=False)['input_ids']
+            tokens = [tokenizer.decode(token_ids[:k+1]) for k in range(len(token_ids))]
+            tokens = [tokens[0]] + [tokens[k][len(tokens[k-1]):] for k in range(1, len(tokens))]
+        else:
+            tokens = regex.findall(r'\w+|\s+|[^\w\s]', code)
+        i += 1
+    return tokens[:num_tokens]
+
+
+def run_parser(inc_parser, tokens: List[str]) -> Tuple[List[float], float]:
+    """
+    Feeds the completion token by token to the parser. Returns the time per token and the total time taken for computing the accepted terminals.
+    """
+    times, time_accepts, code = [], 0, ''
+    for token in tokens:
+        code += token
+        start_time = time.time()
+        inc_parser.get_acceptable_next_terminals(code)
+        times.append(time.time() - start_time)
+        time_accepts += inc_parser.time_accepts
+    return times, time_accepts
+
+
+def bench_parser(grammar='python', model=None, num_tokens=2000, parser='lalr', num_buckets=4, compare_accepts=False, recognizer=True):
+    """
+    Measures the time per generated token of the incremental parser while a completion is generated token by token.
+
+    With persistent parser snapshots and incremental lexing the time per token should not grow with the length of the completion.
+    model (str, optional): The tokenizer used to split the completion into tokens. Defaults to None, which splits the code into words, whitespace and punctuation.
+    num_buckets (int, optional): Number of equal parts of the completion for which the average time per token is reported. Defaults to 4.
+    recognizer (bool, optional): Whether the parser only recognizes the code without building the parse tree, as in GrammarDecoder. Defaults to True.
+    compare_accepts (bool, optional): Whether to also run the parser that computes the accepted terminals by trial-feeding them to the parser instead of the accepts table and compare time_accepts. Defaults to False.
+    """
+    tokenizer = common.load_tokenizer(model) if model is not None else None
+    tokens = python_completion(num_tokens, tokenizer=tokenizer)
+    inc_parser = create_parser(Grammar(grammar), parser=parser, recognizer=recognizer)
+    times, time_accepts = run_parser(inc_parser, tokens)
+
+    bucket_size = (len(times) + num_buckets - 1) // num_buckets
+    for start in range(0, len(times), bucket_size):
+        bucket = times[start:start+bucket_size]
+        print(f"Tokens {start}-{start+len(bucket)}: {sum(bucket) / len(bucket) * 1000:.2f}ms per token")
+    print(f"Total time for {len(times)} tokens: {sum(times):.2f}s")
+    print(f"Time taken for computing accepts: {time_accepts:.2f}s")
+    print(f"Parser snapshots: {inc_parser.snapshot_stats()}")
+
+    if compare_accepts and inc_parser.accepts_table is not None:
+        trial_parser = create_parser(Grammar(grammar), parser=parser, recognizer=recognizer)
+        trial_parser.accepts_table = None
+        trial_times, trial_time_accepts = run_parser(trial_parser, tokens)
+        print(f"Time taken for computing accepts by trial-feeding: {trial_time_accepts:.2f}s (total {sum(trial_times):.2f}s)")
+        print(f"Accepts table speedup: {trial_time_accepts / time_accepts:.1f}x, cache hits: {inc_parser.accepts_table.num_hits}, misses: {inc_parser.accepts_table.num_misses}")
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_parser)
@@ -1,5 +1,7 @@
-from collections import defaultdict
-import copy, os, pickle, time
+from array import array
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import atexit, copy, hashlib, mmap, os, pickle, struct, sys, time, weakref
 import interegular
 import torch
 import regex
@@ -7,9 +9,10 @@ import syncode.common as common
 from tqdm import tqdm
 from syncode.parsers import create_base_parser
 from syncode.larkm.lexer import TerminalDef
-from syncode.parse_result import IndentationConstraint, RemainderState, ParseResult
+from syncode.parse_result import IndentationConstraint, RemainderState, ParseResult, iter_bits, terminal_id, terminal_name
 from syncode.parsers.grammars.grammar import Grammar
-from typing import Any, Optional, Tuple, Iterable, Dict
+from syncode.token_trie import TokenTrie
+from typing import Any, Optional, Tuple, Iterable, Dict, List
 
 
 class DFAState:
@@ -30,64 +33,197 @@ class DFAState:
         return f"({self.terminal}, {self.state_id})"
     
 
+class DenseDFA:
+    """
+    Dense integer representation of a terminal DFA. The DFA walks in DFAs run on this instead of the interegular.FSM since the nested dictionary lookups of interegular and the anything_else fallback are in the innermost loop of the mask store construction and of compute_dfa_states.
+
+    The states are numbered 0..n-1 (state_ids maps them back to the interegular state ids) and the characters are mapped to the interegular transition classes with a list for ASCII characters and a dictionary for the rest. transitions[state][char_class] is the next state or DEAD.
+    """
+    DEAD = -1
+
+    def __init__(self, dfa: interegular.FSM):
+        self.state_ids: List[int] = sorted(dfa.states)
+        self.state_index: Dict[int, int] = {state_id: idx for idx, state_id in enumerate(self.state_ids)}
+
+        class_index: Dict[int, int] = {}
+        for transition in dfa.alphabet.values():
+            class_index.setdefault(transition, len(class_index))
+        self.num_classes = len(class_index)
+
+        self.anything_else_class = self.DEAD
+        self.char_classes: Dict[str, int] = {} # Only non-ASCII characters
+        self.ascii_classes: List[int] = [self.DEAD] * 128
+        for symbol, transition in dfa.alphabet.items():
+            if symbol is interegular.fsm.anything_else:
+                self.anything_else_class = class_index[transition]
+            elif len(symbol) == 1 and ord(symbol) < 128:
+                self.ascii_classes[ord(symbol)] = class_index[transition]
+            else:
+                self.char_classes[symbol] = class_index[transition]
+        if self.anything_else_class != self.DEAD:
+            self.ascii_classes = [self.anything_else_class if char_class == self.DEAD else char_class for char_class in self.ascii_classes]
+
+        self.transitions: List[List[int]] = []
+        for state_id in self.state_ids:
+            row = [self.DEAD] * self.num_classes
+            for transition, next_state_id in dfa.map.get(state_id, {}).items():
+                if transition in class_index:
+                    row[class_index[transition]] = self.state_index[next_state_id]
+            self.transitions.append(row)
+
+        self.initial = self.state_index[dfa.initial]
+        self.finals = bytearray(state_id in dfa.finals for state_id in self.state_ids)
+        self.live = bytearray(dfa.islive(state_id) for state_id in self.state_ids)
+
+
+class RemainderDFAStates:
+    """
+    The DFA states of the remainder of one sequence at the previous decoding step. The remainder usually grows by a few characters at every step (e.g. in long strings and comments), thus DFAs.compute_dfa_states advances these states by the appended characters instead of walking the whole remainder again.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.remainder: Optional[str] = None
+        self.dense_states: List[Tuple[str, int]] = [] # (terminal, dense state) for the terminals that are not dead
+        self.num_incremental_walks = 0
+        self.num_full_walks = 0
+
+
 class DFAs:
     """
     Stores the DFAs for each terminal and provides the method to consume the input string and get the DFA state.
     """
-    def __init__(self, terminals: Iterable[TerminalDef], simplifications: Dict[str, str] = {}):
+    def __init__(self, terminals: Iterable[TerminalDef], simplifications: Dict[str, str] = {}, regex_to_dfa: Dict[str, interegular.FSM] = {}):
+        """
+        regex_to_dfa (dict, optional): Already constructed DFAs for some terminal regexes (e.g. loaded from the cache). The state ids of a DFA depend on the order in which interegular constructs it, thus we reuse the DFA for which the cached lookups were computed.
+        """
         self._terminals_to_dfa: Dict[str, interegular.FSM] = {}
-        self.anything_else = interegular.fsm.anything_else # This is special character used for the 
+        self._terminals_to_dense: Dict[str, DenseDFA] = {}
+        self._terminals_to_regex: Dict[str, str] = {}
         self._simplifications: Dict[str, str] = simplifications
+        regex_to_dfa = dict(regex_to_dfa)
+        regex_to_dense: Dict[str, DenseDFA] = {}
 
         for terminal in terminals:
-            if terminal.name in simplifications:
-                terminal_regex = simplifications[terminal.name]
-            else:
-                terminal_regex = terminal.pattern.to_regexp()
+            terminal_regex = self.terminal_regex(terminal, simplifications)
+            if terminal_regex not in regex_to_dfa:
+                regex_to_dfa[terminal_regex] = interegular.parse_pattern(terminal_regex).to_fsm()
+            if terminal_regex not in regex_to_dense:
+                regex_to_dense[terminal_regex] = DenseDFA(regex_to_dfa[terminal_regex])
+            
             # We store the DFA for each terminal (with name as the key) in the dictionary
-            self._terminals_to_dfa[terminal.name] = interegular.parse_pattern(terminal_regex).to_fsm()
+            self._add_terminal(terminal.name, terminal_regex, regex_to_dfa[terminal_regex], regex_to_dense[terminal_regex])
+
+    def _add_terminal(self, terminal: str, terminal_regex: str, dfa: interegular.FSM, dense_dfa: DenseDFA):
+        self._terminals_to_dfa[terminal] = dfa
+        self._terminals_to_dense[terminal] = dense_dfa
+        self._terminals_to_regex[terminal] = terminal_regex
+
+    @staticmethod
+    def terminal_regex(terminal: TerminalDef, simplifications: Dict[str, str] = {}) -> str:
+        if terminal.name in simplifications:
+            return simplifications[terminal.name]
+        return terminal.pattern.to_regexp()
+
+    @staticmethod
+    def dfa_to_data(dfa: interegular.FSM) -> tuple:
+        """
+        Converts the DFA to plain data that can be stored on disk.
+        """
+        # interegular compares anything_else by identity and a pickled copy would not match the module level object, thus we store it as None
+        alphabet = {(None if symbol is interegular.fsm.anything_else else symbol): transition for symbol, transition in dfa.alphabet.items()}
+        return alphabet, set(dfa.states), dfa.initial, set(dfa.finals), dfa.map
+
+    @staticmethod
+    def dfa_from_data(data: tuple) -> interegular.FSM:
+        alphabet, states, initial, finals, transitions = data
+        alphabet = interegular.fsm.Alphabet({(interegular.fsm.anything_else if symbol is None else symbol): transition for symbol, transition in alphabet.items()})
+        return interegular.FSM(alphabet, states, initial, finals, transitions)
+
+    def to_data(self) -> dict:
+        """
+        Returns the DFAs as plain data. Terminals with the same regex share the DFA.
+        """
+        terminals = [(terminal, terminal_regex) for terminal, terminal_regex in self._terminals_to_regex.items()]
+        regex_to_dfa = {terminal_regex: DFAs.dfa_to_data(self._terminals_to_dfa[terminal]) for terminal, terminal_regex in terminals}
+        return {'terminals': terminals, 'regex_to_dfa': regex_to_dfa, 'simplifications': self._simplifications}
+
+    @staticmethod
+    def from_data(data: dict) -> 'DFAs':
+        dfas = DFAs([], data['simplifications'])
+        regex_to_dfa = {terminal_regex: DFAs.dfa_from_data(dfa_data) for terminal_regex, dfa_data in data['regex_to_dfa'].items()}
+        regex_to_dense = {terminal_regex: DenseDFA(dfa) for terminal_regex, dfa in regex_to_dfa.items()}
+        for terminal, terminal_regex in data['terminals']:
+            dfas._add_terminal(terminal, terminal_regex, regex_to_dfa[terminal_regex], regex_to_dense[terminal_regex])
+        return dfas
+
+    def regex(self, terminal: str) -> str:
+        return self._terminals_to_regex[terminal]
+
+    def dfa(self, terminal: str) -> interegular.FSM:
+        return self._terminals_to_dfa[terminal]
 
     def states(self):
-        return [DFAState(terminal_name, state_id) for terminal_name, dfa in self._terminals_to_dfa.items() for state_id in dfa.states]
+        return [DFAState(terminal_name, state_id) for terminal_name, dfa in self._terminals_to_dense.items() for state_id in dfa.state_ids]
 
     def initial(self, terminal: str):
-        return DFAState(terminal, self._terminals_to_dfa[terminal].initial)
+        dense_dfa = self._terminals_to_dense[terminal]
+        return DFAState(terminal, dense_dfa.state_ids[dense_dfa.initial])
 
-    def compute_dfa_states(self, input_str: str) -> Iterable[DFAState]:
+    def compute_dfa_states(self, input_str: str, prev: Optional[RemainderDFAStates] = None) -> Iterable[DFAState]:
         """
         consume input_str and get the list of pairs of (terminal, dfa_state). This denotes our current DFA state.
 
+        If prev is given and input_str extends the remainder of the previous call, only the appended characters are consumed from the previous DFA states. prev is updated with the new states.
+
         NOTE: The returned DFA state is always a live state
         """
-        dfa_states = []
-        for (terminal, dfa) in self._terminals_to_dfa.items():
-            state_id = self._consume_input(dfa, input_str)
-            if state_id is not None:
-                dfa_states.append(DFAState(terminal, state_id)) 
-        return dfa_states
-
-    def _consume_input(self, dfa: interegular.FSM, input_str: str) -> Optional[int]:
+        if prev is not None and prev.remainder is not None and input_str.startswith(prev.remainder):
+            appended_str = input_str[len(prev.remainder):]
+            dense_states = []
+            for terminal, state in prev.dense_states:
+                state = self._consume_input(self._terminals_to_dense[terminal], appended_str, state)
+                if state != DenseDFA.DEAD:
+                    dense_states.append((terminal, state))
+            prev.num_incremental_walks += 1
+        else:
+            dense_states = []
+            for (terminal, dense_dfa) in self._terminals_to_dense.items():
+                state = self._consume_input(dense_dfa, input_str)
+                if state != DenseDFA.DEAD:
+                    dense_states.append((terminal, state))
+            if prev is not None:
+                prev.num_full_walks += 1
+
+        if prev is not None:
+            prev.remainder, prev.dense_states = input_str, dense_states
+        return [DFAState(terminal, self._terminals_to_dense[terminal].state_ids[state]) for terminal, state in dense_states]
+
+    def _consume_input(self, dense_dfa: DenseDFA, input_str: str, state: Optional[int] = None) -> int:
         """
-        Conumses the input string and returns the final state if it is live, otherwise returns None
+        Conumses the input string from the given (dense) state or the initial state and returns the final (dense) state or DEAD if a transition is missing
         """
-        state_id = dfa.initial
-        for i, symbol in enumerate(input_str):
-            if not symbol in dfa.alphabet:
-                if not self.anything_else in dfa.alphabet:
-                    return None
-                symbol = self.anything_else
-
+        if state is None:
+            state = dense_dfa.initial
+        ascii_classes, char_classes, anything_else_class, transitions = dense_dfa.ascii_classes, dense_dfa.char_classes, dense_dfa.anything_else_class, dense_dfa.transitions
+        for ch in input_str:
+            code = ord(ch)
+            char_class = ascii_classes[code] if code < 128 else char_classes.get(ch, anything_else_class)
             # Missing transition = transition to dead state
-            if not (state_id in dfa.map and dfa.alphabet[symbol] in dfa.map[state_id]):
-                return None
-            state_id = dfa.map[state_id][dfa.alphabet[symbol]]      
-        return state_id
+            if char_class == DenseDFA.DEAD:
+                return DenseDFA.DEAD
+            state = transitions[state][char_class]
+            if state == DenseDFA.DEAD:
+                return DenseDFA.DEAD
+        return state
 
     def is_final(self, dfa_state: DFAState) -> bool:
         """
         Returns True if the dfa state is a final state
         """
-        return dfa_state.state_id in self._terminals_to_dfa[dfa_state.terminal].finals
+        dense_dfa = self._terminals_to_dense[dfa_state.terminal]
+        return bool(dense_dfa.finals[dense_dfa.state_index[dfa_state.state_id]])
 
     def consume_prefix(self, dfa_state: DFAState, input_str: str) -> Tuple[bool, Optional[str]]:
         """
@@ -96,42 +232,192 @@ class DFAs:
         If the consumption ends at any live state that is not an accept state, return (True, '').
         If we reach a final state, return (True, remainder).
         """
-        cur_state_id = dfa_state.state_id
-        dfa: interegular.FSM = self._terminals_to_dfa[dfa_state.terminal]
+        dense_dfa = self._terminals_to_dense[dfa_state.terminal]
+        ascii_classes, char_classes, anything_else_class, transitions, finals = dense_dfa.ascii_classes, dense_dfa.char_classes, dense_dfa.anything_else_class, dense_dfa.transitions, dense_dfa.finals
+        state = dense_dfa.state_index[dfa_state.state_id]
 
         longest_accept_index = -1
 
-        if cur_state_id in dfa.finals:
+        if finals[state]:
             longest_accept_index = 0
 
-        for i, symbol in enumerate(input_str):
-            if not symbol in dfa.alphabet:
-                if not self.anything_else in dfa.alphabet:
-                    cur_state_id = None
-                    break
-                symbol = self.anything_else
+        for i, ch in enumerate(input_str):
+            code = ord(ch)
+            char_class = ascii_classes[code] if code < 128 else char_classes.get(ch, anything_else_class)
 
             # Missing transition = transition to dead state
-            if not (cur_state_id in dfa.map and dfa.alphabet[symbol] in dfa.map[cur_state_id]):
-                cur_state_id = None
+            if char_class == DenseDFA.DEAD:
+                state = DenseDFA.DEAD
+                break
+            state = transitions[state][char_class]
+            if state == DenseDFA.DEAD:
                 break
 
-            cur_state_id = dfa.map[cur_state_id][dfa.alphabet[symbol]]
-
-            if cur_state_id in dfa.finals:
+            if finals[state]:
                 longest_accept_index = i+1
         
         if longest_accept_index != -1: # reached accept state at some point
             return (True, input_str[longest_accept_index:])
-        elif cur_state_id != None and dfa.islive(cur_state_id): # if state is a live state
+        elif state != DenseDFA.DEAD and dense_dfa.live[state]: # if state is a live state
             return (True, '')
         
         # if we never reach a final state and reach a dead state at some point
         return (False, None)
 
+    def consume_prefix_trie(self, dfa_state: DFAState, trie: TokenTrie) -> List[Tuple[int, str]]:
+        """
+        Same as consume_prefix, but for all the strings in the trie at once. Returns (string id, remainder) for every string for which consume_prefix returns (True, remainder).
+
+        The DFA walk is shared by all strings with a common prefix. Once the DFA reaches a dead state, the strings in the subtree are either all rejected (if we never reached a final state) or they all end with the longest accepted prefix.
+        """
+        dense_dfa = self._terminals_to_dense[dfa_state.terminal]
+        ascii_classes, char_classes, anything_else_class, transitions, finals, live = dense_dfa.ascii_classes, dense_dfa.char_classes, dense_dfa.anything_else_class, dense_dfa.transitions, dense_dfa.finals, dense_dfa.live
+        strings = trie.strings
+        out: List[Tuple[int, str]] = []
+
+        state = dense_dfa.state_index[dfa_state.state_id]
+        if not live[state]:
+            return out
+
+        # Each entry is (trie node, dfa state, length of the longest accepted prefix or -1)
+        stack = [(trie.root, state, 0 if finals[state] else -1)]
+        while stack:
+            node, state, longest_accept_index = stack.pop()
+            for idx in trie.ends_at[node]:
+                out.append((idx, strings[idx][longest_accept_index:] if longest_accept_index != -1 else ''))
+
+            row = transitions[state]
+            for ch, child in trie.children[node].items():
+                code = ord(ch)
+                char_class = ascii_classes[code] if code < 128 else char_classes.get(ch, anything_else_class)
+                next_state = row[char_class] if char_class != DenseDFA.DEAD else DenseDFA.DEAD
+
+                if next_state == DenseDFA.DEAD or not live[next_state]:
+                    # Dead state: the rest of the subtree cannot extend the longest accepted prefix
+                    if longest_accept_index != -1:
+                        out.extend((idx, strings[idx][longest_accept_index:]) for idx in trie.subtree_strings(child))
+                    continue
+
+                stack.append((child, next_state, trie.depth[child] if finals[next_state] else longest_accept_index))
+        return out
+
+class VocabTrieWalker:
+    """
+    Walks the vocabulary tries with the terminal DFAs. This is kept separate from DFAMaskStore so that it can be cheaply sent to the worker processes while building the mask store in parallel.
+    """
+    def __init__(self, dfas: DFAs, vocab: Iterable[str], special_token_ids: Iterable[int], ignore_whitespace: bool):
+        self._dfas = dfas
+        self._ignore_whitespace = ignore_whitespace
+        regular_tokens = [(token_idx, token) for token_idx, token in enumerate(vocab) if token_idx not in special_token_ids]
+        self._incomplete_trie = TokenTrie((token_idx, token.replace('\t', '    ')) for token_idx, token in regular_tokens)
+        self._complete_trie = TokenTrie((token_idx, self.remove_left_whitespace(token)) for token_idx, token in regular_tokens)
+
+    def remove_left_whitespace(self, s: str) -> str:
+        if s.startswith(' ') and self._ignore_whitespace: # ignore left space
+            return s[1:]
+        return s
+
+    def walk(self, dfa_state: DFAState) -> Tuple[array, Dict[str, array], array]:
+        """
+        Returns the tokens that end in a live state of the current terminal, the tokens grouped by the remainder that should be consumed by the next terminal and the tokens for the COMPLETE case.
+        """
+        live_tokens, remainder_to_tokens = array('i'), {}
+        for token_idx, remainder in self._dfas.consume_prefix_trie(dfa_state, self._incomplete_trie):
+            if remainder == '':
+                # We reached a live state for the current terminal, thus we add the token in all overapproximate sets of next terminals
+                live_tokens.append(token_idx)
+            else:
+                # We reached the final state while consuming the token, the remainder is consumed with all next terminals
+                remainder = self.remove_left_whitespace(remainder)
+                if remainder not in remainder_to_tokens:
+                    remainder_to_tokens[remainder] = array('i')
+                remainder_to_tokens[remainder].append(token_idx)
+
+        # For COMPLETE case:
+        exact_tokens = array('i', [token_idx for token_idx, remainder in self._dfas.consume_prefix_trie(dfa_state, self._complete_trie) if remainder == ''])
+        return live_tokens, remainder_to_tokens, exact_tokens
+
+    def walk_shard(self, dfa_states: Iterable[DFAState]) -> list:
+        return [self.walk(dfa_state) for dfa_state in dfa_states]
+
+
+# Lazy mask stores whose walks may not be flushed to the shard cache yet. The stores are removed when they are garbage collected or complete
+_incomplete_lazy_stores: 'weakref.WeakSet[DFAMaskStore]' = weakref.WeakSet()
+
+@atexit.register
+def _flush_lazy_stores_at_exit():
+    for mask_store in list(_incomplete_lazy_stores):
+        mask_store.flush()
+
+
+# The walker used by the worker processes. It is set once per process by _init_walker_process
+_process_walker: Optional[VocabTrieWalker] = None
+
+def _init_walker_process(walker: VocabTrieWalker):
+    global _process_walker
+    _process_walker = walker
+
+def _walk_shard_in_process(dfa_states: Iterable[DFAState]) -> list:
+    return _process_walker.walk_shard(dfa_states)
+
+
+class TerminalShardCache:
+    """
+    Caches the result of walking the vocabulary with every state of a terminal DFA (VocabTrieWalker.walk) independently of the grammar. We call this a terminal shard. 
+    
+    The shards are keyed by the terminal regex (or its simplification) and the vocabulary. Thus grammars that share terminals (e.g. NAME, DEC_NUMBER, STRING or whitespace) reuse them and when a grammar is edited, only the new or changed terminals are built. The shards do not depend on the mode ('grammar_mask' or 'grammar_strict'), the mode is only used when the next terminal lookups are assembled from the shards.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_dir: str, vocab: Iterable[str], special_token_ids: Iterable[int], ignore_whitespace: bool):
+        self.cache_dir = cache_dir
+        self._vocab_hash = hashlib.sha256(repr((list(vocab), sorted(special_token_ids), ignore_whitespace)).encode('utf-8')).hexdigest()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, terminal_regex: str) -> str:
+        key = hashlib.sha256(repr((self.VERSION, terminal_regex, self._vocab_hash)).encode('utf-8')).hexdigest()
+        return f'{self.cache_dir}{key}.pkl'
+
+    def load(self, terminal_regex: str) -> Optional[Tuple[interegular.FSM, Dict[int, tuple]]]:
+        """
+        Returns the DFA for the terminal regex and the walk result for each of its states if the shard is cached.
+        """
+        path = self._path(terminal_regex)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                dfa_data, state_to_walk = pickle.load(f)
+            return DFAs.dfa_from_data(dfa_data), state_to_walk
+        except Exception: # If we cannot load the file, the shard is created from scratch
+            return None
+
+    def store(self, terminal_regex: str, dfa: interegular.FSM, state_to_walk: Dict[int, tuple]):
+        # Write to a temporary file first so that concurrent processes never read a partial shard
+        path = self._path(terminal_regex)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((DFAs.dfa_to_data(dfa), state_to_walk), f)
+        os.replace(tmp_path, path)
+
+    def update(self, terminal_regex: str, dfa: interegular.FSM, state_to_walk: Dict[int, tuple]):
+        """
+        Adds the walk result for some states of the DFA to the cached shard. Shards may be partial if they are filled in by a lazy DFAMaskStore.
+        """
+        shard = self.load(terminal_regex)
+        # The state ids of the cached shard are only meaningful for its own DFA, thus we overwrite shards created with a different DFA
+        if shard is not None and DFAs.dfa_to_data(shard[0]) == DFAs.dfa_to_data(dfa):
+            state_to_walk = {**shard[1], **state_to_walk}
+        self.store(terminal_regex, dfa, state_to_walk)
+
+
 class LookupTable:
     """
     Stores the overapproximate tokens
+
+    The lookups are built as lists of token ids. convert_lookups_from_list_to_mask then interns every mask as a row of a single bit-packed matrix (each row is the vocabulary mask packed in 64-bit words) and the lookups map the keys to the row ids. The union of several lookups is computed with a single gather of the rows followed by an OR reduction (see masks_union).
+
+    The rows are content-addressed: many lookups have identical masks (e.g. all keywords after a full match) and they share a single row. See dedup_stats.
     """
     def __init__(self, vocab: Iterable[str], special_token_ids: Iterable[int], indentation=False, mode='grammar_mask'):
         self._dfa_state_and_next_terminal_to_tokens: defaultdict = defaultdict(list)
@@ -142,12 +428,27 @@ class LookupTable:
         self.indentation = indentation
 
         self._default_mask = self._get_default_mask(special_token_ids)
+
+        # Bit-packed mask matrix. Only the first _num_masks rows are used, the rest is reserved for the masks added later by a lazy mask store
+        self._num_words = (len(vocab) + 63) // 64
+        self._masks = torch.zeros((0, self._num_words), dtype=torch.int64)
+        self._num_masks = 0
+        self._num_mask_refs = 0 # Number of masks added including the duplicates
+        self._bit_shifts = torch.arange(64, dtype=torch.int64)
+
+        # Rows with the same fingerprint are candidates for being equal
+        self._fingerprint_to_rows: Optional[Dict[int, List[int]]] = {}
+
+        # The only token of the row, NO_TOKEN or MANY_TOKENS, computed when the row is first looked up. The rows are never modified
+        self._row_to_single_token: Dict[int, int] = {}
+        self._fingerprint_coeffs = torch.randint(-2**62, 2**62, (self._num_words,), dtype=torch.int64, generator=torch.Generator().manual_seed(0)) | 1
+
         if indentation:
             self._whitespace_tokens_map: defaultdict = defaultdict(list)
             self._indentation_to_tokens_map: defaultdict = defaultdict(list)
             self._create_indentation_to_tokens_map()
 
-    def incomplete_case_lookup(self, dfa_state: DFAState) -> Any:
+    def incomplete_case_lookup(self, dfa_state: DFAState) -> int:
         assert isinstance(dfa_state, DFAState)
         if self._mode == 'grammar_mask':
             return self._overapprox_lookup[dfa_state]
@@ -155,13 +456,11 @@ class LookupTable:
             return self._exact_lookup[dfa_state]
         raise ValueError(f"Invalid mode: {self._mode}")
     
-    def store_overapprox_lookup(self, dfa_state: DFAState, mask: torch.Tensor):
+    def store_overapprox_lookup(self, dfa_state: DFAState, tokens: Iterable[int]):
         assert isinstance(dfa_state, DFAState)
-        if dfa_state not in self._overapprox_lookup:
-            self._overapprox_lookup[dfa_state] = self._get_default_mask()
-        self._overapprox_lookup[dfa_state] |= mask
+        self._overapprox_lookup[dfa_state] = self._add_mask(self._tokens_to_words(tokens))
     
-    def complete_case_lookup(self, dfa_state: DFAState) -> Any:
+    def complete_case_lookup(self, dfa_state: DFAState) -> int:
         assert isinstance(dfa_state, DFAState)
         return self._exact_lookup[dfa_state]
 
@@ -171,43 +470,208 @@ class LookupTable:
             self._exact_lookup[dfa_state] = []
         self._exact_lookup[dfa_state].append(token)        
 
-    def dfa_state_and_next_terminal_to_tokens(self, dfa_state: DFAState, next_terminal) -> torch.Tensor:
+    def store_exact_lookup(self, dfa_state: DFAState, tokens: Iterable[int]):
+        assert isinstance(dfa_state, DFAState)
+        self._exact_lookup[dfa_state] = self._add_mask(self._tokens_to_words(tokens))
+
+    def add_exact_lookup_tokens(self, dfa_state: DFAState, tokens: Iterable[int]):
+        assert isinstance(dfa_state, DFAState)
+        if dfa_state not in self._exact_lookup:
+            self._exact_lookup[dfa_state] = []
+        self._exact_lookup[dfa_state].extend(tokens)
+
+    def dfa_state_and_next_terminal_to_tokens(self, dfa_state: DFAState, next_terminal) -> Optional[int]:
         assert isinstance(dfa_state, DFAState)
-        return self._dfa_state_and_next_terminal_to_tokens[(dfa_state, next_terminal)]
+        return self._dfa_state_and_next_terminal_to_tokens.get((dfa_state, next_terminal))
 
-    def dfa_state_and_next_terminal_to_tokens_store(self, dfa_state: DFAState, next_terminal, mask: torch.Tensor):
+    def dfa_state_and_next_terminal_to_tokens_store(self, dfa_state: DFAState, next_terminal, tokens: Iterable[int]):
         assert isinstance(dfa_state, DFAState)
-        self._dfa_state_and_next_terminal_to_tokens[(dfa_state, next_terminal)] = mask
+        self._dfa_state_and_next_terminal_to_tokens[(dfa_state, next_terminal)] = self._add_mask(self._tokens_to_words(tokens))
     
     def dfa_state_and_next_terminal_to_tokens_add(self, dfa_state: DFAState, next_terminal, token):
         assert isinstance(dfa_state, DFAState)
         self._dfa_state_and_next_terminal_to_tokens[(dfa_state, next_terminal)].append(token)
 
-    def _list_to_mask(self, tokens_idx_list) -> torch.Tensor:
-        indices = torch.tensor(tokens_idx_list)
-        tokens_mask = self._get_default_mask()
-        tokens_mask[indices] = 1
-        return tokens_mask
+    def dfa_state_and_next_terminal_to_tokens_extend(self, dfa_state: DFAState, next_terminal, tokens: Iterable[int]):
+        assert isinstance(dfa_state, DFAState)
+        self._dfa_state_and_next_terminal_to_tokens[(dfa_state, next_terminal)].extend(tokens)
+
+    def _tokens_to_words(self, tokens_idx_list: Iterable[int]) -> torch.Tensor:
+        """
+        Packs the token ids in a mask of 64-bit words. Token i is the bit i % 64 of the word i // 64.
+        """
+        indices = torch.unique(torch.tensor(list(tokens_idx_list), dtype=torch.int64))
+        words = torch.zeros(self._num_words, dtype=torch.int64)
+        # The bits are distinct, thus adding them is the same as OR-ing them
+        words.index_put_((indices >> 6,), torch.ones_like(indices) << (indices & 63), accumulate=True)
+        return words
+
+    def _words_to_mask(self, words: torch.Tensor) -> torch.Tensor:
+        bits = (words.unsqueeze(-1) >> self._bit_shifts) & 1
+        return bits.view(-1)[:len(self._vocab)].bool()
+
+    def _fingerprint(self, words: torch.Tensor) -> int:
+        # Multiply-add hash over the words, the products wrap around in int64
+        return int((words * self._fingerprint_coeffs).sum())
+
+    def _add_mask(self, words: torch.Tensor) -> int:
+        """
+        Returns the row id of the packed mask in the mask matrix. The mask is added as a new row if there is no equal row already.
+        """
+        self._num_mask_refs += 1
+        if self._fingerprint_to_rows is None:
+            # The fingerprints are not stored in the file, they are recomputed if a loaded lookup table is extended
+            self._fingerprint_to_rows = {}
+            for row in range(self._num_masks):
+                self._fingerprint_to_rows.setdefault(self._fingerprint(self._masks[row]), []).append(row)
+
+        fingerprint = self._fingerprint(words)
+        for row in self._fingerprint_to_rows.get(fingerprint, []):
+            if torch.equal(self._masks[row], words):
+                return row
+        self._fingerprint_to_rows.setdefault(fingerprint, []).append(self._num_masks)
+
+        if self._num_masks == self._masks.shape[0]:
+            capacity = max(16, 2 * self._masks.shape[0])
+            masks = torch.zeros((capacity, self._num_words), dtype=torch.int64)
+            masks[:self._num_masks] = self._masks[:self._num_masks]
+            self._masks = masks
+        self._masks[self._num_masks] = words
+        self._num_masks += 1
+        return self._num_masks - 1
+
+    def dedup_stats(self) -> Dict[str, Any]:
+        """
+        Returns the number of masks stored in the lookups, the number of distinct masks and their ratio.
+        """
+        return {
+            'masks': self._num_mask_refs,
+            'unique_masks': self._num_masks,
+            'dedup_ratio': self._num_mask_refs / max(self._num_masks, 1),
+            'matrix_bytes': self._num_masks * self._num_words * 8,
+        }
+
+    def masks_union_words(self, rows: Iterable[int]) -> torch.Tensor:
+        """
+        Returns the bit-packed union of the masks with the given row ids.
+        """
+        rows = sorted(set(rows))
+        if not rows:
+            return torch.zeros(self._num_words, dtype=torch.int64)
+        words = self._masks[rows]
+        # OR reduction of the gathered rows by halving
+        while words.shape[0] > 1:
+            half = words.shape[0] // 2
+            reduced = words[:half] | words[half:2*half]
+            if words.shape[0] % 2 == 1:
+                reduced[0] |= words[-1]
+            words = reduced
+        return words[0]
+
+    NO_TOKEN, MANY_TOKENS = -1, -2
+
+    def _single_token(self, row: int) -> int:
+        single_token = self._row_to_single_token.get(row)
+        if single_token is None:
+            words = self._masks[row]
+            nonzero_words = torch.nonzero(words).flatten().tolist()
+            single_token = LookupTable.NO_TOKEN if not nonzero_words else LookupTable.MANY_TOKENS
+            if len(nonzero_words) == 1:
+                word = int(words[nonzero_words[0]]) & ((1 << 64) - 1)
+                if word & (word - 1) == 0:
+                    single_token = nonzero_words[0] * 64 + word.bit_length() - 1
+            self._row_to_single_token[row] = single_token
+        return single_token
+
+    def masks_union_single_token(self, rows: Iterable[int]) -> Optional[int]:
+        """
+        Returns the token if the union of the masks with the given row ids has exactly one token and None otherwise. Unlike masks_union, this does not build the union.
+        """
+        token = None
+        for row in rows:
+            single_token = self._single_token(row)
+            if single_token == LookupTable.NO_TOKEN:
+                continue
+            if single_token == LookupTable.MANY_TOKENS or (token is not None and token != single_token):
+                return None
+            token = single_token
+        return token
+
+    def masks_union(self, rows: Iterable[int]) -> torch.Tensor:
+        """
+        Returns the union of the masks with the given row ids as a boolean mask over the vocabulary.
+        """
+        return self._words_to_mask(self.masks_union_words(rows))
 
     def convert_lookups_from_list_to_mask(self):
         """
-        Converts the lookups from list of tokens to boolean tensor mask
+        Converts the lookups from list of tokens to rows of the bit-packed mask matrix
         """
+        num_masks = len(self._dfa_state_and_next_terminal_to_tokens) + len({dfa_state for dfa_state, _ in self._dfa_state_and_next_terminal_to_tokens}) + len(self._exact_lookup)
+        if self.indentation:
+            num_masks += len(self._whitespace_tokens_map) + len(self._indentation_to_tokens_map)
+        self._masks = torch.zeros((num_masks, self._num_words), dtype=torch.int64)
+
+        overapprox_words: Dict[DFAState, torch.Tensor] = {}
+        dfa_state_and_next_terminal_to_tokens = {}
         for key, val in self._dfa_state_and_next_terminal_to_tokens.items():
-            m = self._list_to_mask(val)
-            self._dfa_state_and_next_terminal_to_tokens[key] = m
+            words = self._tokens_to_words(val)
+            dfa_state_and_next_terminal_to_tokens[key] = self._add_mask(words)
             (dfa_state, _) = key
-            self.store_overapprox_lookup(dfa_state, m)
+            if dfa_state not in overapprox_words:
+                overapprox_words[dfa_state] = words
+            else:
+                overapprox_words[dfa_state] = overapprox_words[dfa_state] | words
+        self._dfa_state_and_next_terminal_to_tokens = dfa_state_and_next_terminal_to_tokens
+
+        for dfa_state, words in overapprox_words.items():
+            self._overapprox_lookup[dfa_state] = self._add_mask(words)
         
         for key, val in self._exact_lookup.items():
-            self._exact_lookup[key] = self._list_to_mask(val)
+            self._exact_lookup[key] = self._add_mask(self._tokens_to_words(val))
         
         # TODO: move this logic to the lookup table
         if self.indentation:
             for key, val in self._whitespace_tokens_map.items():
-                self._whitespace_tokens_map[key] = self._list_to_mask(val)
+                self._whitespace_tokens_map[key] = self._add_mask(self._tokens_to_words(val))
             for key, val in self._indentation_to_tokens_map.items():
-                self._indentation_to_tokens_map[key] = self._list_to_mask(val)
+                self._indentation_to_tokens_map[key] = self._add_mask(self._tokens_to_words(val))
+        
+        # Release the rows that are not used because of deduplication
+        self._masks = self._masks[:self._num_masks].clone()
+
+    def to_index(self) -> dict:
+        """
+        Returns the row ids of all lookups as plain data. Together with the mask matrix, this is all that is needed to restore the lookup table.
+        """
+        index = {
+            'mode': self._mode,
+            'indentation': self.indentation,
+            'next_terminal': [(dfa_state.terminal, dfa_state.state_id, next_terminal, row) for (dfa_state, next_terminal), row in self._dfa_state_and_next_terminal_to_tokens.items()],
+            'exact': [(dfa_state.terminal, dfa_state.state_id, row) for dfa_state, row in self._exact_lookup.items()],
+            'overapprox': [(dfa_state.terminal, dfa_state.state_id, row) for dfa_state, row in self._overapprox_lookup.items()],
+            'num_mask_refs': self._num_mask_refs,
+        }
+        if self.indentation:
+            index['whitespace'] = dict(self._whitespace_tokens_map)
+            index['indentation_to_tokens'] = dict(self._indentation_to_tokens_map)
+        return index
+
+    @staticmethod
+    def from_index(index: dict, vocab: Iterable[str], special_token_ids: Iterable[int], masks: torch.Tensor) -> 'LookupTable':
+        lookup_table = LookupTable(vocab, special_token_ids, indentation=False, mode=index['mode'])
+        lookup_table._dfa_state_and_next_terminal_to_tokens = {(DFAState(terminal, state_id), next_terminal): row for terminal, state_id, next_terminal, row in index['next_terminal']}
+        lookup_table._exact_lookup = {DFAState(terminal, state_id): row for terminal, state_id, row in index['exact']}
+        lookup_table._overapprox_lookup = {DFAState(terminal, state_id): row for terminal, state_id, row in index['overapprox']}
+        lookup_table.indentation = index['indentation']
+        if lookup_table.indentation:
+            lookup_table._whitespace_tokens_map = defaultdict(list, index['whitespace'])
+            lookup_table._indentation_to_tokens_map = defaultdict(list, index['indentation_to_tokens'])
+        lookup_table._masks = masks
+        lookup_table._num_masks = masks.shape[0]
+        lookup_table._num_mask_refs = index['num_mask_refs']
+        lookup_table._fingerprint_to_rows = None
+        return lookup_table
 
     def _get_default_mask(self, special_token_ids=None) -> torch.Tensor:
         if special_token_ids is not None:
@@ -241,28 +705,39 @@ class LookupTable:
         """
         Returns the tokens mask for the indentation constraint
         """
-        out_mask = self._get_default_mask()
+        out_mask = self.masks_union(self._indentation_rows(indent_constraint))
+        
+        if get_list: # This is useful for testing
+            return self._get_tokens_list(out_mask) 
+        return out_mask
+
+    def indentation_accepts(self, indent_constraint: IndentationConstraint, token: int) -> bool:
+        """
+        Checks if the token is in the tokens mask for the indentation constraint without building the mask
+        """
+        rows = self._indentation_rows(indent_constraint)
+        return bool(rows) and bool(((self._masks[rows, token >> 6] >> (token & 63)) & 1).any())
+
+    def _indentation_rows(self, indent_constraint: IndentationConstraint) -> List[int]:
+        rows = []
         if indent_constraint.greater_than_indent_val is not None:
             for indent in self._indentation_to_tokens_map.keys():
                 if indent > indent_constraint.greater_than_indent_val:
-                    out_mask |= self._indentation_to_tokens_map[indent]
+                    rows.append(self._indentation_to_tokens_map[indent])
             
             for indent in self._whitespace_tokens_map.keys():  # We are ok with any num of whitespace
-                out_mask |= self._whitespace_tokens_map[indent]
+                rows.append(self._whitespace_tokens_map[indent])
 
         elif indent_constraint.accept_indents is not None:
             for indent in indent_constraint.accept_indents:
                 if indent in self._indentation_to_tokens_map:
-                    out_mask |= self._indentation_to_tokens_map[indent]
+                    rows.append(self._indentation_to_tokens_map[indent])
             
             max_acceptable_indent = max(indent_constraint.accept_indents)
             for indent in self._whitespace_tokens_map.keys():  # We are ok with num whitespace <= largest accepted indent
                 if indent <= max_acceptable_indent:
-                    out_mask |= self._whitespace_tokens_map[indent]
-        
-        if get_list: # This is useful for testing
-            return self._get_tokens_list(out_mask) 
-        return out_mask
+                    rows.append(self._whitespace_tokens_map[indent])
+        return rows
 
     def _get_tokens_list(self, token_mask) -> Iterable[str]:
         return [self._vocab[idx.item()] for idx in torch.where(token_mask == True)[0]]
@@ -279,7 +754,18 @@ class DFAMaskStore:
     2. INCOMPLETE: In this case, the remainder is incomplete and does not match any terminal regex. Thus, we need to compute all tokens such that consuming the token leads to a live state for the current terminal DFA or again it reaches a final state for the current terminal DFA at some point.
 
     3. MAYBE_COMPLETE: In this case the remainder matches a type of terminal. It may happen that we add to the same matched part of the remainder. In that case, there are two possibilities. i) the matched terminal type does not change and thus we can use the next terminal set computed by assuming that. ii) the matched terminal type changes and then we do not know the next terminal set. Thus, we need to compute all tokens such that consuming the token leads to a live state for the current terminal DFA or again it reaches a final state for the current terminal DFA at some point.
+
+    With lazy=True, nothing is precomputed in the constructor. The lookups for a DFA state (and a pair of DFA state and next terminal) are computed the first time get_accept_mask needs them and memoized. The vocabulary walks computed this way are added to the terminal shard cache every flush_interval DFA states and at exit, thus later processes start warm. build_all() fills in the remaining lookups at once.
+
+    The mask store is stored on disk in a versioned binary format (see save) that is loaded with mmap, thus the masks are not copied and the pages are shared by all processes that load the same file.
     """
+    _lazy = False
+
+    # File format: header, metadata (DFAs, vocabulary and the key index of the lookup table) and the bit-packed mask matrix aligned to FILE_ALIGNMENT bytes
+    FILE_MAGIC = b'SYNCMSK\0'
+    FILE_VERSION = 2
+    FILE_ALIGNMENT = 64
+    _FILE_HEADER = struct.Struct('<8sIIQQQ') # magic, version, little endian flag, metadata length, number of rows, number of words per row
     def __init__(self, 
                  terminals: Iterable[TerminalDef], 
                  vocab: Iterable[str], 
@@ -287,27 +773,86 @@ class DFAMaskStore:
                  special_token_ids: Iterable=[], 
                  indentation: bool=True,
                  mode='grammar_mask',
-                 ignore_terminals: Iterable[str]=[]
+                 ignore_terminals: Iterable[str]=[],
+                 use_trie: bool=True,
+                 num_workers: int=1,
+                 shard_cache_dir: Optional[str]=None,
+                 lazy: bool=False,
+                 flush_interval: int=64,
+                 accept_mask_cache_size: int=512
                  ):
         self._vocab = vocab
         self.special_token_ids = special_token_ids  
         self._mode = mode
-        self._dfas = DFAs(terminals, simplifications)
+        self._num_workers = num_workers
 
         # Check if whitespace is in ignore terminals
         self._ignore_whitespace = self.set_ignore_whitespace(terminals, ignore_terminals)
         print(f"Ignore whitespace tokens is {self._ignore_whitespace}", flush=True)
+
+        # Load the cached terminal shards
+        shard_cache = TerminalShardCache(shard_cache_dir, vocab, special_token_ids, self._ignore_whitespace) if shard_cache_dir is not None and use_trie else None
+        regex_to_shard = {}
+        if shard_cache is not None:
+            for terminal in terminals:
+                terminal_regex = DFAs.terminal_regex(terminal, simplifications)
+                if terminal_regex not in regex_to_shard:
+                    shard = shard_cache.load(terminal_regex)
+                    if shard is not None:
+                        regex_to_shard[terminal_regex] = shard
+        self._dfas = DFAs(terminals, simplifications, regex_to_dfa={terminal_regex: dfa for terminal_regex, (dfa, _) in regex_to_shard.items()})
         
         # Iterate through each pair of DFA state and next terminals and store the overapproximate tokens
         self._lookup_table = LookupTable(vocab, special_token_ids, indentation=indentation, mode=mode)
         terminal_names = [terminal.name for terminal in terminals]
-        self._store_overapproximate_tokens(terminal_names, vocab)
+        regex_to_walks = {terminal_regex: state_to_walk for terminal_regex, (_, state_to_walk) in regex_to_shard.items()}
+        if lazy:
+            if not use_trie:
+                raise ValueError("The lazy mask store requires use_trie=True")
+            self._init_lazy(terminal_names, regex_to_walks, shard_cache, flush_interval)
+        elif use_trie:
+            self._store_overapproximate_tokens(terminal_names, vocab, regex_to_walks, shard_cache)
+        else:
+            self._store_overapproximate_tokens_naive(terminal_names, vocab)
 
         self.indentation = indentation       
+        self._init_accept_mask_cache(accept_mask_cache_size)
 
         # NOTE: This should be called at the end of the constructor
         self._lookup_table.convert_lookups_from_list_to_mask() 
 
+    def _init_accept_mask_cache(self, size: int=512):
+        """
+        The final accept masks are cached in an LRU cache since decoding loops (e.g. repeated statements or JSON arrays) hit the same DFA states, accept sequences and indentation constraints over and over.
+        """
+        self._accept_mask_cache: OrderedDict = OrderedDict()
+        self._accept_mask_cache_size = size
+        self.accept_mask_cache_hits = 0
+        self.accept_mask_cache_misses = 0
+
+    def accept_mask_cache_stats(self) -> Dict[str, Any]:
+        num_lookups = self.accept_mask_cache_hits + self.accept_mask_cache_misses
+        return {
+            'size': len(self._accept_mask_cache),
+            'hits': self.accept_mask_cache_hits,
+            'misses': self.accept_mask_cache_misses,
+            'hit_rate': self.accept_mask_cache_hits / num_lookups if num_lookups > 0 else 0.0,
+        }
+
+    def _accept_mask_cache_key(self, dfa_states: Iterable[DFAState], r: ParseResult) -> tuple:
+        indent_key = None
+        if self.indentation and r.next_ac_indents is not None:
+            accept_indents = r.next_ac_indents.accept_indents
+            indent_key = (tuple(sorted(accept_indents)) if accept_indents is not None else None, r.next_ac_indents.greater_than_indent_val)
+        return (
+            frozenset((dfa_state.terminal, dfa_state.state_id) for dfa_state in dfa_states),
+            r.single_bits,
+            frozenset(r.pair_bits.items()),
+            r.first_bits,
+            r.remainder_state,
+            indent_key
+            )
+
     def set_ignore_whitespace(self, terminals: Iterable[TerminalDef], ignore_terminals: Iterable[str]) -> bool:
         ignore_whitespace = False
         for ig_name in ignore_terminals:
@@ -318,27 +863,33 @@ class DFAMaskStore:
         return ignore_whitespace
 
     @staticmethod
-    def load_dfa_mask_store(grammar: Grammar, tokenizer, use_cache=True, logger=None, mode='grammar_mask'):
+    def load_dfa_mask_store(grammar: Grammar, tokenizer, use_cache=True, logger=None, mode='grammar_mask', num_workers: int=1, lazy: bool=False):
         '''
         Loads the dfa for the given language and tokenizer. If the dfa is not cached, it is created and cached. 
+
+        num_workers (int, optional): Number of worker processes used for creating the dfa. Defaults to 1.
+        lazy (bool, optional): If the dfa is not cached, returns a lazy mask store that is filled in on demand instead. Only the terminal shards are cached in this case. Defaults to False.
         '''
         tokenizer_name = type(tokenizer).__name__
         dfa_dir = common.SYNCODE_CACHE + 'mask_stores/' + tokenizer_name + '/'
         grammar_hash = grammar.hash()
 
         # TODO: Hasing using the tokenizer vocab size, this may be problmatic if we have two fine-tuned models with same tokenizer, same vocab size but different vocab
-        dfa_path = f'{dfa_dir}{mode}_{grammar_hash}_{tokenizer.vocab_size}.pkl'
+        dfa_path = f'{dfa_dir}{mode}_{grammar_hash}_{tokenizer.vocab_size}.bin'
         
         start_time = time.time()
         if use_cache and os.path.exists(dfa_path):
             try:
-                mask_store = pickle.load(open(dfa_path, 'rb'))
+                mask_store = DFAMaskStore.load(dfa_path)
                 logger.log_time(f"Time taken for loading dfa: {time.time() - start_time:.2f}s")
                 return mask_store
             except: # If we cannot load the file, we will create the dfa from scratch
                 pass
     
-        print(f"Creating DFA mask store for {tokenizer_name} and {grammar}, may take more than 10 minutes. Caching at {os.path.abspath(dfa_path)}.", flush=True)
+        if lazy:
+            print(f"Creating lazy DFA mask store for {tokenizer_name} and {grammar}.", flush=True)
+        else:
+            print(f"Creating DFA mask store for {tokenizer_name} and {grammar}, may take a few minutes. Caching at {os.path.abspath(dfa_path)}.", flush=True)
         vocab = common.get_vocab_from_tokenizer(tokenizer)
         logger.log_time(f"Time taken for loading vocab: {time.time() - start_time:.2f}s")
 
@@ -348,20 +899,294 @@ class DFAMaskStore:
         simplifications = grammar.simplifications()
         os.makedirs(dfa_dir, exist_ok=True)
 
-        mask_store = DFAMaskStore(base_parser.terminals, vocab, simplifications=simplifications, special_token_ids=[tokenizer.eos_token_id], mode=mode, ignore_terminals=base_parser.ignore_tokens)
+        # Terminal shards are shared by all grammars and tokenizers with the same vocabulary
+        shard_cache_dir = common.SYNCODE_CACHE + 'mask_stores/terminals/' if use_cache else None
+
+        mask_store = DFAMaskStore(base_parser.terminals, vocab, simplifications=simplifications, special_token_ids=[tokenizer.eos_token_id], mode=mode, ignore_terminals=base_parser.ignore_tokens, num_workers=num_workers, shard_cache_dir=shard_cache_dir, lazy=lazy)
         logger.log_time(f"Time taken for creating dfa: {time.time() - start_time:.2f}s")
+        if lazy: # The lazy mask store is incomplete, thus it is not stored as a whole
+            return mask_store
 
-        pickle.dump(mask_store, open(dfa_path, 'wb'))
+        stats = mask_store._lookup_table.dedup_stats()
+        logger.log(f"DFA mask store has {stats['unique_masks']} unique masks out of {stats['masks']} (dedup ratio {stats['dedup_ratio']:.2f}, {stats['matrix_bytes'] / 2**20:.1f}MB)")
+
+        mask_store.save(dfa_path)
         logger.log_time(f"Time taken for storing the dfa: {time.time() - start_time:.2f}s")
         return mask_store
 
+    def save(self, path: str):
+        """
+        Stores the mask store in the binary format that is loaded by DFAMaskStore.load.
+        """
+        if self._lazy:
+            raise ValueError("A lazy mask store cannot be saved, call build_all() first")
+        lookup_table = self._lookup_table
+        metadata = pickle.dumps({
+            'vocab': list(self._vocab),
+            'special_token_ids': list(self.special_token_ids),
+            'mode': self._mode,
+            'indentation': self.indentation,
+            'ignore_whitespace': self._ignore_whitespace,
+            'dfas': self._dfas.to_data(),
+            'lookup_table': lookup_table.to_index(),
+        })
+        num_rows, num_words = lookup_table._num_masks, lookup_table._num_words
+        header = self._FILE_HEADER.pack(self.FILE_MAGIC, self.FILE_VERSION, sys.byteorder == 'little', len(metadata), num_rows, num_words)
+        matrix_offset = self._matrix_offset(len(metadata))
+        
+        # Write to a temporary file first so that concurrent processes never read a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(metadata)
+            f.truncate(matrix_offset + num_rows * num_words * 8)
+        if num_rows * num_words > 0:
+            # Copy the matrix through a writable mapping of the file
+            with open(tmp_path, 'r+b') as f, mmap.mmap(f.fileno(), 0) as mm:
+                matrix = torch.frombuffer(mm, dtype=torch.int64, count=num_rows * num_words, offset=matrix_offset)
+                matrix.copy_(lookup_table._masks[:num_rows].reshape(-1))
+                del matrix
+                mm.flush()
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> 'DFAMaskStore':
+        """
+        Loads the mask store stored by DFAMaskStore.save. The mask matrix is mapped copy-on-write and it is never written, thus it stays shared with the page cache.
+        """
+        with open(path, 'rb') as f:
+            header = f.read(DFAMaskStore._FILE_HEADER.size)
+            if len(header) != DFAMaskStore._FILE_HEADER.size:
+                raise ValueError(f"Invalid mask store file: {path}")
+            magic, version, little_endian, metadata_len, num_rows, num_words = DFAMaskStore._FILE_HEADER.unpack(header)
+            if magic != DFAMaskStore.FILE_MAGIC:
+                raise ValueError(f"Invalid mask store file: {path}")
+            if version != DFAMaskStore.FILE_VERSION:
+                raise ValueError(f"Unsupported mask store version {version}, expected {DFAMaskStore.FILE_VERSION}")
+            if bool(little_endian) != (sys.byteorder == 'little'):
+                raise ValueError("The mask store was stored on a machine with a different byte order")
+            metadata = pickle.loads(f.read(metadata_len))
+
+            matrix_offset = DFAMaskStore._matrix_offset(metadata_len)
+            if num_rows * num_words > 0:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+                masks = torch.frombuffer(mm, dtype=torch.int64, count=num_rows * num_words, offset=matrix_offset).view(num_rows, num_words)
+            else:
+                masks = torch.zeros((num_rows, num_words), dtype=torch.int64)
+
+        mask_store = DFAMaskStore.__new__(DFAMaskStore)
+        mask_store._vocab = metadata['vocab']
+        mask_store.special_token_ids = metadata['special_token_ids']
+        mask_store._mode = metadata['mode']
+        mask_store._num_workers = 1
+        mask_store._ignore_whitespace = metadata['ignore_whitespace']
+        mask_store.indentation = metadata['indentation']
+        mask_store._dfas = DFAs.from_data(metadata['dfas'])
+        mask_store._init_accept_mask_cache()
+        mask_store._lookup_table = LookupTable.from_index(metadata['lookup_table'], mask_store._vocab, mask_store.special_token_ids, masks)
+        return mask_store
+
+    @staticmethod
+    def _matrix_offset(metadata_len: int) -> int:
+        offset = DFAMaskStore._FILE_HEADER.size + metadata_len
+        return (offset + DFAMaskStore.FILE_ALIGNMENT - 1) // DFAMaskStore.FILE_ALIGNMENT * DFAMaskStore.FILE_ALIGNMENT
+
     def _get_default_mask(self) -> torch.Tensor:
         mask = torch.zeros(len(self._vocab), dtype=torch.bool)
         return mask
 
-    def _store_overapproximate_tokens(self, terminals: Iterable[str], vocab: Iterable[str]):
+    def _store_overapproximate_tokens(self, terminals: Iterable[str], vocab: Iterable[str], regex_to_walks: Dict[str, Dict[int, tuple]]={}, shard_cache: Optional[TerminalShardCache]=None):
         """
         Stores the overapproximate tokens for each dfa state and next terminals
+
+        Instead of consuming every token separately for every DFA state, we build a prefix trie over the vocabulary once and walk it with each DFA state (see DFAs.consume_prefix_trie). The remainders left after the walk are shared by many (DFA state, token) pairs, thus the next terminals accepting a remainder are computed only once per distinct remainder.
+
+        The walk only depends on the terminal DFA and the vocabulary. It is reused from regex_to_walks for the DFA states whose walks were cached and the new walks are stored in shard_cache.
+        """
+        regex_to_walks = {terminal_regex: dict(state_to_walk) for terminal_regex, state_to_walk in regex_to_walks.items()}
+
+        # Walk the states that are not cached. Terminals with the same regex are walked only once
+        regex_to_terminal = {self._dfas.regex(terminal): terminal for terminal in terminals}
+        new_dfa_states = [dfa_state for dfa_state in self._dfas.states() if regex_to_terminal[self._dfas.regex(dfa_state.terminal)] == dfa_state.terminal and dfa_state.state_id not in regex_to_walks.get(self._dfas.regex(dfa_state.terminal), {})]
+        if new_dfa_states:
+            walker = VocabTrieWalker(self._dfas, vocab, self.special_token_ids, self._ignore_whitespace)
+            for dfa_state, walk in zip(new_dfa_states, self._walk_dfa_states(walker, new_dfa_states)):
+                regex_to_walks.setdefault(self._dfas.regex(dfa_state.terminal), {})[dfa_state.state_id] = walk
+
+            if shard_cache is not None:
+                for terminal_regex in {self._dfas.regex(dfa_state.terminal) for dfa_state in new_dfa_states}:
+                    shard_cache.store(terminal_regex, self._dfas.dfa(regex_to_terminal[terminal_regex]), regex_to_walks[terminal_regex])
+
+        dfa_state_to_remainders = {}
+        for dfa_state in self._dfas.states():
+            live_tokens, remainder_to_tokens, exact_tokens = regex_to_walks[self._dfas.regex(dfa_state.terminal)][dfa_state.state_id]
+            dfa_state_to_remainders[dfa_state] = (live_tokens, remainder_to_tokens)
+            if exact_tokens:
+                self._lookup_table.add_exact_lookup_tokens(dfa_state, exact_tokens)
+
+            if self._dfas.is_final(dfa_state):
+                for token_idx in self.special_token_ids:
+                    self._lookup_table.dfa_state_and_next_terminal_to_tokens_add(dfa_state, '$END', token_idx)
+
+        remainder_to_next_terminals = self._compute_next_terminals_for_remainders(terminals, {remainder for _, remainder_to_tokens in dfa_state_to_remainders.values() for remainder in remainder_to_tokens})
+
+        for dfa_state, (live_tokens, remainder_to_tokens) in dfa_state_to_remainders.items():
+            next_terminal_to_tokens = defaultdict(list)
+            for remainder, tokens in remainder_to_tokens.items():
+                for next_terminal in remainder_to_next_terminals[remainder]:
+                    next_terminal_to_tokens[next_terminal].extend(tokens)
+            
+            for next_terminal in terminals:
+                tokens = list(live_tokens) + next_terminal_to_tokens[next_terminal]
+                if tokens:
+                    self._lookup_table.dfa_state_and_next_terminal_to_tokens_extend(dfa_state, next_terminal, tokens)
+
+    def _walk_dfa_states(self, walker: VocabTrieWalker, dfa_states: List[DFAState]) -> Iterable[Tuple[array, Dict[str, array], array]]:
+        """
+        Walks the vocabulary tries with each DFA state. With more than one worker, the DFA states are split in contiguous shards that are walked in a process pool. The results are returned in the order of dfa_states irrespective of the number of workers.
+        """
+        if self._num_workers <= 1 or len(dfa_states) <= 1:
+            for dfa_state in tqdm(dfa_states):
+                yield walker.walk(dfa_state)
+            return
+
+        # Several shards per worker so that the work is balanced even if some terminals (e.g. strings) are more expensive
+        shard_size = max(1, len(dfa_states) // (self._num_workers * 8))
+        shards = [dfa_states[i:i+shard_size] for i in range(0, len(dfa_states), shard_size)]
+        with ProcessPoolExecutor(max_workers=self._num_workers, initializer=_init_walker_process, initargs=(walker,)) as executor:
+            for shard_result in tqdm(executor.map(_walk_shard_in_process, shards), total=len(shards)):
+                yield from shard_result
+
+    def _compute_next_terminals_for_remainders(self, terminals: Iterable[str], remainders: Iterable[str]) -> Dict[str, List[str]]:
+        """
+        For every distinct remainder, computes the next terminals such that consuming the remainder from the initial state of the next terminal is valid.
+        """
+        remainders = sorted(set(remainders))
+        remainder_trie = TokenTrie(enumerate(remainders))
+
+        remainder_to_next_terminals: Dict[str, List[str]] = {remainder: [] for remainder in remainders}
+        for next_terminal in terminals:
+            initial_state = self._dfas.initial(next_terminal)
+            for remainder_idx, remainder_new in self._dfas.consume_prefix_trie(initial_state, remainder_trie):
+                if self._mode == 'grammar_mask':
+                    # In the non-strict mode we overapproximate. We reached a live state for the next terminal, thus we add the token in the overapproximate sets of next terminals
+                    remainder_to_next_terminals[remainders[remainder_idx]].append(next_terminal)
+                elif self._mode == 'grammar_strict':
+                    if remainder_new == '':
+                        # We reached a live state for the next terminal and the remainder is empty, thus we add the token in the exact set of next terminals
+                        remainder_to_next_terminals[remainders[remainder_idx]].append(next_terminal)
+                else:
+                    raise ValueError(f"Invalid mode: {self._mode}")
+        return remainder_to_next_terminals
+
+    def _init_lazy(self, terminals: Iterable[str], regex_to_walks: Dict[str, Dict[int, tuple]], shard_cache: Optional[TerminalShardCache], flush_interval: int):
+        self._lazy = True
+        self._terminal_names = list(terminals)
+        self._regex_to_terminal = {self._dfas.regex(terminal): terminal for terminal in self._terminal_names}
+        self._regex_to_walks = {terminal_regex: dict(state_to_walk) for terminal_regex, state_to_walk in regex_to_walks.items()}
+        self._shard_cache = shard_cache
+        self._flush_interval = flush_interval
+        self._walker: Optional[VocabTrieWalker] = None # The vocabulary tries are only built if some walk is not cached
+        self._pending_walks: Dict[str, Dict[int, tuple]] = {} # Walks that are not flushed to the shard cache yet
+        self._num_pending_walks = 0
+        self._remainder_to_next_terminals: Dict[str, List[str]] = {}
+        self._lazy_next_terminal_to_tokens: Dict[DFAState, Dict[str, list]] = {} # Filled in DFA states
+        self._lazy_filled_pairs: set = set()
+        _incomplete_lazy_stores.add(self)
+
+    def _lazy_walk(self, dfa_state: DFAState) -> Tuple[array, Dict[str, array], array]:
+        terminal_regex = self._dfas.regex(dfa_state.terminal)
+        state_to_walk = self._regex_to_walks.setdefault(terminal_regex, {})
+        if dfa_state.state_id not in state_to_walk:
+            if self._walker is None:
+                self._walker = VocabTrieWalker(self._dfas, self._vocab, self.special_token_ids, self._ignore_whitespace)
+            walk = self._walker.walk(dfa_state)
+            state_to_walk[dfa_state.state_id] = walk
+            self._pending_walks.setdefault(terminal_regex, {})[dfa_state.state_id] = walk
+            self._num_pending_walks += 1
+            if self._num_pending_walks >= self._flush_interval:
+                self.flush()
+        return state_to_walk[dfa_state.state_id]
+
+    def _lazy_fill_dfa_state(self, dfa_state: DFAState):
+        """
+        Computes the exact and the overapproximate lookups for the DFA state. The tokens for each next terminal are kept to compute the lookups for the pairs of the DFA state and next terminal on demand.
+        """
+        if dfa_state in self._lazy_next_terminal_to_tokens:
+            return
+        live_tokens, remainder_to_tokens, exact_tokens = self._lazy_walk(dfa_state)
+
+        new_remainders = [remainder for remainder in remainder_to_tokens if remainder not in self._remainder_to_next_terminals]
+        if new_remainders:
+            self._remainder_to_next_terminals.update(self._compute_next_terminals_for_remainders(self._terminal_names, new_remainders))
+
+        next_terminal_to_tokens = defaultdict(list)
+        for remainder, tokens in remainder_to_tokens.items():
+            for next_terminal in self._remainder_to_next_terminals[remainder]:
+                next_terminal_to_tokens[next_terminal].extend(tokens)
+        if self._dfas.is_final(dfa_state):
+            next_terminal_to_tokens['$END'].extend(self.special_token_ids)
+        self._lazy_next_terminal_to_tokens[dfa_state] = next_terminal_to_tokens
+
+        if exact_tokens:
+            self._lookup_table.store_exact_lookup(dfa_state, exact_tokens)
+
+        # The overapproximate lookup is the union of the lookups of all next terminals
+        overapprox_tokens = list(live_tokens) + [token_idx for tokens in next_terminal_to_tokens.values() for token_idx in tokens]
+        if overapprox_tokens:
+            self._lookup_table.store_overapprox_lookup(dfa_state, overapprox_tokens)
+
+    def _lazy_fill_next_terminal(self, dfa_state: DFAState, next_terminal: str):
+        if (dfa_state, next_terminal) in self._lazy_filled_pairs:
+            return
+        self._lazy_fill_dfa_state(dfa_state)
+        tokens = self._lazy_next_terminal_to_tokens[dfa_state].get(next_terminal, [])
+        if next_terminal in self._terminal_names:
+            tokens = list(self._lazy_walk(dfa_state)[0]) + tokens
+        if tokens:
+            self._lookup_table.dfa_state_and_next_terminal_to_tokens_store(dfa_state, next_terminal, tokens)
+        self._lazy_filled_pairs.add((dfa_state, next_terminal))
+
+    def build_all(self):
+        """
+        Fills in the lookups for all DFA states and next terminals of a lazy mask store. The missing vocabulary walks are computed with num_workers processes and flushed to the shard cache.
+        """
+        if not self._lazy:
+            return
+        missing_dfa_states = [dfa_state for dfa_state in self._dfas.states() if self._regex_to_terminal[self._dfas.regex(dfa_state.terminal)] == dfa_state.terminal and dfa_state.state_id not in self._regex_to_walks.get(self._dfas.regex(dfa_state.terminal), {})]
+        if missing_dfa_states:
+            if self._walker is None:
+                self._walker = VocabTrieWalker(self._dfas, self._vocab, self.special_token_ids, self._ignore_whitespace)
+            for dfa_state, walk in zip(missing_dfa_states, self._walk_dfa_states(self._walker, missing_dfa_states)):
+                terminal_regex = self._dfas.regex(dfa_state.terminal)
+                self._regex_to_walks.setdefault(terminal_regex, {})[dfa_state.state_id] = walk
+                self._pending_walks.setdefault(terminal_regex, {})[dfa_state.state_id] = walk
+        self.flush()
+
+        for dfa_state in self._dfas.states():
+            for next_terminal in self._terminal_names + ['$END']:
+                self._lazy_fill_next_terminal(dfa_state, next_terminal)
+        # All the walks are flushed, thus nothing is left to flush at exit
+        _incomplete_lazy_stores.discard(self)
+
+    def flush(self):
+        """
+        Adds the vocabulary walks computed by a lazy mask store since the last flush to the terminal shard cache.
+        """
+        if not self._lazy or not self._pending_walks:
+            return
+        pending_walks, self._pending_walks, self._num_pending_walks = self._pending_walks, {}, 0
+        if self._shard_cache is None:
+            return
+        for terminal_regex, state_to_walk in pending_walks.items():
+            try:
+                self._shard_cache.update(terminal_regex, self._dfas.dfa(self._regex_to_terminal[terminal_regex]), state_to_walk)
+            except OSError: # The cache is only an optimization, thus we do not fail if it cannot be written
+                pass
+
+    def _store_overapproximate_tokens_naive(self, terminals: Iterable[str], vocab: Iterable[str]):
+        """
+        Reference implementation of _store_overapproximate_tokens that consumes every token separately for every DFA state. This is much slower and is only kept for testing and benchmarking.
         """
         all_dfa_states = self._dfas.states()
         pbar = tqdm(total=len(all_dfa_states))
@@ -417,39 +1242,48 @@ class DFAMaskStore:
             self._lookup_table.add_exact_lookup(dfa_state, token_idx)
         
 
-    def _lookup_next_tokens_for_dfa_state(self, dfa_state: DFAState, next_terminal) -> torch.Tensor:
-        tokens = self._lookup_table.dfa_state_and_next_terminal_to_tokens(dfa_state, next_terminal)
-        if tokens == []:
-            # TODO: This is a hack. Do something better
-            return self._get_default_mask()
-        return tokens
+    def _lookup_next_tokens_for_dfa_state(self, dfa_state: DFAState, next_terminal) -> Optional[int]:
+        if self._lazy:
+            self._lazy_fill_next_terminal(dfa_state, next_terminal)
+        # None if no token is accepted for the pair
+        return self._lookup_table.dfa_state_and_next_terminal_to_tokens(dfa_state, next_terminal)
 
     def _lookup_next_tokens(self, dfa_states: Iterable[DFAState], r: ParseResult) -> torch.Tensor:
-        overapprox_token_ids = self._get_default_mask()
-
-        # Case when the final string may be incomplete
-        for dfa_state in dfa_states:
-                for accept_sequence in r.accept_sequences:
-                    if dfa_state.terminal != accept_sequence[0]:
-                        continue
-
-                    if r.remainder_state == RemainderState.COMPLETE:
-                            assert len(accept_sequence) == 1 # Since we only store length 1 accept sequences in this case
-                            overapprox_token_ids |= self._lookup_table.complete_case_lookup(dfa_state)
+        return self._lookup_table.masks_union(self._lookup_rows(dfa_states, r))
 
-                    if r.remainder_state == RemainderState.INCOMPLETE:
-                            overapprox_token_ids |= self._lookup_table.incomplete_case_lookup(dfa_state)
-                    
-                    if r.remainder_state == RemainderState.MAYBE_COMPLETE:
-                            if len(accept_sequence) == 1:
-                                overapprox_token_ids |= self._lookup_table.complete_case_lookup(dfa_state)
-                            elif len(accept_sequence) == 2:
-                                overapprox_token_ids |= self._lookup_next_tokens_for_dfa_state(dfa_state, accept_sequence[1])
-                            else:
-                                raise ValueError(f"Invalid accept sequence: {accept_sequence}")
-        return overapprox_token_ids
+    def _lookup_rows(self, dfa_states: Iterable[DFAState], r: ParseResult) -> List[int]:
+        """
+        Returns the row ids of the lookups in the mask matrix whose union is the accept mask, so the union can be computed at once.
+        """
+        rows = []
+        first_bits, single_bits, pair_bits = r.first_bits, r.single_bits, r.pair_bits
 
-    def get_dfa_states(self, r: ParseResult) -> Iterable[DFAState]:
+        # Only the DFA states whose terminal is the first terminal of an accept sequence are looked up
+        for dfa_state in dfa_states:
+            tid = terminal_id(dfa_state.terminal)
+            if not (first_bits >> tid) & 1:
+                continue
+
+            if self._lazy:
+                self._lazy_fill_dfa_state(dfa_state)
+
+            if r.remainder_state == RemainderState.COMPLETE:
+                assert tid not in pair_bits # Since we only store length 1 accept sequences in this case
+                rows.append(self._lookup_table.complete_case_lookup(dfa_state))
+
+            if r.remainder_state == RemainderState.INCOMPLETE:
+                rows.append(self._lookup_table.incomplete_case_lookup(dfa_state))
+
+            if r.remainder_state == RemainderState.MAYBE_COMPLETE:
+                if (single_bits >> tid) & 1:
+                    rows.append(self._lookup_table.complete_case_lookup(dfa_state))
+                for next_tid in iter_bits(pair_bits.get(tid, 0)):
+                    row = self._lookup_next_tokens_for_dfa_state(dfa_state, terminal_name(next_tid))
+                    if row is not None:
+                        rows.append(row)
+        return rows
+
+    def get_dfa_states(self, r: ParseResult, prev_dfa_states: Optional[RemainderDFAStates]=None) -> Iterable[DFAState]:
         """
         Returns the DFA state for the current partial code
         """
@@ -457,14 +1291,15 @@ class DFAMaskStore:
         if cur_incomplete_string is None:
             return []
 
-        cur_dfa_states = self._dfas.compute_dfa_states(cur_incomplete_string)
+        cur_dfa_states = self._dfas.compute_dfa_states(cur_incomplete_string, prev_dfa_states)
         return cur_dfa_states
 
     def get_accept_mask(
             self, 
             r: ParseResult, 
             get_list=False, 
-            logger: common.Logger=common.EmptyLogger()
+            logger: common.Logger=common.EmptyLogger(),
+            prev_dfa_states: Optional[RemainderDFAStates]=None
             ) -> torch.Tensor:
         """
         Returns the mask for the acceptable tokens for the current partial code
@@ -473,35 +1308,65 @@ class DFAMaskStore:
             r (ParseResult): The parse result
             get_list (bool, optional): If True, returns the list of tokens instead of the mask. Defaults to False.
             logger (common.Logger, optional): The logger. Defaults to common.EmptyLogger().
+            prev_dfa_states (RemainderDFAStates, optional): The DFA states of the remainder of the same sequence at the previous step. It is used to compute the DFA states incrementally and it is updated. Defaults to None.
+
+        NOTE: The returned mask is shared with the accept mask cache and should not be modified in place.
         """
         start_time = time.time()
         cur_incomplete_string = r.remainder
         if cur_incomplete_string is None:
             return torch.ones(len(self._vocab), dtype=torch.bool)
 
-        cur_dfa_states = self._dfas.compute_dfa_states(cur_incomplete_string)
-        accept_token_mask = self._lookup_next_tokens(cur_dfa_states, r)
+        cur_dfa_states = self._dfas.compute_dfa_states(cur_incomplete_string, prev_dfa_states)
 
-        if self.indentation and r.next_ac_indents is not None:
-            indent_ac_token = self._lookup_table.get_indentation_tokens(r.next_ac_indents)
-            accept_token_mask &= indent_ac_token
+        cache_key = self._accept_mask_cache_key(cur_dfa_states, r)
+        accept_token_mask = self._accept_mask_cache.get(cache_key)
+        if accept_token_mask is not None:
+            self.accept_mask_cache_hits += 1
+            self._accept_mask_cache.move_to_end(cache_key)
+        else:
+            self.accept_mask_cache_misses += 1
+            accept_token_mask = self._lookup_next_tokens(cur_dfa_states, r)
+
+            if self.indentation and r.next_ac_indents is not None:
+                indent_ac_token = self._lookup_table.get_indentation_tokens(r.next_ac_indents)
+                accept_token_mask &= indent_ac_token
+
+            if self._accept_mask_cache_size > 0:
+                self._accept_mask_cache[cache_key] = accept_token_mask
+                if len(self._accept_mask_cache) > self._accept_mask_cache_size:
+                    self._accept_mask_cache.popitem(last=False)
             
         if get_list: # This is useful for testing
             return self._get_tokens_list(accept_token_mask)
         logger.log_time(f"Time taken for computing the mask: {time.time() - start_time:.3f}s")
         return accept_token_mask
     
-    def is_valid_prefix(self, r: ParseResult) -> bool:
+    def get_forced_token(self, r: ParseResult, prev_dfa_states: Optional[RemainderDFAStates]=None) -> Optional[int]:
+        """
+        Returns the token if the accept mask for the current partial code has exactly one token and None otherwise. The rows of the lookups are checked for a single token without building the mask, so this is much cheaper than get_accept_mask when no token is forced.
+
+        With an indentation constraint, None is also returned if the lookups have more than one token but only one of them has an acceptable indentation.
+        """
+        if r.remainder is None:
+            return None
+        cur_dfa_states = self._dfas.compute_dfa_states(r.remainder, prev_dfa_states)
+        token = self._lookup_table.masks_union_single_token(self._lookup_rows(cur_dfa_states, r))
+        if token is not None and self.indentation and r.next_ac_indents is not None and not self._lookup_table.indentation_accepts(r.next_ac_indents, token):
+            return None
+        return token
+
+    def is_valid_prefix(self, r: ParseResult, prev_dfa_states: Optional[RemainderDFAStates]=None) -> bool:
         """
         Check if r.remainder is a valid prefix for accept sequences in r
         """
         cur_incomplete_string = r.remainder
 
-        cur_dfa_states = self._dfas.compute_dfa_states(cur_incomplete_string)
-        for accept_sequence in r.accept_sequences:
-            for dfa_state in cur_dfa_states:
-                if dfa_state.terminal == accept_sequence[0]:
-                    return True
+        cur_dfa_states = self._dfas.compute_dfa_states(cur_incomplete_string, prev_dfa_states)
+        first_bits = r.first_bits
+        for dfa_state in cur_dfa_states:
+            if (first_bits >> terminal_id(dfa_state.terminal)) & 1:
+                return True
         return False
 
     def _list_to_mask(self, tokens_idx_list) -> torch.Tensor:
@@ -1,12 +1,16 @@
-import time
-from typing import Iterator
+import hashlib, threading, time
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
 import torch
 import syncode.common as common
 from transformers import LogitsProcessor, PreTrainedTokenizer
-from syncode.parse_result import RemainderState
+from syncode.parse_result import RemainderState, terminals_to_bits
 from syncode.parsers.incremental_parser import IncrementalParser, ParseResult
 from syncode.parsers import create_parser
-from syncode.dfa_mask_store import DFAMaskStore
+from syncode.parsers.parser_pool import ParserPool
+from syncode.parsers.parser_state_cache import ParserStateCache
+from syncode.dfa_mask_store import DFAMaskStore, RemainderDFAStates
+from syncode.incremental_detokenizer import IncrementalDetokenizer
 from syncode.parsers.grammars import Grammar
 
 
@@ -19,19 +23,27 @@ class GrammarDecoder(LogitsProcessor):
         tokenizer (PreTrainedTokenizer): The tokenizer to use for decoding.
         logger (common.Logger): The logger to use for logging.
         use_cache (bool, optional): Whether to use the cache. Defaults to True.
+        lazy_mask_store (bool, optional): Whether to compute the DFA mask store lazily if it is not cached. Defaults to False.
+        mask_store_workers (int, optional): Number of worker processes used for creating the DFA mask store if it is not cached. Defaults to 1.
         parse_output_only (bool, optional): Whether to parse the prompt. Defaults to False.
-        dev_mode (bool, optional): Whether to run in development mode. Defaults to False.
+        dev_mode (bool, optional): Whether to run in development mode, which raises the parser exceptions and logs the parse results of the masked rows and the steps where the grammar mask changes the greedy token. Defaults to False.
+        parser_state_cache_size (int, optional): Memory budget in bytes of the cache of the parser states for the prompt prefixes, which is kept across prompts. It is only used if the prompt is parsed. Defaults to 64MB, 0 disables the cache.
+        prompt_block_size (int, optional): Minimum number of tokens between the prompt prefixes whose parser states are cached. Defaults to 64.
     """
     def __init__(self, 
         grammar: Grammar, 
         tokenizer: PreTrainedTokenizer, 
         logger: common.Logger, 
         use_cache=True,
+        lazy_mask_store=False,
+        mask_store_workers=1,
         parse_output_only=False, 
         num_samples=1,
         dev_mode=False,
         parser='lalr',
-        mode='grammar_mask'):
+        mode='grammar_mask',
+        parser_state_cache_size=64 * 2**20,
+        prompt_block_size=64):
 
         time_start = time.time()
         self.tokenizer = tokenizer
@@ -43,6 +55,7 @@ class GrammarDecoder(LogitsProcessor):
         # For backtracking to syntactically valid completions
         self.last_valid_state: list = []
         self.function_end: list = []
+        self._end_terminal_bits = terminals_to_bits(['$END', 'EOF'])
 
         # We use this when only the LLM output is parsed and not (input+output)
         self.parse_output_only = parse_output_only
@@ -55,13 +68,37 @@ class GrammarDecoder(LogitsProcessor):
                                     use_cache=use_cache, 
                                     logger=self.logger,
                                     mode=mode,
+                                    lazy=lazy_mask_store,
+                                    num_workers=mask_store_workers,
                                     )
 
-        # Create parsers
-        self.inc_parsers: Iterator[IncrementalParser] = [create_parser(self.grammar, logger=self.logger, parser=parser) for _ in range(self.batch_size)]
+        # Create parsers. They only recognize the code since the parse tree is not needed for computing the accepted terminals
+        self.inc_parsers: Iterator[IncrementalParser] = [create_parser(self.grammar, logger=self.logger, parser=parser, recognizer=True)]
+        self.inc_parsers += [create_parser(self.grammar, logger=self.logger, parser=parser, recognizer=True, dense_table=self.inc_parsers[0].dense_table) for _ in range(self.batch_size-1)]
+
+        # The samples with the same code are parsed once per step
+        self.parser_pool = ParserPool(self.inc_parsers)
+
+        # Parser states for the prefixes of the previous prompts, e.g., for a common system prompt or few-shot examples
+        self.parser_state_cache = ParserStateCache(parser_state_cache_size) if parser_state_cache_size > 0 else None
+        self.prompt_block_size = prompt_block_size
+
+        # DFA states of the remainder at the previous step for each sequence
+        self.remainder_dfa_states = [RemainderDFAStates() for _ in range(self.batch_size)]
+
+        # Decoded text of the generated tokens for each sequence, so that only the new tokens are decoded in every step
+        self.detokenizers = [IncrementalDetokenizer(self.tokenizer) for _ in range(self.batch_size)]
+
+        # Accept masks of the rows of the batch padded to the width of the scores
+        self._mask_buffer = None
+
+        # Row -> (partial code, parse result, accept mask) computed ahead of time by prepare_masks()
+        self._prepared_masks: Dict[int, Tuple[str, ParseResult, torch.Tensor]] = {}
+        self._last_masked_rows: List[int] = [] # Rows masked by the last __call__, their masks are prepared first
+        self.num_prepared_masks = 0
+        self.num_prepared_mask_hits = 0
+        self.num_prepared_mask_misses = 0
 
-        # For profiling
-        self.debug = True
         self.logger.log_time(f"Time taken for preprocessing: {time.time() - time_start:.2f}s")
         
     def _log_current_status(self, partial_code, r: ParseResult):
@@ -81,10 +118,67 @@ class GrammarDecoder(LogitsProcessor):
         else:
             self.start_from = 0
 
-        for p in self.inc_parsers:
-            p.reset()
+        self.parser_pool.reset()
+        if not self.parse_output_only and self.parser_state_cache is not None:
+            self._parse_prompt(prompt_tokens.tolist())
+
+        for dfa_states in self.remainder_dfa_states:
+            dfa_states.reset()
+
+        for detokenizer in self.detokenizers:
+            detokenizer.reset()
+
+        self._prepared_masks = {}
+        self._last_masked_rows = []
+        self.num_prepared_masks = 0
+        self.num_prepared_mask_hits = 0
+        self.num_prepared_mask_misses = 0
 
 
+    def _parse_prompt(self, prompt_tokens: List[int]):
+        """
+        Parses the prompt before the first step. Parsing resumes from the cached parser state of the longest prefix of the prompt, and the parser states for the longer prefixes are added to the cache.
+        """
+        prefixes = self._prompt_prefixes(prompt_tokens)
+        num_cached_tokens = 0
+        for num_tokens, key in reversed(prefixes):
+            state = self.parser_state_cache.get(key)
+            if state is not None:
+                self.parser_pool.restore_state(state)
+                num_cached_tokens = num_tokens
+                break
+        self.parser_state_cache.record_lookup(num_cached_tokens, len(prompt_tokens))
+
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        for num_tokens, key in prefixes:
+            if num_tokens <= num_cached_tokens:
+                continue
+            try:
+                self.parser_pool.get_acceptable_next_terminals(0, detokenizer.decode(prompt_tokens[:num_tokens]))
+            except Exception as e:
+                self.logger.log(f"Exception while parsing the prompt:\n {e}")
+                break
+            self.parser_state_cache.put(key, self.parser_pool.parsers[0].save_state())
+        self.logger.log(f"Parser state cache: {self.parser_state_cache.stats()}")
+
+    def _prompt_prefixes(self, prompt_tokens: List[int]) -> List[Tuple[int, str]]:
+        """
+        Returns the number of tokens and the hash of the token ids of the prompt prefixes whose parser states are cached.
+
+        A prefix ends at the first token of a line, so that the lexer checkpoint of the parser state is close to the end of the prefix, and the whole prompt is the last prefix. The prefixes are at least prompt_block_size tokens and 1/8 of the prefix length apart, so the cached states of a prompt take O(n) memory in total. They only depend on the tokens in the prefix, so the prompts that start with the same tokens have the same prefixes.
+        """
+        vocab = self.dfa_mask_store._vocab
+        token_texts = [vocab[token_id] if token_id < len(vocab) else '' for token_id in prompt_tokens]
+        hasher = hashlib.sha256()
+        prefixes: List[Tuple[int, str]] = []
+        start = 0
+        for num_tokens in range(1, len(prompt_tokens)+1):
+            if num_tokens == len(prompt_tokens) or (num_tokens - start >= max(self.prompt_block_size, start // 8, 2) and '\n' in token_texts[num_tokens-2]):
+                hasher.update(array('q', prompt_tokens[start:num_tokens]).tobytes())
+                prefixes.append((num_tokens, hasher.hexdigest()))
+                start = num_tokens
+        return prefixes
+
     def is_valid(self, input_ids: torch.LongTensor, next_token: torch.LongTensor) -> bool:
         """
         Check if the next token is valid given the input_ids.
@@ -97,90 +191,218 @@ class GrammarDecoder(LogitsProcessor):
             bool: True if the next token is valid, False otherwise.
         """
         assert len(input_ids) == 1, "Only one input is supported for now."
-        input_ids = torch.cat((input_ids, next_token.unsqueeze(0)), dim=-1)
-        partial_code = self._get_partial_codes(input_ids)[0]
-
-        try:
-            r = self.inc_parsers[0].get_acceptable_next_terminals(partial_code)
-        except Exception as e:
-            self.logger.log(f"Exception while parsing:\n {e}")
-            return False
-        
-        self.update_valid_state(input_ids, 0, r)
-        if r.remainder_state == RemainderState.COMPLETE or r.remainder_state == RemainderState.MAYBE_COMPLETE:
-            return True
+        return bool(self.get_valid_rows(input_ids, next_token)[0])
+
+    def get_valid_rows(self, input_ids: torch.LongTensor, next_tokens: torch.LongTensor, rows: Optional[List[int]]=None) -> torch.BoolTensor:
+        """
+        Checks for each row of the batch if its next token is valid given its input_ids.
+
+        Args:
+            input_ids (torch.LongTensor): The input ids of the rows.
+            next_tokens (torch.LongTensor): The next token of each row.
+            rows (List[int], optional): The rows of the batch of the input ids if only some rows are checked. Defaults to None, i.e., all the rows.
+
+        Returns:
+            torch.BoolTensor: True for the rows whose next token is valid.
+        """
+        if rows is None:
+            rows = list(range(input_ids.size(0)))
+        input_ids = torch.cat((input_ids, next_tokens.unsqueeze(-1)), dim=-1)
+        partial_codes = self._get_partial_codes(input_ids, rows)
+        self.parser_pool.share(partial_codes, rows)
+
+        valid = torch.zeros(len(rows), dtype=torch.bool)
+        for i, (idx, partial_code) in enumerate(zip(rows, partial_codes)):
+            try:
+                r = self.parser_pool.get_acceptable_next_terminals(idx, partial_code)
+            except Exception as e:
+                self.logger.log(f"Exception while parsing:\n {e}")
+                continue
+
+            self.update_valid_state(input_ids[i:i+1], idx, r)
+            if r.remainder_state == RemainderState.COMPLETE or r.remainder_state == RemainderState.MAYBE_COMPLETE:
+                valid[i] = True
+            else:
+                # Check if the remainder is a valid prefix for the last terminal
+                valid[i] = self.dfa_mask_store.is_valid_prefix(r, prev_dfa_states=self.remainder_dfa_states[idx])
+        return valid
+
+    def get_forced_tokens(self, input_ids: torch.LongTensor, rows: Optional[List[int]]=None) -> List[Optional[int]]:
+        """
+        Returns for each row the token that the grammar forces after its input ids, i.e., the only token in the accept mask, or None if the mask accepts more than one token. The forced tokens are only useful if all the rows have one, so the rows after the first row without a forced token are not parsed and get None.
+
+        Args:
+            input_ids (torch.LongTensor): The input ids of the rows.
+            rows (List[int], optional): The rows of the batch of the input ids if only some rows are checked. Defaults to None, i.e., all the rows.
+        """
+        if rows is None:
+            rows = list(range(input_ids.size(0)))
+        partial_codes = self._get_partial_codes(input_ids, rows)
+        self.parser_pool.share(partial_codes, rows)
 
-        # Check if the remainder is a valid prefix for the last terminal
-        out = self.dfa_mask_store.is_valid_prefix(r)
-        return out
-    
+        forced_tokens: List[Optional[int]] = [None] * len(rows)
+        for i, (idx, partial_code) in enumerate(zip(rows, partial_codes)):
+            try:
+                r = self.parser_pool.get_acceptable_next_terminals(idx, partial_code)
+            except Exception as e:
+                self.logger.log(f"Exception while parsing:\n {e}")
+                break
+
+            self.update_valid_state(input_ids[i:i+1], idx, r)
+            forced_tokens[i] = self.dfa_mask_store.get_forced_token(r, prev_dfa_states=self.remainder_dfa_states[idx])
+            if forced_tokens[i] is None:
+                break
+        return forced_tokens
+
+    def prepare_masks(self, input_ids: torch.LongTensor, rows: Optional[List[int]]=None, stop_event: Optional[threading.Event]=None):
+        """
+        Computes the accept masks of the rows for their input ids ahead of time, e.g., on a worker thread while the model computes the scores of the next token. __call__ uses the prepared mask of a row if it is called with the same partial code, and computes the mask otherwise.
+
+        Only the rows whose sampled token is not valid use their masks, but these rows are not known before the scores are computed. The rows that were masked in the last step are prepared first since their next token is more likely to be invalid again.
+
+        The decoder is not thread-safe, so no other method should be called until this returns. The stop_event is checked before parsing a row and again before computing its mask, so setting it waits for at most one parse or one mask. The rows whose masks are not computed, including the row that is parsed when the stop_event is set, are not prepared and __call__ computes their masks when they are needed.
+
+        Args:
+            input_ids (torch.LongTensor): The input ids of the rows.
+            rows (List[int], optional): The rows of the batch of the input ids if only some rows are prepared. Defaults to None, i.e., all the rows.
+            stop_event (threading.Event, optional): Set when the masks are needed. Defaults to None.
+        """
+        self._prepared_masks = {}
+        if rows is None:
+            rows = list(range(input_ids.size(0)))
+        partial_codes = self._get_partial_codes(input_ids, rows)
+        self.parser_pool.share(partial_codes, rows)
+
+        last_masked_rows = set(self._last_masked_rows)
+        order = sorted(range(len(rows)), key=lambda i: rows[i] not in last_masked_rows)
+        for i in order:
+            idx, partial_code = rows[i], partial_codes[i]
+            if stop_event is not None and stop_event.is_set():
+                break
+            try:
+                r = self.parser_pool.get_acceptable_next_terminals(idx, partial_code)
+            except Exception as e:
+                self.logger.log(f"Exception while parsing:\n {e}")
+                continue
+            if stop_event is not None and stop_event.is_set():
+                break
+
+            self.update_valid_state(input_ids[i:i+1], idx, r)
+            accept_mask = self.dfa_mask_store.get_accept_mask(r, logger=self.logger, prev_dfa_states=self.remainder_dfa_states[idx])
+            self._prepared_masks[idx] = (partial_code, r, accept_mask)
+            self.num_prepared_masks += 1
 
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, rows: Optional[List[int]]=None) -> torch.FloatTensor:    
+        """
+        Masks the scores of the tokens that are not syntactically valid after the input ids of each row.
+
+        Args:
+            input_ids (torch.LongTensor): The input ids of the rows.
+            scores (torch.FloatTensor): The scores of the next token of the rows.
+            rows (List[int], optional): The rows of the batch of the input ids if only some rows are masked e.g., the rows whose sampled token is not valid. Defaults to None, i.e., all the rows.
+        """
         time1 = time.time() 
+        if rows is None:
+            rows = list(range(input_ids.size(0)))
+        self._last_masked_rows = rows
         # start_from is used for choosing where the parsing should start
-        partial_codes = self._get_partial_codes(input_ids)
+        partial_codes = self._get_partial_codes(input_ids, rows)
+        self.parser_pool.share(partial_codes, rows)
 
-        for idx, partial_code in enumerate(partial_codes):
+        # The masks of all the rows are applied to the scores at once
+        batch_mask = self._get_mask_buffer(scores.size(0), scores.size(1))
+        vocab_len = min(len(self.dfa_mask_store._vocab), scores.size(1))
+        masked_rows = torch.zeros(scores.size(0), dtype=torch.bool)
+        results = [None for _ in partial_codes]
+
+        for i, (idx, partial_code) in enumerate(zip(rows, partial_codes)):
             time2 = time.time()
 
-            ## Parsing
-            try: # returns the accept sequences that are currently accepted.
-                r = self.inc_parsers[idx].get_acceptable_next_terminals(partial_code)
-            except Exception as e:
-                if self.dev_mode == True:
-                    raise e
-                self.logger.log(f"Exception while parsing:\n {e}")
-                # print(f"Exception while parsing! Fix this!\n {e}")
-                continue  # Skip altering the scores for this batch
+            prepared = self._prepared_masks.pop(idx, None)
+            if prepared is not None and prepared[0] == partial_code:
+                # The mask was computed ahead of time by prepare_masks()
+                self.num_prepared_mask_hits += 1
+                _, r, accept_mask = prepared
+            else:
+                self.num_prepared_mask_misses += 1
 
-            self.logger.log_time(f"Time taken for compilation: {time.time() - time2:.3f}s")
-            self.update_valid_state(input_ids, idx, r)
-        
-            accept_mask = self.dfa_mask_store.get_accept_mask(r, logger=self.logger)
+                ## Parsing
+                try: # returns the accept sequences that are currently accepted.
+                    r = self.parser_pool.get_acceptable_next_terminals(idx, partial_code)
+                except Exception as e:
+                    if self.dev_mode == True:
+                        raise e
+                    self.logger.log(f"Exception while parsing:\n {e}")
+                    # print(f"Exception while parsing! Fix this!\n {e}")
+                    continue  # Skip altering the scores for this batch
 
-            if self.debug:
-                self._log_current_status(partial_code, r)
-            greedy_token = self.tokenizer.decode(scores[idx].argmax(dim=-1)) # For debugging, do not move this line
-
-            if torch.sum(accept_mask) != 0: # If there are acceptable tokens for the current partial code 
-                if len(scores[idx]) != len(accept_mask):
-                    # Pad accept_mask with 0 values. Since scores[i] may be longer than tokenizer vocab size, we need to pad accept_mask with 0 values
-                    accept_mask = torch.cat((accept_mask, torch.zeros(len(scores[idx]) - len(accept_mask), dtype=torch.bool)))
-                    
-                scores[idx] = scores[idx].masked_fill(~accept_mask.to(scores.device), -float("inf"))
-            else: # Otherwise, report the error and mask no tokens
-                self.logger.log('No acceptable tokens for the current partial code!')
-                self._log_current_status(partial_code, r)
+                self.logger.log_time(f"Time taken for compilation: {time.time() - time2:.3f}s")
+                self.update_valid_state(input_ids[i:i+1], idx, r)
+            
+                accept_mask = self.dfa_mask_store.get_accept_mask(r, logger=self.logger, prev_dfa_states=self.remainder_dfa_states[idx])
+            # The columns of the scores after the tokenizer vocab stay 0 in the buffer
+            batch_mask[i, :vocab_len] = accept_mask[:vocab_len]
+            masked_rows[i] = True
+            results[i] = r
 
+            if self.dev_mode:
+                # repr(r) builds the accept sequences from the terminal bitsets, so the status is only logged in the dev mode
+                self._log_current_status(partial_code, r)
             self.logger.log_time(f"Time taken for masking: {time.time() - time2:.3f}s")
-            
-            # For debugging - remove later
-            greedy_grammar_token = self.tokenizer.decode(scores[idx].argmax(dim=-1))
-            if greedy_token != greedy_grammar_token:
-                self._log_greedy_difference(greedy_grammar_token, partial_code, r, greedy_token)
+
+        # If there are no acceptable tokens for the partial code of a row, report the error and mask no tokens
+        for i in torch.nonzero(masked_rows & ~batch_mask.any(dim=1)).flatten().tolist():
+            self.logger.log('No acceptable tokens for the current partial code!')
+            self._log_current_status(partial_codes[i], results[i])
+            masked_rows[i] = False
+
+        if masked_rows.any():
+            # For debugging, the greedy tokens are compared only in the dev mode since decoding them for every row is expensive
+            greedy_tokens = scores.argmax(dim=-1).tolist() if self.dev_mode else None
+
+            reject_mask = ~batch_mask
+            reject_mask[~masked_rows] = False
+            scores = scores.masked_fill(reject_mask.to(scores.device, non_blocking=True), -float("inf"))
+
+            if greedy_tokens is not None:
+                greedy_grammar_tokens = scores.argmax(dim=-1).tolist()
+                for i in torch.nonzero(masked_rows).flatten().tolist():
+                    if greedy_tokens[i] != greedy_grammar_tokens[i]:
+                        self._log_greedy_difference(self.tokenizer.decode(greedy_grammar_tokens[i]), partial_codes[i], results[i], self.tokenizer.decode(greedy_tokens[i]))
 
         self.logger.log_time(f"Time taken for decoding: {time.time() - time1:.3f}s")
         return scores
 
-    def _get_partial_codes(self, input_ids: torch.LongTensor):   
+    def _get_mask_buffer(self, batch_size: int, num_scores: int) -> torch.Tensor:
+        """
+        Returns the buffer for the accept masks of a batch with num_scores scores per row. The scores may be longer than the tokenizer vocab, and the padding columns of the buffer are 0 since only the vocab columns are written, so the buffer is allocated once per batch size and model.
+        """
+        if self._mask_buffer is None or self._mask_buffer.size(0) < batch_size or self._mask_buffer.size(1) != num_scores:
+            self._mask_buffer = torch.zeros((max(batch_size, self.batch_size), num_scores), dtype=torch.bool)
+        return self._mask_buffer[:batch_size]
+
+    def _get_partial_codes(self, input_ids: torch.LongTensor, rows: Optional[List[int]]=None):   
         assert self.start_from <= input_ids.size(1), "Make sure that the decoder is reset for new prompt."            
-        partial_codes = self.tokenizer.batch_decode(input_ids[:, self.start_from:], skip_special_tokens=True)
+        if rows is None:
+            rows = list(range(input_ids.size(0)))
+        partial_codes = [self.detokenizers[idx].decode(input_ids[i, self.start_from:]) for i, idx in enumerate(rows)]
         return partial_codes
 
     def update_valid_state(self, input_ids, idx: int, r: ParseResult):
         """
         This a simple heuristic to cut off the generated output at the end of the function. 
         TODO: Put this under a flag to enable/disable this heuristic.
+
+        input_ids holds the input ids of the row idx of the batch.
         """
         if idx < len(self.function_end):
             if r.function_end and self.function_end[idx] == None: # If the function end is not None, then the last valid state is the function end
-                self.function_end[idx] = len(input_ids[idx])-1
+                self.function_end[idx] = input_ids.size(-1)-1
 
         if idx < len(self.last_valid_state):
-            for accept_seq in r.accept_sequences:
-                # 'EOF' is special terminal since $END does not work with python
-                if accept_seq[0] == '$END' or accept_seq[0] == 'EOF':
-                    self.last_valid_state[idx] = len(input_ids[idx])-1
+            # 'EOF' is special terminal since $END does not work with python
+            if r.first_bits & self._end_terminal_bits:
+                self.last_valid_state[idx] = input_ids.size(-1)-1
 
     def _log_greedy_difference(self, greedy_grammar_token, partial_code, r, greedy_token):
         self.logger.log_check(f"Greedy token and greedy grammar-based token do not match!")
@@ -0,0 +1,115 @@
+import re
+import torch
+from typing import Dict, List, Optional, Sequence, Union
+
+
+_BYTE_TOKEN = re.compile(r'<0x[0-9A-Fa-f]{2}>')
+
+class IncrementalDetokenizer:
+    """
+    Decodes a growing sequence of token ids to text by decoding only the new tokens in every step.
+
+    Decoding the new tokens on their own does not always give the text that they add to the whole sequence, e.g., sentencepiece tokenizers drop the prefix space of the first decoded token and byte-level tokenizers may split a multi-byte character over several tokens. Hence, the new tokens are decoded together with a window of the previous `lookback` tokens and the text of the window is removed from the result. If the decoded window is not a prefix of the result or the sequence is not an extension of the decoded sequence, the whole sequence is decoded.
+
+    Args:
+        tokenizer (PreTrainedTokenizer): The tokenizer to use for decoding.
+        skip_special_tokens (bool, optional): Whether to remove special tokens in the decoding. Defaults to True.
+        lookback (int, optional): Number of previous tokens decoded with the new tokens. Defaults to 4.
+    """
+    def __init__(self, tokenizer, skip_special_tokens=True, lookback=4):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.lookback = lookback
+        self._ends_text_cache: Dict[int, bool] = {} # Whether the text of a sequence is final after the token id, see _ends_text
+        self.reset()
+
+    def reset(self):
+        self.token_ids: List[int] = [] # Token ids of the last decoded sequence
+        self.read_offset = 0 # Number of token ids whose text is in self.text
+        self.text = '' # Text of token_ids[:read_offset]
+
+        # read_offset and text before the last step, for going back by one step e.g., when the next token is rejected
+        self._prev_state: Optional[tuple] = None
+
+        # Statistics
+        self.num_incremental_decodes = 0
+        self.num_full_decodes = 0
+
+    def decode(self, token_ids: Union[torch.Tensor, Sequence[int]]) -> str:
+        """
+        Returns the text of the token ids, i.e., tokenizer.decode(token_ids).
+        """
+        token_ids = token_ids.tolist() if isinstance(token_ids, torch.Tensor) else list(token_ids)
+
+        if not self._extends(token_ids, self.read_offset):
+            if self._prev_state is not None and self._extends(token_ids, self._prev_state[0]):
+                self.read_offset, self.text = self._prev_state
+                self._prev_state = None
+            else:
+                return self._decode_full(token_ids)
+
+        prefix_offset = max(0, self.read_offset - self.lookback)
+        prefix_text = self._decode(token_ids[prefix_offset:self.read_offset])
+        while prefix_text == '' and prefix_offset > 0:
+            # The window has no text e.g., only skipped special tokens. Without text before them, the new tokens would be decoded as the start of the sequence and sentencepiece would drop their prefix space
+            prefix_offset = max(0, prefix_offset - self.lookback)
+            prefix_text = self._decode(token_ids[prefix_offset:self.read_offset])
+        new_text = self._decode(token_ids[prefix_offset:])
+        if not new_text.startswith(prefix_text):
+            return self._decode_full(token_ids)
+
+        self.num_incremental_decodes += 1
+        text = self.text + new_text[len(prefix_text):]
+        if len(token_ids) > self.read_offset and self._ends_text(token_ids):
+            self._prev_state = (self.read_offset, self.text)
+            self._set_state(token_ids, text)
+        return text
+
+    def _decode_full(self, token_ids: List[int]) -> str:
+        self.num_full_decodes += 1
+        text = self._decode(token_ids)
+        self._prev_state = None
+        if self._ends_text(token_ids):
+            self._set_state(token_ids, text)
+        else:
+            self._set_state([], '')
+        return text
+
+    def _ends_text(self, token_ids: List[int]) -> bool:
+        """
+        Checks if the text of the token ids cannot change with the next tokens, so that the decoding can continue from the end of the token ids.
+
+        It is not the case if the last token is a part of a multi-byte character. Sentencepiece byte fallback decodes consecutive byte tokens together and replaces all of them if they are not valid UTF-8, so the text is also not final after a byte token or a skipped special token that may be between byte tokens.
+        """
+        if not token_ids:
+            return True
+        # The check only depends on the last token id
+        ends_text = self._ends_text_cache.get(token_ids[-1])
+        if ends_text is None:
+            ends_text = self._ends_text_cache[token_ids[-1]] = self._token_ends_text(token_ids[-1])
+        return ends_text
+
+    def _token_ends_text(self, token_id: int) -> bool:
+        if hasattr(self.tokenizer, 'convert_ids_to_tokens'):
+            last_token = self.tokenizer.convert_ids_to_tokens(token_id)
+            if isinstance(last_token, str) and _BYTE_TOKEN.fullmatch(last_token):
+                return False
+        last_text = self._decode([token_id])
+        if getattr(self.tokenizer, 'clean_up_tokenization_spaces', False) and last_text.endswith(' '):
+            # The clean up removes the space before punctuation, e.g., in ' .' and " 's"
+            return False
+        return last_text != '' and '�' not in last_text
+
+    def _set_state(self, token_ids: List[int], text: str):
+        self.token_ids = token_ids
+        self.read_offset = len(token_ids)
+        self.text = text
+
+    def _extends(self, token_ids: List[int], read_offset: int) -> bool:
+        """
+        Checks if the first read_offset token ids are the same as in the decoded sequence.
+        """
+        return len(token_ids) >= read_offset and token_ids[:read_offset] == self.token_ids[:read_offset]
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
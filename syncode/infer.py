@@ -14,8 +14,8 @@ from syncode.evaluation.json_eval import JSONEval
 from syncode.evaluation.fol_eval import FOLEval
 
 
-def compile_and_run(model, mode="grammar_mask", quantize=True, device="cuda", num_samples=1, grammar=None, dataset="input", num_few_shot=0, chat_mode=False, dev_mode=False, log_level=1, new_mask_store=False, parser="lalr", task_id=None, json_eval_type='schema', **kwargs):
-    sc = Syncode(model, mode=mode, quantize=quantize, device=device, num_samples=num_samples, grammar=grammar, dataset=dataset, num_few_shot=num_few_shot, chat_mode=chat_mode, dev_mode=dev_mode, log_level=log_level, new_mask_store=new_mask_store, parser=parser, task_id=task_id, json_eval_type= json_eval_type, **kwargs)
+def compile_and_run(model, mode="grammar_mask", quantize=True, device="cuda", num_samples=1, grammar=None, dataset="input", num_few_shot=0, chat_mode=False, dev_mode=False, log_level=1, new_mask_store=False, lazy_mask_store=False, parser="lalr", task_id=None, json_eval_type='schema', **kwargs):
+    sc = Syncode(model, mode=mode, quantize=quantize, device=device, num_samples=num_samples, grammar=grammar, dataset=dataset, num_few_shot=num_few_shot, chat_mode=chat_mode, dev_mode=dev_mode, log_level=log_level, new_mask_store=new_mask_store, lazy_mask_store=lazy_mask_store, parser=parser, task_id=task_id, json_eval_type= json_eval_type, **kwargs)
     sc.infer(task_id=task_id)
 
 class Syncode:
@@ -31,12 +31,16 @@ class Syncode:
             other options currently supported are "python", "go", "calc"
         dataset (str, optional): Dataset. Defaults to "humaneval".
         new_mask_store (bool, optional): Use new DFA mask store. Defaults to False.
+        lazy_mask_store (bool, optional): Compute the DFA mask store lazily during generation if it is not cached. Defaults to False.
+        mask_store_workers (int, optional): Number of worker processes used for creating the DFA mask store if it is not cached. Defaults to 1.
         num_few_shot (int, optional): Number of examples for few shot prompting. Defaults to 0.
         chat_mode (bool, optional): Parse only the (output) and not (prompt+output) in chat mode. Defaults to False.
         dev_mode (bool, optional): Development mode. Defaults to False.
         log_level (int, optional): Log level. Defaults to 2. 0 for no logs, 1 for minimal logs, 2 for all logs including time.
         parser (str, optional): Parser to use. Defaults to "lalr".
         task_id (int, optional): For debugging a specific task. Defaults to None.
+        jump_forward (bool, optional): Append the tokens forced by the grammar without running the model. Defaults to False.
+        overlap_masking (bool, optional): Compute the grammar masks on a worker thread while the model runs. Defaults to False.
 
         List of currently tested models:
         Llama models: "Llama-7b", "CodeLlama-7b", "CodeLlama-7b-Python", "Llama-13b"
@@ -59,9 +63,13 @@ class Syncode:
         dev_mode: bool = False,
         log_level: int = 1,
         new_mask_store: bool = False,
+        lazy_mask_store: bool = False,
+        mask_store_workers: int = 1,
         parser: Literal["lr", "lalr"] = "lalr",
         task_id: Optional[int] = None,
         json_eval_type: Literal["schema", "exact_match"] = "schema",
+        jump_forward: bool = False,
+        overlap_masking: bool = False,
         **kwargs
     ):  
         # Check inputs
@@ -77,6 +85,7 @@ class Syncode:
         self.device = device
         self.num_samples = num_samples
         self.new_mask_store = new_mask_store
+        self.lazy_mask_store = lazy_mask_store
         self.num_few_shot = num_few_shot
         self.parser = parser
         self.chat_mode = chat_mode
@@ -110,6 +119,8 @@ class Syncode:
                 tokenizer=tokenizer, 
                 logger=self.logger, 
                 use_cache=(not self.new_mask_store), 
+                lazy_mask_store=self.lazy_mask_store,
+                mask_store_workers=mask_store_workers,
                 parse_output_only=self.parse_output_only,
                 num_samples=self.num_samples, 
                 dev_mode=dev_mode,
@@ -128,6 +139,8 @@ class Syncode:
             device=device, 
             grammar_decoder=self.grammar_decoder, 
             mode=self.mode, 
+            jump_forward=jump_forward,
+            overlap_masking=overlap_masking,
             **kwargs
             )
 
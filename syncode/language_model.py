@@ -1,5 +1,6 @@
-import time
+import contextlib, threading, time
 import torch
+from concurrent.futures import ThreadPoolExecutor
 import syncode.common as common
 from syncode.grammar_decoder import GrammarDecoder
 from transformers import LogitsProcessorList, StoppingCriteriaList, StoppingCriteria
@@ -12,22 +13,31 @@ from transformers.generation.configuration_utils import GenerationConfig
 
 class KeywordsStoppingCriteria(StoppingCriteria):
     '''
-    Assume batch_size = 1
-
-    We can use this class to check if the stop word is present in the completion. This is more expensive since we need to decode the completion to check if the stop word is present.
+    We can use this class to check if the stop word is present at the end of the completion of each row of the batch. Only the last tokens of the rows are decoded, which are enough for the longest stop word since every token except the special tokens decodes to at least one byte, e.g., the byte fallback tokens of sentencepiece.
     '''
+    # A tail that starts within a multi-byte character is moved by up to this many tokens to the next character
+    MAX_CONTINUATION_BYTES = 3
+
     def __init__(self, tokenizer, stop_words = []):
         super().__init__()
         self.tokenizer = tokenizer
         self.stop_words = stop_words
         self.stop_words_ids = []
+        # One more token since some tokenizers drop the leading space of the first decoded token
+        self.num_tail_tokens = max([len(stop_word.encode('utf-8')) for stop_word in stop_words], default=0) + 1 + self.MAX_CONTINUATION_BYTES
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        tail_ids = input_ids[:, -self.num_tail_tokens:]
+        partial_outputs = self.tokenizer.batch_decode(tail_ids, skip_special_tokens=True)
+        is_done = [self._ends_with_stop_word(partial_output) for partial_output in partial_outputs]
+        for row, partial_output in enumerate(partial_outputs):
+            if not is_done[row] and '\ufffd' in partial_output:
+                # The tail may start within a multi-byte character. Sentencepiece byte fallback then replaces all the consecutive byte tokens, including the ones of the stop word
+                is_done[row] = any(self._ends_with_stop_word(self.tokenizer.decode(tail_ids[row, start:], skip_special_tokens=True)) for start in range(1, self.MAX_CONTINUATION_BYTES+1))
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
 
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> bool:
-        partial_output = self.tokenizer.batch_decode(input_ids, skip_special_tokens=True)[0]
-        for stop_word in self.stop_words:
-            if partial_output.endswith(stop_word):
-                return True
-        return False    
+    def _ends_with_stop_word(self, text: str) -> bool:
+        return any(text.endswith(stop_word) for stop_word in self.stop_words)
 
 
 class HuggingFaceModel:
@@ -44,6 +54,8 @@ class HuggingFaceModel:
             device='cuda', 
             grammar_decoder=None, 
             mode: str ='original', 
+            jump_forward: bool = False,
+            overlap_masking: bool = False,
             **kwargs) -> None:
         super().__init__()
 
@@ -59,6 +71,9 @@ class HuggingFaceModel:
         self.mode = mode
         self.grammar = grammar
         self.vocab = common.get_vocab_from_tokenizer(self.tokenizer)
+        self.jump_forward = jump_forward
+        self.num_saved_forward_passes = 0 # In the last generation with jump forward
+        self.overlap_masking = overlap_masking
         self.gen_args = kwargs
 
     def get_grammar_decoder(self):
@@ -93,7 +108,7 @@ class HuggingFaceModel:
             stop_criteria = []
 
         # Generate completions
-        if (gen_mode == GenerationMode.SAMPLE or gen_mode == GenerationMode.GREEDY_SEARCH) and batch_size == 1: # Use our own implementation for greedy search and sampling
+        if gen_mode == GenerationMode.SAMPLE or gen_mode == GenerationMode.GREEDY_SEARCH: # Use our own implementation for greedy search and sampling
             generated_ids = self._generate(
                 inputs, 
                 gen_config, 
@@ -103,8 +118,8 @@ class HuggingFaceModel:
                 )
         else:
             # Use generate from transformers library for other modes
-            if stop_criteria is not None:
-                print('Warning: Stopping criteria is not supported for batch generation')
+            if len(stop_criteria) > 0:
+                print('Warning: Stopping criteria is not supported for this generation mode')
 
             generated_ids = self.model.generate(
                 **inputs, 
@@ -148,56 +163,131 @@ class HuggingFaceModel:
         stop_criteria:StoppingCriteria=[]
         ):
         """
-        We support greedy search and sampling for batch size 1 otherwise we use the generate function from transformers library.
-        """
-        token_ids, attention_mask, past_key_values = inputs['input_ids'], inputs['attention_mask'], None
-        logit_warper = self.model._get_logits_warper(gen_config)
-        max_tokens = self.gen_args['max_new_tokens']+token_ids.size(1)
+        We support greedy search and sampling, otherwise we use the generate function from transformers library.
 
-        while True:
-            try:
-                if past_key_values: # Get the last token if kv is cached for all previous tokens
-                    input_ids = token_ids[..., -1].unsqueeze(-1) 
-                else:
-                    input_ids = token_ids
+        All the rows of the batch are sampled first and the grammar decoder checks the sampled token of each row. The grammar mask is computed and the token is sampled again only for the rows whose token is not syntactically valid. A row is finished when it generates the eos token or meets a stopping criterion. The finished rows are no longer checked or masked and they are padded with the eos token until all the rows are finished.
 
-                outputs = self.model(
-                    input_ids, 
-                    attention_mask=attention_mask, 
-                    past_key_values=past_key_values
-                    )                
-            except IndexError as e:  
-                raise ValueError(f"The input length exceeds the context length of the model. {e}")
+        With overlap_masking, the grammar masks of the unfinished rows are computed on a worker thread while the model computes the scores, so a row whose sampled token is not valid is masked without waiting for the parser. The worker is created for each generation. It stops when the scores are ready, after the parse or the mask that it is computing, and the rows that it has not prepared are masked when they are needed. The masks of all the unfinished rows are prepared although only the rows with an invalid sampled token use them, since these rows are only known after the forward pass.
 
-            next_token_scores, past_key_values = outputs.logits[:, -1, :], outputs.past_key_values
-            
-            if grammar_decoder is not None:
-                next_token = self._get_next_token(gen_mode, token_ids, logit_warper, next_token_scores)
-                is_valid = grammar_decoder.is_valid(token_ids, next_token)
-
-                if not is_valid:
-                    # calling grammar decoder is expensive. Hence, in the opportunist mode, we call it only when the standard generation is syntactically incorrect
-                    next_token_scores = grammar_decoder(token_ids, next_token_scores)
-                    next_token = self._get_next_token(gen_mode, token_ids, logit_warper, next_token_scores)
-            else:
+        With jump_forward, the tokens that the grammar forces in all the unfinished rows, i.e., the only token in their accept masks, are appended without running the model and the next forward pass processes them together with the last sampled token.
+        """
+        input_ids, past_key_values = inputs['input_ids'], None
+        logit_warper = self.model._get_logits_warper(gen_config)
+        batch_size, cur_len = input_ids.size()
+        max_tokens = self.gen_args['max_new_tokens']+cur_len
+        unfinished = torch.ones(batch_size, dtype=torch.bool, device=input_ids.device)
+        num_checked_tokens, num_masked_tokens = 0, 0
+        num_cached_tokens = 0 # Number of tokens whose keys and values are in past_key_values
+        self.num_saved_forward_passes = 0
+
+        # The generated tokens and the attention mask are written in place instead of concatenating a column in every step
+        token_buffer = torch.zeros((batch_size, max_tokens), dtype=input_ids.dtype, device=input_ids.device)
+        token_buffer[:, :cur_len] = input_ids
+        attention_buffer = torch.ones((batch_size, max_tokens), dtype=inputs['attention_mask'].dtype, device=inputs['attention_mask'].device)
+        attention_buffer[:, :cur_len] = inputs['attention_mask']
+
+        # The worker thread is shut down with the generation, so no thread is left behind by the model
+        with ThreadPoolExecutor(max_workers=1) if self.overlap_masking and grammar_decoder is not None else contextlib.nullcontext() as mask_executor:
+            while True:
+                token_ids, attention_mask = token_buffer[:, :cur_len], attention_buffer[:, :cur_len]
+                mask_future = None
+                if mask_executor is not None:
+                    stop_event = threading.Event()
+                    rows = torch.nonzero(unfinished).flatten().tolist()
+                    mask_future = mask_executor.submit(grammar_decoder.prepare_masks, token_buffer[rows, :cur_len], rows, stop_event)
+
+                try:
+                    if past_key_values: # Get the tokens after the ones whose kv is cached, i.e., the last token and the forced tokens
+                        input_ids = token_ids[:, num_cached_tokens:]
+                    else:
+                        input_ids = token_ids
+
+                    outputs = self.model(
+                        input_ids, 
+                        attention_mask=attention_mask, 
+                        past_key_values=past_key_values
+                        )                
+                except IndexError as e:  
+                    raise ValueError(f"The input length exceeds the context length of the model. {e}")
+                finally:
+                    if mask_future is not None:
+                        self._join_mask_worker(mask_future, stop_event)
+
+                next_token_scores, past_key_values = outputs.logits[:, -1, :], outputs.past_key_values
+                num_cached_tokens = cur_len
                 next_token = self._get_next_token(gen_mode, token_ids, logit_warper, next_token_scores)
             
-            token_ids = torch.cat([token_ids, next_token[:, None]], dim=-1)
-
-            # Check stopping criteria
-            finish_generation = False
-            for stop_criterion in stop_criteria:
-                if stop_criterion(token_ids, next_token_scores):
-                    finish_generation = True
+                if grammar_decoder is not None:
+                    rows = torch.nonzero(unfinished).flatten().tolist()
+                    is_valid = grammar_decoder.get_valid_rows(token_ids[rows], next_token[rows], rows=rows)
+                    invalid_rows = [idx for idx, valid in zip(rows, is_valid.tolist()) if not valid]
+                    num_checked_tokens += len(rows)
+                    num_masked_tokens += len(invalid_rows)
+
+                    if invalid_rows:
+                        # calling grammar decoder is expensive. Hence, in the opportunist mode, we call it only for the rows whose standard generation is syntactically incorrect
+                        masked_scores = grammar_decoder(token_ids[invalid_rows], next_token_scores[invalid_rows], rows=invalid_rows)
+                        next_token[invalid_rows] = self._get_next_token(gen_mode, token_ids[invalid_rows], logit_warper, masked_scores)
+                        next_token_scores[invalid_rows] = masked_scores
+
+                cur_len = self._append_next_token(token_buffer, attention_buffer, cur_len, next_token, unfinished, stop_criteria, next_token_scores)
+
+                if self.jump_forward and grammar_decoder is not None:
+                    while unfinished.any() and cur_len < max_tokens:
+                        rows = torch.nonzero(unfinished).flatten().tolist()
+                        forced_tokens = grammar_decoder.get_forced_tokens(token_buffer[rows, :cur_len], rows=rows)
+                        if None in forced_tokens:
+                            break
+                        next_token = torch.zeros(batch_size, dtype=token_buffer.dtype, device=token_buffer.device)
+                        next_token[rows] = torch.tensor(forced_tokens, dtype=token_buffer.dtype, device=token_buffer.device)
+                        # The scores of the masked distribution, where the forced token has all the probability
+                        next_token_scores = torch.full_like(next_token_scores, -float('inf'))
+                        next_token_scores[rows, next_token[rows]] = 0
+                        cur_len = self._append_next_token(token_buffer, attention_buffer, cur_len, next_token, unfinished, stop_criteria, next_token_scores)
+                        self.num_saved_forward_passes += 1
                     
-             # Check if the next token is the end of the sequence or the max tokens is reached
-            if finish_generation or next_token == self.tokenizer.eos_token_id or token_ids.size(1) >= max_tokens:
-                break
+                # Check if all the rows are finished or the max tokens is reached
+                if not unfinished.any() or cur_len >= max_tokens:
+                    break
+
+        if grammar_decoder is not None:
+            self.logger.log(f"Grammar masks computed for {num_masked_tokens} of {num_checked_tokens} sampled tokens")
+        if self.jump_forward:
+            self.logger.log(f"Forward passes saved by jump forward: {self.num_saved_forward_passes}")
+        if self.overlap_masking and grammar_decoder is not None:
+            self.logger.log(f"Grammar masks computed during the forward pass: {grammar_decoder.num_prepared_mask_hits} of {grammar_decoder.num_prepared_mask_hits + grammar_decoder.num_prepared_mask_misses} used, {grammar_decoder.num_prepared_masks} computed")
+        return token_buffer[:, :cur_len]
+
+    def _join_mask_worker(self, mask_future, stop_event: threading.Event):
+        """
+        Waits for the worker that computes the grammar masks to finish the current parse or mask. If the worker fails, the masks are computed when they are needed.
+        """
+        stop_event.set()
+        try:
+            mask_future.result()
+        except Exception as e:
+            self.logger.log(f"Exception while computing the grammar masks during the forward pass:\n {e}")
 
-            # Update attention mask
-            attention_mask = torch.cat([attention_mask, torch.ones((attention_mask.size(0), 1), dtype=attention_mask.dtype).to(self.device)], dim=-1)
-            
-        return token_ids
+    def _append_next_token(self, token_buffer, attention_buffer, cur_len, next_token, unfinished, stop_criteria, next_token_scores) -> int:
+        """
+        Writes the next token of the unfinished rows and the eos token of the finished rows at cur_len and updates the unfinished rows. Returns the new length.
+
+        The padding eos tokens of the finished rows are not attended to.
+        """
+        if not unfinished.all():
+            next_token = next_token.masked_fill(~unfinished, self.tokenizer.eos_token_id)
+            attention_buffer[~unfinished, cur_len] = 0
+        token_buffer[:, cur_len] = next_token
+        cur_len += 1
+
+        # Check if the next token is the end of the sequence or a stopping criterion is met for each row
+        unfinished &= next_token != self.tokenizer.eos_token_id
+        if len(stop_criteria) > 0 and unfinished.any():
+            rows = torch.nonzero(unfinished).flatten()
+            scores = next_token_scores[rows]
+            for stop_criterion in stop_criteria:
+                unfinished[rows] &= ~stop_criterion(token_buffer[rows, :cur_len], scores).to(unfinished.device)
+        return cur_len
 
     def _get_next_token(self, gen_mode, token_ids, logit_warper, next_token_scores):
         if gen_mode == GenerationMode.GREEDY_SEARCH:
@@ -1,5 +1,49 @@
+import threading
 from enum import Enum
-from typing import Tuple, Optional
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional
+
+# Terminal names are interned to small integer ids shared by the parsers, ParseResult and the mask store, so that a set of terminals can be stored as an int bitset
+_terminal_ids: Dict[str, int] = {}
+_terminal_names: List[str] = []
+_terminal_ids_lock = threading.Lock()
+
+def terminal_id(terminal: str) -> int:
+    """
+    Returns the id of the terminal and assigns the next id to a new terminal.
+    """
+    tid = _terminal_ids.get(terminal)
+    if tid is None:
+        with _terminal_ids_lock:
+            tid = _terminal_ids.get(terminal)
+            if tid is None:
+                tid = len(_terminal_names)
+                _terminal_names.append(terminal)
+                _terminal_ids[terminal] = tid
+    return tid
+
+def terminal_name(tid: int) -> str:
+    return _terminal_names[tid]
+
+def terminals_to_bits(terminals: Iterable[str]) -> int:
+    """
+    Returns the bitset of the terminals, i.e., the bit terminal_id(t) is set for every terminal t.
+    """
+    bits = 0
+    for t in terminals:
+        bits |= 1 << terminal_id(t)
+    return bits
+
+def iter_bits(bits: int) -> Iterator[int]:
+    """
+    Iterates over the ids of the set bits from the lowest.
+    """
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+def bits_to_terminals(bits: int) -> List[str]:
+    return [_terminal_names[tid] for tid in iter_bits(bits)]
 
 class AcceptSequence(list):
     """
@@ -18,7 +62,7 @@ class AcceptSequence(list):
         return self.accept_terminals == other.accept_terminals
 
     def __hash__(self):
-        return hash(str(self.accept_terminals))
+        return hash(tuple(self.accept_terminals))
 
     def __len__(self):
         return len(self.accept_terminals)
@@ -37,46 +81,107 @@ class RemainderState(Enum):
 class ParseResult:
     """ 
     Stores the result of parsing. 
+
+    The accept sequences have length 1 or 2 and are stored as bitsets of terminal ids: first_bits has the first terminals of all sequences, single_bits the sequences of length 1 and pair_bits maps the id of the first terminal to the bitset of the second terminals of the sequences of length 2. accept_sequences is the same set of AcceptSequences and either of the representations is computed from the other on access.
     """
     def __init__(self, accept_sequences, remainder, remainder_state: RemainderState, next_ac_indents=None, function_end=False):
         self.remainder = remainder
         self.remainder_state = remainder_state
-        self.accept_sequences = accept_sequences
+        self._accept_sequences = accept_sequences
+        self._bits: Optional[Tuple[int, int, Dict[int, int]]] = None
         self.next_ac_indents: Optional[IndentationConstraint] = next_ac_indents
         self.function_end = function_end
+
+    @staticmethod
+    def from_bits(single_bits: int, pair_bits: Dict[int, int], remainder, remainder_state: RemainderState, next_ac_indents=None, function_end=False) -> 'ParseResult':
+        r = ParseResult(None, remainder, remainder_state, next_ac_indents, function_end=function_end)
+        first_bits = single_bits
+        for first in pair_bits:
+            first_bits |= 1 << first
+        r._bits = (first_bits, single_bits, pair_bits)
+        return r
+
+    @property
+    def accept_sequences(self) -> set:
+        if self._accept_sequences is None:
+            _, single_bits, pair_bits = self._bits
+            accept_sequences = {AcceptSequence([t]) for t in bits_to_terminals(single_bits)}
+            for first, second_bits in pair_bits.items():
+                t1 = terminal_name(first)
+                accept_sequences.update(AcceptSequence([t1, t2]) for t2 in bits_to_terminals(second_bits))
+            self._accept_sequences = accept_sequences
+        return self._accept_sequences
+
+    @accept_sequences.setter
+    def accept_sequences(self, accept_sequences):
+        self._accept_sequences = accept_sequences
+        self._bits = None
+
+    def _get_bits(self) -> Tuple[int, int, Dict[int, int]]:
+        if self._bits is None:
+            first_bits, single_bits, pair_bits = 0, 0, {}
+            for accept_sequence in self._accept_sequences:
+                first = terminal_id(accept_sequence[0])
+                first_bits |= 1 << first
+                if len(accept_sequence) == 1:
+                    single_bits |= 1 << first
+                elif len(accept_sequence) == 2:
+                    pair_bits[first] = pair_bits.get(first, 0) | (1 << terminal_id(accept_sequence[1]))
+                else:
+                    raise ValueError(f"Invalid accept sequence: {accept_sequence}")
+            self._bits = (first_bits, single_bits, pair_bits)
+        return self._bits
+
+    @property
+    def first_bits(self) -> int:
+        """
+        Bitset of the first terminals of the accept sequences.
+        """
+        return self._get_bits()[0]
+
+    @property
+    def single_bits(self) -> int:
+        """
+        Bitset of the terminals of the accept sequences of length 1.
+        """
+        return self._get_bits()[1]
+
+    @property
+    def pair_bits(self) -> Dict[int, int]:
+        """
+        Bitsets of the second terminals of the accept sequences of length 2 by the id of the first terminal.
+        """
+        return self._get_bits()[2]
         
     @staticmethod
     def from_accept_terminals(cur_accept_terminals, next_accept_terminals, remainder, remainder_state: RemainderState, next_ac_indents=None, final_terminal=None, ignore_terminals=None) -> 'ParseResult':
         """
         Create a ParseResult from current and next accept terminals.
         """
+        ignore_bits = terminals_to_bits(ignore_terminals) if ignore_terminals is not None else 0
+        pair_bits = {}
         if remainder_state == RemainderState.COMPLETE: 
-            accept_sequences = {AcceptSequence([t]) for t in next_accept_terminals}
+            single_bits = terminals_to_bits(next_accept_terminals)
         elif remainder_state == RemainderState.INCOMPLETE:
-            accept_sequences = {AcceptSequence([t]) for t in cur_accept_terminals}
+            single_bits = terminals_to_bits(cur_accept_terminals)
         else:
-            accept_sequences = set()
             assert final_terminal is not None
-            for t in cur_accept_terminals:
-                if t == final_terminal:
-                    for t2 in next_accept_terminals:
-                        accept_sequences.add(AcceptSequence([final_terminal, t2]))
-                    if ignore_terminals is not None:
-                        for t2 in ignore_terminals:
-                            accept_sequences.add(AcceptSequence([final_terminal, t2]))
-                else:
-                    accept_sequences.add(AcceptSequence([t]))
+            single_bits = terminals_to_bits(cur_accept_terminals)
+            final_bit = 1 << terminal_id(final_terminal)
+            if single_bits & final_bit:
+                single_bits ^= final_bit
+                second_bits = terminals_to_bits(next_accept_terminals) | ignore_bits
+                if second_bits:
+                    pair_bits[terminal_id(final_terminal)] = second_bits
         
-        if ignore_terminals is not None: # Does this cause imprecision?
-            # Add the sequences that only contain ignore_terminals    
-            accept_sequences = accept_sequences.union({AcceptSequence([t]) for t in ignore_terminals})
-
-        next_ac_indents: IndentationConstraint = next_ac_indents
+        # Does this cause imprecision?
+        # Add the sequences that only contain ignore_terminals    
+        single_bits |= ignore_bits
 
         if remainder_state == RemainderState.INCOMPLETE: # If the terminal is not complete, then next_accept_terminals should be None
             assert len(next_accept_terminals) == 0, f'remiander: {repr(remainder)}, next_accept_terminals: {next_accept_terminals}, cur_accept_terminals: {cur_accept_terminals}'
         function_end = True if '$END' in next_accept_terminals else False
-        return ParseResult(accept_sequences, remainder, remainder_state, next_ac_indents, function_end=function_end)
+        return ParseResult.from_bits(single_bits, pair_bits, remainder, remainder_state, next_ac_indents, function_end=function_end)
 
     def __repr__(self):
         return 'remainder : {}, remainder_state: {}, accept_sequences: {}, next_ac_indents: {}'.format(repr(self.remainder), self.remainder_state, self.accept_sequences, self.next_ac_indents)
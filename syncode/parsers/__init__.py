@@ -1,15 +1,19 @@
-import os
+import hashlib, os, pickle
 from syncode.parsers import incremental_parser
 from syncode.parsers.python_parser import PythonIncrementalParser, PythonIndenter
 from syncode.parsers.go_parser import GoIncrementalParser
+from syncode.parsers.dense_parse_table import DenseParseTable
+from syncode.larkm.parsers.lalr_analysis import IntParseTable
 import syncode.common as common
 from syncode.larkm.lark import Lark
 from syncode.parsers.grammars.grammar import Grammar
+from typing import Optional
 
 def create_parser(grammar: Grammar, parser='lalr', **kwargs) -> incremental_parser.IncrementalParser:   
         """ 
         Creates an incremental parser for the given grammar. The parser is cached for future use.
         parser (str, optional): The type of parser to use. Can be 'lalr' or 'lr'. Defaults to 'lalr'.        
+        recognizer (bool, optional): Whether the incremental parser only recognizes the code without building the parse tree. The base parser still builds the full tree in base_parser.parse(). Defaults to False.
         """
         indenter = None
         parser_cache_dir = common.SYNCODE_CACHE + 'parsers/'
@@ -20,6 +24,8 @@ def create_parser(grammar: Grammar, parser='lalr', **kwargs) -> incremental_pars
             indenter = PythonIndenter()
 
         base_parser = create_base_parser(grammar, parser, indenter, cache_filename)
+        if kwargs.get('recognizer') and 'dense_table' not in kwargs:
+            kwargs['dense_table'] = create_dense_parse_table(base_parser, cache_filename)
 
         if grammar.name == 'python':
             return PythonIncrementalParser(base_parser, indenter, **kwargs)
@@ -39,3 +45,35 @@ def create_base_parser(grammar, parser='lalr', indenter=None, cache_filename=Non
                     )
                 
     return base_parser
+
+def create_dense_parse_table(base_parser, cache_filename=None) -> Optional[DenseParseTable]:
+    """
+    Returns the integer parse table of the base parser, or None if the base parser has no IntParseTable (e.g., in debug mode).
+
+    The table is cached next to the cached base parser. The states are numbered when the base parser is created, thus the cached table is only used with the cached base parser that it was built from.
+    """
+    parse_table = base_parser.parse_interactive('').parser_state.parse_conf.parse_table
+    if not isinstance(parse_table, IntParseTable):
+        return None
+    if cache_filename is None or not os.path.exists(cache_filename):
+        return DenseParseTable(parse_table)
+
+    with open(cache_filename, 'rb') as f:
+        base_parser_hash = hashlib.sha256(f.read()).hexdigest()
+    dense_cache_filename = cache_filename.replace('_parser.pkl', '_dense_table.pkl')
+    if os.path.exists(dense_cache_filename):
+        try:
+            with open(dense_cache_filename, 'rb') as f:
+                data = pickle.load(f)
+            if data['base_parser_hash'] == base_parser_hash:
+                return DenseParseTable.deserialize(data)
+        except (OSError, pickle.UnpicklingError, EOFError): # If we cannot load the file, we will create the table from scratch
+            pass
+
+    dense_table = DenseParseTable(parse_table)
+    # Write to a temporary file first so that concurrent processes never read a partial file
+    tmp_filename = f'{dense_cache_filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'wb') as f:
+        pickle.dump({'base_parser_hash': base_parser_hash, **dense_table.serialize()}, f)
+    os.replace(tmp_filename, dense_cache_filename)
+    return dense_table
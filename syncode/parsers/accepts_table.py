@@ -0,0 +1,113 @@
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from syncode.larkm.parsers.lalr_analysis import ParseTableBase, Shift
+
+
+class AcceptsTable:
+    """
+    Computes the terminals accepted by an LALR parser without trial-feeding them.
+
+    InteractiveParser.accepts() copies the parser and feeds every terminal in the choices of the current state. In an LALR table a terminal with a shift action is always accepted, so these are precomputed for every state. A terminal with a reduce action may still be rejected after the reductions due to the merged lookaheads, so the reductions are simulated on the state stack. The result only depends on the states at the top of the stack that the reductions reach, so it is cached in a trie keyed on this suffix of the stack (top to bottom).
+
+    Args:
+        parse_table (ParseTableBase): The LALR parse table.
+        max_cache_size (int, optional): Maximum number of cached stack suffixes. The cache is cleared when it is full. Defaults to 100000.
+    """
+    def __init__(self, parse_table: ParseTableBase, max_cache_size: int=100000):
+        self.states = parse_table.states
+        self.end_states = frozenset(parse_table.end_states.values())
+        self.max_cache_size = max_cache_size
+
+        # Terminals with a shift action and (terminal, rule) pairs with a reduce action in each state
+        self.shift_terminals: Dict[Any, frozenset] = {}
+        self.reduce_actions: Dict[Any, List[Tuple[str, Any]]] = {}
+        for state, actions in self.states.items():
+            self.shift_terminals[state] = frozenset(t for t, (action, _) in actions.items() if t.isupper() and action is Shift)
+            self.reduce_actions[state] = [(t, arg) for t, (action, arg) in actions.items() if t.isupper() and action is not Shift]
+
+        self._cache: dict = {}
+        self.cache_size = 0
+
+        # Statistics
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def accepts(self, state_stack: Iterable) -> Set[str]:
+        """
+        Returns the set of terminals that the parser with the given state stack accepts. This is the same as InteractiveParser.accepts().
+        """
+        node = self._cache
+        for state in reversed(state_stack):
+            node = node.get(state)
+            if node is None:
+                break
+            if not isinstance(node, dict):
+                self.num_hits += 1
+                return set(node)
+
+        self.num_misses += 1
+        accepts, suffix = self._compute_accepts(state_stack)
+        self._add_to_cache(suffix, accepts)
+        return set(accepts)
+
+    def _compute_accepts(self, state_stack: Iterable) -> Tuple[frozenset, List[Any]]:
+        """
+        Returns the accepted terminals and the states at the top of the stack (top to bottom) that are read for computing them.
+        """
+        stack_iter = reversed(state_stack)
+        suffix: List[Any] = [] # States read from the stack so far, top to bottom
+
+        def get(depth: int):
+            while len(suffix) <= depth:
+                suffix.append(next(stack_iter))
+            return suffix[depth]
+
+        top = get(0)
+        accepts = set(self.shift_terminals[top])
+        for terminal, rule in self.reduce_actions[top]:
+            if self._accepts_after_reduce(terminal, rule, get):
+                accepts.add(terminal)
+        return frozenset(accepts), suffix
+
+    def _accepts_after_reduce(self, terminal: str, rule, get) -> bool:
+        """
+        Simulates the reductions of feeding the terminal, as in ParserState.feed_token(). The stack is the unread part of the real stack at the given depth with the states pushed by the reductions on top of it.
+        """
+        states = self.states
+        depth = 0
+        pushed: List[Any] = []
+        while True:
+            size = len(rule.expansion)
+            if size <= len(pushed):
+                del pushed[len(pushed)-size:]
+            else:
+                depth += size - len(pushed)
+                pushed = []
+
+            below = pushed[-1] if pushed else get(depth)
+            _, new_state = states[below][rule.origin.name]
+            pushed.append(new_state)
+
+            # InteractiveParser.feed_token() feeds '$END' with is_end=True, which stops at the end state
+            if terminal == '$END' and new_state in self.end_states:
+                return True
+
+            action = states[new_state].get(terminal)
+            if action is None:
+                return False
+            action, rule = action
+            if action is Shift:
+                return True
+
+    def _add_to_cache(self, suffix: List[Any], accepts: frozenset):
+        if self.cache_size >= self.max_cache_size:
+            self._cache = {}
+            self.cache_size = 0
+
+        node = self._cache
+        for state in suffix[:-1]:
+            child = node.get(state)
+            if not isinstance(child, dict):
+                child = node[state] = {}
+            node = child
+        node[suffix[-1]] = accepts
+        self.cache_size += 1
@@ -0,0 +1,143 @@
+from typing import Any, Dict, List
+from syncode.larkm.exceptions import UnexpectedToken
+from syncode.larkm.lexer import Token
+from syncode.larkm.parsers.lalr_analysis import IntParseTable, Shift
+from syncode.larkm.parsers.lalr_parser_state import ParserState
+from syncode.parsers.persistent_state import PersistentStack, RecognizerParserState
+
+
+class DenseParseTable:
+    """
+    Integer representation of an LALR or LR parse table for the parser driver. ParserState.feed_token() looks up the action in a dictionary per state keyed by the terminal name and the goto of every reduction in another one, this table replaces them with flat lists indexed by integer ids.
+
+    The parser states are the states of the IntParseTable (0..n-1), so a parser state stack can be used with both tables. The terminals and the nonterminals are numbered separately and the rules are numbered in the order in which they appear in the table.
+    action[state * num_terminals + terminal] is 0 for an error, s+1 for a shift to the state s and -(r+1) for a reduction by the rule r.
+    goto[state * num_nonterminals + nonterminal] is the state after reducing to the nonterminal in the state or -1.
+    """
+    ERROR = 0
+    NO_GOTO = -1
+
+    def __init__(self, parse_table: IntParseTable):
+        states = parse_table.states
+        if sorted(states) != list(range(len(states))):
+            raise ValueError('DenseParseTable requires an IntParseTable with the states 0..n-1')
+        self.num_states = len(states)
+
+        self.terminals: List[str] = sorted({symbol for actions in states.values() for symbol in actions if symbol.isupper()})
+        # The origins of the rules include the nonterminals without a goto e.g., $root_start in the LR table
+        nonterminals = {symbol for actions in states.values() for symbol in actions if not symbol.isupper()}
+        nonterminals.update(arg.origin.name for actions in states.values() for symbol, (action, arg) in actions.items() if symbol.isupper() and action is not Shift)
+        self.nonterminals: List[str] = sorted(nonterminals)
+        self._set_symbol_ids()
+
+        rule_ids: Dict[Any, int] = {}
+        self.rule_len: List[int] = []
+        self.rule_origin: List[int] = []
+        self.action: List[int] = [self.ERROR] * (self.num_states * self.num_terminals)
+        self.goto: List[int] = [self.NO_GOTO] * (self.num_states * self.num_nonterminals)
+
+        for state, actions in states.items():
+            for symbol, (action, arg) in actions.items():
+                if not symbol.isupper():
+                    assert action is Shift
+                    self.goto[state * self.num_nonterminals + self.nonterminal_ids[symbol]] = arg
+                elif action is Shift:
+                    self.action[state * self.num_terminals + self.terminal_ids[symbol]] = arg + 1
+                else:
+                    if arg not in rule_ids:
+                        rule_ids[arg] = len(rule_ids)
+                        self.rule_len.append(len(arg.expansion))
+                        self.rule_origin.append(self.nonterminal_ids[arg.origin.name])
+                    self.action[state * self.num_terminals + self.terminal_ids[symbol]] = -(rule_ids[arg] + 1)
+
+    def _set_symbol_ids(self):
+        self.num_terminals = len(self.terminals)
+        self.num_nonterminals = len(self.nonterminals)
+        self.terminal_ids: Dict[str, int] = {terminal: idx for idx, terminal in enumerate(self.terminals)}
+        self.nonterminal_ids: Dict[str, int] = {nonterminal: idx for idx, nonterminal in enumerate(self.nonterminals)}
+
+    def serialize(self) -> Dict[str, Any]:
+        return {
+            'num_states': self.num_states,
+            'terminals': self.terminals,
+            'nonterminals': self.nonterminals,
+            'rule_len': self.rule_len,
+            'rule_origin': self.rule_origin,
+            'action': self.action,
+            'goto': self.goto,
+        }
+
+    @staticmethod
+    def deserialize(data: Dict[str, Any]) -> 'DenseParseTable':
+        table = DenseParseTable.__new__(DenseParseTable)
+        table.num_states = data['num_states']
+        table.terminals = data['terminals']
+        table.nonterminals = data['nonterminals']
+        table.rule_len = data['rule_len']
+        table.rule_origin = data['rule_origin']
+        table.action = data['action']
+        table.goto = data['goto']
+        table._set_symbol_ids()
+        return table
+
+
+class DenseRecognizerState(RecognizerParserState):
+    """
+    RecognizerParserState whose feed_token() runs on the DenseParseTable. The state stack holds the same states as with the parse table of the base parser.
+    """
+    __slots__ = ('dense_table',)
+
+    def __init__(self, parse_conf, lexer, dense_table: DenseParseTable, state_stack=None):
+        super().__init__(parse_conf, lexer, state_stack)
+        self.dense_table = dense_table
+
+    @staticmethod
+    def from_parser_state(parser_state: ParserState, dense_table: DenseParseTable) -> 'DenseRecognizerState':
+        return DenseRecognizerState(
+            parser_state.parse_conf,
+            parser_state.lexer,
+            dense_table,
+            PersistentStack.from_iterable(parser_state.state_stack)
+        )
+
+    def __copy__(self):
+        return type(self)(
+            self.parse_conf,
+            self.lexer,
+            self.dense_table,
+            self.state_stack,
+        )
+
+    def feed_token(self, token: Token, is_end=False) -> Any:
+        table = self.dense_table
+        action, goto, rule_len, rule_origin = table.action, table.goto, table.rule_len, table.rule_origin
+        num_terminals, num_nonterminals = table.num_terminals, table.num_nonterminals
+        end_state = self.parse_conf.end_state
+        terminal = table.terminal_ids.get(token.type)
+        state_stack = self.state_stack
+
+        while True:
+            state = state_stack.peek()
+            act = action[state * num_terminals + terminal] if terminal is not None else DenseParseTable.ERROR
+            if act == DenseParseTable.ERROR:
+                self.state_stack = state_stack
+                expected = {s for s in self.parse_conf.states[state].keys() if s.isupper()}
+                raise UnexpectedToken(token, expected, state=self, interactive_parser=None)
+
+            if act > 0:
+                # shift once and return
+                assert not is_end
+                self.state_stack = state_stack.push(act - 1)
+                return
+            else:
+                # reduce+shift as many times as necessary
+                rule = -act - 1
+                state_stack = state_stack.drop(rule_len[rule])
+                new_state = goto[state_stack.peek() * num_nonterminals + rule_origin[rule]]
+                if new_state == DenseParseTable.NO_GOTO:
+                    raise KeyError(table.nonterminals[rule_origin[rule]])
+                state_stack = state_stack.push(new_state)
+
+                if is_end and new_state == end_state:
+                    self.state_stack = state_stack
+                    return None
@@ -39,7 +39,7 @@ class GoIncrementalParser(IncrementalParser):
                     if 'EOS' not in self.next_ac_terminals:
                         continue
 
-                self.parsed_lexer_tokens.append(token) # parser_token_seq holds all tokens
+                self.parsed_lexer_tokens = self.parsed_lexer_tokens.push(token) # parser_token_seq holds all tokens
                 interactive.feed_token(token)
                 
                 # Store the current state of the parser
@@ -59,7 +59,7 @@ class GoIncrementalParser(IncrementalParser):
         remainder_state, current_term_str, final_terminal = self._get_remainder(partial_code, parse_incomplete=parse_incomplete)
         
         if remainder_state != RemainderState.INCOMPLETE:
-            self.next_ac_terminals.add('EOS')
+            self.next_ac_terminals = self.next_ac_terminals | {'EOS'} # The accept sets are shared with the stored parser states
 
         return ParseResult.from_accept_terminals(self.cur_ac_terminals, self.next_ac_terminals, current_term_str, remainder_state, final_terminal=final_terminal, ignore_terminals=self.base_parser.lexer_conf.ignore)
     
\ No newline at end of file
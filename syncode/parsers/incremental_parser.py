@@ -1,19 +1,99 @@
-import copy, time
+import copy, itertools, regex, threading, time
 import syncode.common as common
 import syncode.larkm as lark
 from syncode.larkm.parsers.lalr_interactive_parser import InteractiveParser
 from syncode.parse_result import ParseResult, RemainderState
-from syncode.larkm.lexer import Token
-from typing import Optional, Any, Tuple, Iterable
+from syncode.larkm.lexer import LexerState, LineCounter, Token
+from syncode.larkm.parsers.lalr_analysis import IntParseTable
+from syncode.parsers.accepts_table import AcceptsTable
+from syncode.parsers.dense_parse_table import DenseParseTable, DenseRecognizerState
+from syncode.parsers.persistent_state import PersistentParserState, PersistentStack, RecognizerParserState
+from typing import Optional, Any, Dict, Iterator, List, Tuple, Iterable
+
+
+class LexerTokens:
+    """
+    Lexer tokens of a code without copying the tokens before the lexer checkpoint.
+
+    The first tokens are a prefix of a list that is shared with the lexer checkpoint, and the tokens lexed after the checkpoint are kept in a separate list. The shared list is only appended to, so its prefix never changes and every checkpoint and the lexer tokens that are lexed from it can refer to the same list. Hence, lexing a code costs the number of tokens after the checkpoint instead of the number of all the tokens.
+    """
+    __slots__ = ('_shared', '_num_shared', '_tail')
+    _extend_lock = threading.Lock() # Parsers forked from the same state may extend the shared list from different threads
+
+    def __init__(self, shared: Optional[List[Token]]=None, num_shared: int=0):
+        self._shared: List[Token] = shared if shared is not None else []
+        self._num_shared = num_shared
+        self._tail: List[Token] = []
+
+    def __len__(self) -> int:
+        return self._num_shared + len(self._tail)
+
+    def __getitem__(self, index: int) -> Token:
+        if index < 0:
+            index += len(self)
+        if 0 <= index < self._num_shared:
+            return self._shared[index]
+        if index < 0:
+            raise IndexError('lexer token index out of range')
+        return self._tail[index - self._num_shared]
+
+    def __iter__(self) -> Iterator[Token]:
+        yield from itertools.islice(self._shared, self._num_shared)
+        yield from self._tail
+
+    def __iadd__(self, tokens: Iterable[Token]) -> 'LexerTokens':
+        self._tail.extend(tokens)
+        return self
+
+    def append(self, token: Token):
+        self._tail.append(token)
+
+    def prefix(self, num_tokens: int) -> 'LexerTokens':
+        """
+        Returns the first num_tokens tokens. The tokens after the shared ones are appended to the shared list unless the shared list has already been extended by other lexer tokens, in which case the shared tokens are copied once.
+        """
+        if num_tokens <= self._num_shared:
+            return LexerTokens(self._shared, num_tokens)
+        with LexerTokens._extend_lock:
+            shared = self._shared
+            if len(shared) != self._num_shared:
+                shared = shared[:self._num_shared]
+            shared.extend(self._tail[:num_tokens - self._num_shared])
+        return LexerTokens(shared, num_tokens)
+
+    def __repr__(self):
+        return f'LexerTokens({list(self)!r})'
+
+
+class LexerCheckpoint:
+    """
+    The lexer state after the last lexer token that cannot be changed by appending text to the code. Lexing of a code that extends the code up to the checkpoint resumes from here.
+    """
+    def __init__(self, code: str='', line_ctr: Optional[LineCounter]=None, tokens: Optional[LexerTokens]=None, last_token: Optional[Token]=None, postlex_state: Any=None):
+        self.code = code # The code up to the checkpoint
+        self.line_ctr = line_ctr
+        self.tokens: LexerTokens = tokens if tokens is not None else LexerTokens() # Lexer tokens before the checkpoint
+        self.last_token = last_token # Last token returned by the basic lexer
+        self.postlex_state = postlex_state # e.g., the indentation levels of the Python indenter
+
 
 class IncrementalParser:    
     """
     This is the base class for all incremental parsers.
+
+    recognizer (bool, optional): Whether to only recognize the code without building the value stack and running the tree callbacks of the base parser. This is enough for computing the accepted terminals. Defaults to False.
+    dense_table (DenseParseTable, optional): The integer parse table of the base parser that the recognizer runs on. Defaults to None, which builds it from the parse table of the base parser.
+    snapshot_window (int, optional): Number of lexer tokens before the last parsed token for which all the parser snapshots are kept. Further back, the snapshots are kept at exponentially growing distances, and a mismatch there is parsed again from the nearest kept snapshot. Defaults to 64, None keeps all the snapshots.
+    max_snapshots (int, optional): Maximum number of parser snapshots. If it is exceeded, the distances between the snapshots outside the window are doubled. Defaults to 1024.
     """
-    def __init__(self, base_parser, logger: Optional[common.Logger]=None) -> None:
+    def __init__(self, base_parser, logger: Optional[common.Logger]=None, recognizer: bool=False, dense_table: Optional[DenseParseTable]=None, snapshot_window: Optional[int]=64, max_snapshots: int=1024) -> None:
+        self.recognizer = recognizer
+        self.dense_table = dense_table
+        self.snapshot_window = min(snapshot_window, max_snapshots // 2) if snapshot_window is not None else None
+        self.max_snapshots = max_snapshots
         self.cur_pos = 0 # Current cursor position in the lexer tokens list
         self.lexer_pos = 0 # Current lexer position in the code
-        self.dedent_queue: list = []
+        self.dedent_queue = PersistentStack()
 
         # Initialize the parser
         time_start = time.time()
@@ -21,11 +101,23 @@ class IncrementalParser:
 
         self.logger = logger if logger is not None else common.EmptyLogger()
         self.logger.log_time(f"Time taken for loading parser: {time.time() - time_start:.2f}s")
-        self.interactive = self.base_parser.parse_interactive('')
-        self.parsed_lexer_tokens: list = []
+        self.interactive = self._parse_interactive()
+        self._initial_parser_state = self.interactive.parser_state.copy()
+        self.parsed_lexer_tokens = PersistentStack()
         self.prev_lexer_tokens: list[Token] = [] # To enable going back to old state of the parser
-        self.cur_pos_to_parser_state: dict[int, Tuple[Any, set, set, Optional[list], list]] = {} # parser_state, cur_ac_terminals, next_ac_terminals, indent_levels (optional), dedent_queue
+        self.cur_pos_to_parser_state: dict[int, Tuple[PersistentStack, Any, set, set, Optional[PersistentStack], PersistentStack]] = {} # parsed_lexer_tokens, parser_state, cur_ac_terminals, next_ac_terminals, indent_levels (optional), dedent_queue
         self.time_accepts = 0 # Profiling
+        self._reset_snapshot_retention()
+
+        # Accepted terminals are looked up in the table instead of trial-feeding them. It is None for the LR parser whose accepts() does not feed the terminals
+        self.accepts_table: Optional[AcceptsTable] = None
+        if self.interactive.parser.parser_type == 'lalr':
+            self.accepts_table = AcceptsTable(self.interactive.parser_state.parse_conf.parse_table)
+
+        # Incremental lexing
+        self.lexer_checkpoint = LexerCheckpoint()
+        self.num_unchanged_lexer_tokens = 0 # Number of lexer tokens at the start that are the same as in the previous call
+        self._multiline_terminal_patterns = None
 
         self.cur_ac_terminals: set = set()
         self.next_ac_terminals: set = self._accepts(self.interactive)
@@ -36,58 +128,193 @@ class IncrementalParser:
         """
         self.cur_pos = 0
         self.lexer_pos = 0
-        self.dedent_queue = []
-        self.parsed_lexer_tokens = []
+        self.dedent_queue = PersistentStack()
+        self.parsed_lexer_tokens = PersistentStack()
         self.prev_lexer_tokens = []
         self.cur_pos_to_parser_state = {}
         self.time_accepts = 0
-        self.interactive = self.base_parser.parse_interactive('')
+        self._reset_snapshot_retention()
+        self.lexer_checkpoint = LexerCheckpoint()
+        self.num_unchanged_lexer_tokens = 0
+        self.interactive = self._parse_interactive()
+        self._initial_parser_state = self.interactive.parser_state.copy()
         self.cur_ac_terminals = set()
         self.next_ac_terminals = self._accepts(self.interactive)
     
-    def _store_parser_state(self, pos: int, parser_state, accepts: set, indent_levels: Optional[list] = None):  
+    def save_state(self) -> dict:
+        """
+        Returns the state of the parser after the last parsed code, so that parsing can later continue from it with restore_state(), possibly in another parser of the same grammar.
+
+        The parser snapshots, the lexer checkpoint and the accept sets are not modified in place, so they are shared with the parser. Only the dictionary of the snapshots is copied.
+        """
+        return {
+            'cur_pos': self.cur_pos,
+            'lexer_pos': self.lexer_pos,
+            'dedent_queue': self.dedent_queue,
+            'parser_state': self.interactive.parser_state.copy(),
+            'parsed_lexer_tokens': self.parsed_lexer_tokens,
+            'prev_lexer_tokens': self.prev_lexer_tokens,
+            'cur_pos_to_parser_state': dict(self.cur_pos_to_parser_state),
+            'snapshot_stride': self.snapshot_stride,
+            'last_pruned_pos': self._last_pruned_pos,
+            'lexer_checkpoint': self.lexer_checkpoint,
+            'num_unchanged_lexer_tokens': self.num_unchanged_lexer_tokens,
+            'cur_ac_terminals': self.cur_ac_terminals,
+            'next_ac_terminals': self.next_ac_terminals,
+        }
+
+    def restore_state(self, state: dict):
+        """
+        Continues parsing from the state returned by save_state(). The state can be restored any number of times.
+        """
+        self.cur_pos = state['cur_pos']
+        self.lexer_pos = state['lexer_pos']
+        self.dedent_queue = state['dedent_queue']
+        self.interactive.parser_state = state['parser_state'].copy()
+        self.parsed_lexer_tokens = state['parsed_lexer_tokens']
+        self.prev_lexer_tokens = state['prev_lexer_tokens']
+        self.cur_pos_to_parser_state = dict(state['cur_pos_to_parser_state'])
+        self.snapshot_stride = state['snapshot_stride']
+        self._last_pruned_pos = state['last_pruned_pos']
+        self.lexer_checkpoint = state['lexer_checkpoint']
+        self.num_unchanged_lexer_tokens = state['num_unchanged_lexer_tokens']
+        self.cur_ac_terminals = state['cur_ac_terminals']
+        self.next_ac_terminals = state['next_ac_terminals']
+
+    def copy_state_from(self, other: 'IncrementalParser'):
+        """
+        Makes the parser continue from the state of another parser of the same grammar, as if it had parsed the same code.
+        """
+        self.restore_state(other.save_state())
+    
+    def _parse_interactive(self) -> InteractiveParser:
+        """
+        Returns an interactive parser on the empty input whose parser state uses persistent stacks.
+        """
+        interactive = self.base_parser.parse_interactive('')
+        if self.recognizer:
+            if self.dense_table is None and isinstance(interactive.parser_state.parse_conf.parse_table, IntParseTable):
+                self.dense_table = DenseParseTable(interactive.parser_state.parse_conf.parse_table)
+            if self.dense_table is not None:
+                interactive.parser_state = DenseRecognizerState.from_parser_state(interactive.parser_state, self.dense_table)
+            else:
+                interactive.parser_state = RecognizerParserState.from_parser_state(interactive.parser_state)
+        else:
+            interactive.parser_state = PersistentParserState.from_parser_state(interactive.parser_state)
+        return interactive
+
+    def _store_parser_state(self, pos: int, parser_state, accepts: set, indent_levels: Optional[PersistentStack] = None):  
+        """
+        Stores the parser state after the lexer token at pos. 
+        
+        The token list, dedent queue, indentation levels and parser stacks are persistent stacks and the accept sets are never modified in place, so the snapshot only holds references and is O(1) in the number of parsed tokens.
+        """
         time_start = time.time() 
         cur_ac_terminals = self.next_ac_terminals  
         next_ac_terminals = accepts 
         
-        # parser_state, cur_ac_terminals, next_ac_terminals, indent_levels, dedent_queue
-        self.cur_pos_to_parser_state[pos] = (copy.deepcopy(self.parsed_lexer_tokens), parser_state, cur_ac_terminals, next_ac_terminals, indent_levels, copy.deepcopy(self.dedent_queue))
+        # parsed_lexer_tokens, parser_state, cur_ac_terminals, next_ac_terminals, indent_levels, dedent_queue
+        self.cur_pos_to_parser_state[pos] = (self.parsed_lexer_tokens, parser_state, cur_ac_terminals, next_ac_terminals, indent_levels, self.dedent_queue)
         
-        self.cur_ac_terminals = copy.deepcopy(cur_ac_terminals)
-        self.next_ac_terminals = copy.deepcopy(next_ac_terminals)
+        self.cur_ac_terminals = cur_ac_terminals
+        self.next_ac_terminals = next_ac_terminals
+        if self.snapshot_window is not None:
+            self._prune_snapshots(pos)
         self.logger.log_time(f'Time taken for storing parser state:{time.time() - time_start}')
 
+    def _reset_snapshot_retention(self):
+        self.snapshot_stride = max(1, self.snapshot_window // 4) if self.snapshot_window is not None else 1 # Distance between the kept snapshots just outside the window
+        self._last_pruned_pos = -1
+
+        # Statistics
+        self.num_pruned_snapshots = 0
+        self.num_reparsed_tokens = 0 # Matching lexer tokens that were parsed again since there was no snapshot after them
+        self.num_deep_restores = 0 # Restores with the first mismatch outside the window
+
+    def snapshot_stats(self) -> Dict[str, Any]:
+        return {
+            'snapshots': len(self.cur_pos_to_parser_state),
+            'stride': self.snapshot_stride,
+            'pruned': self.num_pruned_snapshots,
+            'reparsed_tokens': self.num_reparsed_tokens,
+            'deep_restores': self.num_deep_restores,
+        }
+
+    def _prune_snapshots(self, pos: int):
+        """
+        Removes the snapshots that are not kept after the snapshot at pos is stored.
+
+        A snapshot at the distance d >= snapshot_window from pos is kept if its position is a multiple of snapshot_stride * 2^k, where k = floor(log2(d / snapshot_window)). A snapshot only moves to the next k when pos reaches the distance snapshot_window * 2^k from it, so only these positions are checked for every pos since the last call. There are about 4 log2(n / snapshot_window) snapshots outside the window and a mismatch at the distance d is parsed again from at most about d / 4 tokens before it.
+        """
+        snapshots = self.cur_pos_to_parser_state
+        start = self._last_pruned_pos + 1 if self._last_pruned_pos < pos else pos
+        for frontier in range(start, pos+1):
+            distance, stride = self.snapshot_window, self.snapshot_stride
+            while distance <= frontier:
+                old_pos = frontier - distance
+                if old_pos % stride != 0 and old_pos in snapshots:
+                    del snapshots[old_pos]
+                    self.num_pruned_snapshots += 1
+                distance, stride = distance * 2, stride * 2
+        self._last_pruned_pos = pos
+
+        if len(snapshots) > self.max_snapshots:
+            self._thin_snapshots(pos)
+
+    def _thin_snapshots(self, pos: int):
+        """
+        Doubles the distances between the snapshots outside the window and removes the snapshots that are no longer kept. The snapshots after pos are left from the code before going back and are also removed.
+        """
+        self.snapshot_stride *= 2
+        snapshots = self.cur_pos_to_parser_state
+        for old_pos in list(snapshots):
+            distance = pos - old_pos
+            if distance < 0:
+                del snapshots[old_pos]
+                continue
+            if distance < self.snapshot_window:
+                continue
+            stride = self.snapshot_stride << ((distance // self.snapshot_window).bit_length() - 1)
+            if old_pos % stride != 0:
+                del snapshots[old_pos]
+                self.num_pruned_snapshots += 1
+
     def _restore_parser_state(self, pos: int):
         time_start = time.time()
         parsed_lexer_tokens, parser_state, cur_ac_terminals, next_ac_terminals, indent_levels, dedent_queue = self.cur_pos_to_parser_state[pos]
         
+        # The stored parser state is shared with the snapshot, the copy only holds references to its persistent stacks
         self.interactive.parser_state = parser_state.copy()
-        self.parsed_lexer_tokens = copy.deepcopy(parsed_lexer_tokens)
-        self.dedent_queue = copy.deepcopy(dedent_queue)
-        self.cur_ac_terminals = copy.deepcopy(cur_ac_terminals)
-        self.next_ac_terminals = copy.deepcopy(next_ac_terminals)
+        self.parsed_lexer_tokens = parsed_lexer_tokens
+        self.dedent_queue = dedent_queue
+        self.cur_ac_terminals = cur_ac_terminals
+        self.next_ac_terminals = next_ac_terminals
 
         if indent_levels is not None:
-            self.indent_level = copy.deepcopy(indent_levels)
+            self.indent_level = indent_levels
 
         self.logger.log_time(f'Time taken for restoring parser state:{time.time() - time_start}')
 
-    def _lex_code(self, code) -> Tuple[Iterable[Token], bool]:
+    def _lex_code(self, code) -> Tuple[LexerTokens, bool]:
         """
-        Lexes the given code and returns the list of tokens.
+        Lexes the given code and returns the list of tokens. If the code extends the code lexed up to the lexer checkpoint, lexing resumes from the checkpoint.
         """
         # Collect Lexer tokens
-        lexer_tokens: Iterable[Token] = []
         interactive = self.base_parser.parse_interactive(code)
         lexing_start_time = time.time()
         lexer_state = interactive.lexer_thread.state
+        blexer = interactive.lexer_thread.lexer
+        checkpoint = self._resume_lexing(code, lexer_state)
+        lexer_tokens = checkpoint.tokens.prefix(len(checkpoint.tokens))
+        lexed_tokens = [] # (start position, token, number of lexer tokens, postlexer state) for the tokens lexed after the checkpoint
         lexing_incomplete = False
         try:
             while lexer_state.line_ctr.char_pos < len(lexer_state.text):
-                blexer = interactive.lexer_thread.lexer
+                start_pos = lexer_state.line_ctr.char_pos
                 token = blexer.next_token(lexer_state)
                 self.lexer_pos = lexer_state.line_ctr.char_pos
                 lexer_tokens.append(token)
+                lexed_tokens.append((start_pos, token, len(lexer_tokens), None))
         except lark.exceptions.UnexpectedCharacters as e:
             lexing_incomplete = True
             # We update the lexer position to the current position since the lexer has stopped at this position
@@ -95,19 +322,96 @@ class IncrementalParser:
         except EOFError as e:
             pass
     
+        self._advance_lexer_checkpoint(code, blexer, lexer_tokens, lexed_tokens)
         self.logger.log_time(f'Time taken for lexing:{time.time() - lexing_start_time}')
         return lexer_tokens, lexing_incomplete
+
+    def _resume_lexing(self, code: str, lexer_state: LexerState) -> LexerCheckpoint:
+        """
+        Moves the lexer state to the lexer checkpoint if the code extends the code up to the checkpoint. Otherwise, the checkpoint is dropped and lexing starts from the beginning of the code.
+        """
+        checkpoint = self.lexer_checkpoint
+        if not code.startswith(checkpoint.code):
+            checkpoint = self.lexer_checkpoint = LexerCheckpoint()
+
+        if checkpoint.line_ctr is not None:
+            lexer_state.line_ctr = copy.copy(checkpoint.line_ctr)
+            lexer_state.last_token = checkpoint.last_token
+            self.lexer_pos = checkpoint.line_ctr.char_pos
+        self.num_unchanged_lexer_tokens = len(checkpoint.tokens)
+        return checkpoint
+
+    def _advance_lexer_checkpoint(self, code: str, blexer, lexer_tokens: LexerTokens, lexed_tokens: list):
+        """
+        Moves the lexer checkpoint over the tokens lexed after it as long as they cannot be changed by appending text to the code.
+
+        A token is considered unchangeable if it ends before the last newline in the code and no terminal that can span multiple lines (e.g., long strings and comments) is partially matched where the lexer matched the token, the ignored text before it, or the text right after it. Single line terminals cannot look beyond the last newline, and a partial match of a multi-line terminal means that it may match once more text is appended, e.g., when a long string is not closed yet.
+        """
+        last_newline_pos = code.rfind('\n')
+        num_stable = 0
+        for start_pos, token, _, _ in lexed_tokens:
+            if token.end_pos > last_newline_pos or not self._is_stable_lexing(code, blexer, start_pos, token.end_pos):
+                break
+            num_stable += 1
+
+        if num_stable == 0:
+            return
+        _, token, num_tokens, postlex_state = lexed_tokens[num_stable-1]
+        line_ctr = LineCounter(self.lexer_checkpoint.line_ctr.newline_char if self.lexer_checkpoint.line_ctr is not None else '\n')
+        line_ctr.char_pos, line_ctr.line, line_ctr.column = token.end_pos, token.end_line, token.end_column
+        line_ctr.line_start_pos = token.end_pos - token.end_column + 1
+        self.lexer_checkpoint = LexerCheckpoint(code[:token.end_pos], line_ctr, lexer_tokens.prefix(num_tokens), last_token=token, postlex_state=postlex_state)
+
+    def _is_stable_lexing(self, code: str, blexer, start_pos: int, end_pos: int) -> bool:
+        """
+        Checks that no multi-line terminal partially matches at any position where the lexer starts a match between start_pos and end_pos (both inclusive).
+        """
+        patterns = self._get_multiline_terminal_patterns(blexer)
+        if patterns is None:
+            return False
+        pos = start_pos
+        while True:
+            for pattern in patterns:
+                m = pattern.match(code, pos, partial=True)
+                if m is not None and m.partial:
+                    return False
+            if pos >= end_pos:
+                return True
+            value, _ = blexer.match(code, pos)
+            pos += len(value)
+
+    def _get_multiline_terminal_patterns(self, blexer) -> Optional[list]:
+        """
+        Returns the compiled regexes of the terminals that may contain a newline. Returns None if some regex is not supported by the regex module, in which case no token is considered stable.
+        """
+        if self._multiline_terminal_patterns is None:
+            try:
+                self._multiline_terminal_patterns = [regex.compile(t.pattern.to_regexp(), blexer.g_regex_flags) for t in blexer.terminals if t.name in blexer.newline_types]
+            except regex.error:
+                self.logger.log('Incremental lexing is disabled since the multi-line terminals cannot be compiled with the regex module')
+                self._multiline_terminal_patterns = False
+        return self._multiline_terminal_patterns if self._multiline_terminal_patterns is not False else None
     
     def _restore_recent_parser_state(self, lexer_tokens):
         """
         Restores the parser state to the most recent prefix matching state that was stored. 
         """
-        max_matching_index = -1
-        for i in range(min(len(self.prev_lexer_tokens), len(lexer_tokens))):
+        # The lexer tokens before the lexer checkpoint are the same as in the previous call
+        num_matching = min(self.num_unchanged_lexer_tokens, len(self.prev_lexer_tokens), len(lexer_tokens))
+        for i in range(num_matching, min(len(self.prev_lexer_tokens), len(lexer_tokens))):
             if self.prev_lexer_tokens[i] != lexer_tokens[i]:
                 break
+            num_matching = i + 1
+
+        # The nearest stored snapshot before the first mismatch. It may be further back if the snapshots there are not kept
+        max_matching_index = -1
+        for i in range(num_matching-1, -1, -1):
             if i in self.cur_pos_to_parser_state:
                 max_matching_index = i
+                break
+        self.num_reparsed_tokens += num_matching - 1 - max_matching_index
+        if self.snapshot_window is not None and len(self.prev_lexer_tokens) - num_matching > self.snapshot_window:
+            self.num_deep_restores += 1
 
         if max_matching_index != -1:
             self.cur_pos = max_matching_index + 1
@@ -115,7 +419,17 @@ class IncrementalParser:
             self._restore_parser_state(max_matching_index)
         else:
             self.cur_pos = 0
+            self._restore_initial_parser_state()
 
+    def _restore_initial_parser_state(self):
+        """
+        Restores the parser state before the first lexer token, e.g., when the first lexer token has changed.
+        """
+        self.interactive.parser_state = self._initial_parser_state.copy()
+        self.parsed_lexer_tokens = PersistentStack()
+        self.dedent_queue = PersistentStack()
+        self.cur_ac_terminals = set()
+        self.next_ac_terminals = self._accepts(self.interactive)
 
     def get_acceptable_next_terminals(self, partial_code) -> ParseResult:
         """
@@ -141,7 +455,7 @@ class IncrementalParser:
             while self.cur_pos < len(lexer_tokens):
                 token = lexer_tokens[self.cur_pos]
                 self.cur_pos += 1
-                self.parsed_lexer_tokens.append(token) # parser_token_seq holds all tokens
+                self.parsed_lexer_tokens = self.parsed_lexer_tokens.push(token) # parser_token_seq holds all tokens
                 interactive.feed_token(token)
 
                 # Store the current state of the parser
@@ -175,8 +489,8 @@ class IncrementalParser:
                 self.next_ac_terminals = set()
         elif parse_incomplete: # Parsing is incomplete
             remainder_state = RemainderState.INCOMPLETE
-            current_term_str = self.parsed_lexer_tokens[-1].value
-            final_terminal = self.parsed_lexer_tokens[-1].type
+            current_term_str = self.parsed_lexer_tokens.peek().value
+            final_terminal = self.parsed_lexer_tokens.peek().type
         elif len(self.parsed_lexer_tokens) > 0:
             if self.lexer_pos < len(code): # In this case the final lexical tokens are ignored by the parser
                 remainder_state = RemainderState.COMPLETE
@@ -184,9 +498,9 @@ class IncrementalParser:
             else:
                 # Although this is a complete terminal, it may happen that this may be just prefix of some other terminal
                 # e.g., 'de' may seem like a variable name that is complete, but it may be just a prefix of 'def'
-                current_term_str = self.parsed_lexer_tokens[-1].value
+                current_term_str = self.parsed_lexer_tokens.peek().value
                 remainder_state = RemainderState.MAYBE_COMPLETE
-                final_terminal = self.parsed_lexer_tokens[-1].type
+                final_terminal = self.parsed_lexer_tokens.peek().type
         else:
             # When the code is empty
             remainder_state = RemainderState.COMPLETE
@@ -195,7 +509,10 @@ class IncrementalParser:
     
     def _accepts(self, interactive_parser: InteractiveParser) -> set:
         start_time = time.time()
-        accepts = interactive_parser.accepts()
+        if self.accepts_table is not None:
+            accepts = self.accepts_table.accepts(interactive_parser.parser_state.state_stack)
+        else:
+            accepts = interactive_parser.accepts()
         self.time_accepts += time.time() - start_time
         return accepts
     
@@ -0,0 +1,113 @@
+from typing import Any, Dict, List, Optional, Tuple
+from syncode.parse_result import ParseResult
+from syncode.parsers.incremental_parser import IncrementalParser
+
+
+class ParserPool:
+    """
+    Incremental parsers for the sequences of a batch that share the parser state while the sequences are the same.
+
+    Every sequence (row) of the batch is parsed by one of the parsers of the pool, and the rows with the same partial code are parsed by the same parser, so the prompt and the common prefixes of the samples (e.g., with greedy or low temperature sampling) are parsed once per batch. When the code of a row diverges from the other rows of its parser, the row moves to a free parser that first copies the state of the shared parser. The copy only holds references to the stored parser snapshots in cur_pos_to_parser_state, so the free parser continues from the longest common prefix as if it had parsed the row from the start.
+
+    Args:
+        parsers (List[IncrementalParser]): One parser for every row of the batch. The parsers should be created for the same grammar.
+    """
+    def __init__(self, parsers: List[IncrementalParser]):
+        self.parsers = parsers
+        # The parsers are created for the same grammar, so the accepts table cache is shared
+        for parser in parsers[1:]:
+            if parser.accepts_table is not None and parsers[0].accepts_table is not None:
+                parser.accepts_table = parsers[0].accepts_table
+        self.reset()
+
+    def reset(self):
+        """
+        Resets all the parsers. All the rows share the first parser until their code diverges.
+        """
+        for parser in self.parsers:
+            parser.reset()
+        self.row_to_parser: List[int] = [0 for _ in self.parsers]
+        self._last_results: Dict[int, Tuple[str, ParseResult]] = {} # parser index -> (code, parse result) of the last parse
+
+        # Statistics
+        self.num_parses = 0
+        self.num_shared_parses = 0
+        self.num_forks = 0
+
+    def restore_state(self, state: dict):
+        """
+        Makes all the rows continue from the parser state returned by IncrementalParser.save_state().
+        """
+        self.row_to_parser = [0 for _ in self.parsers]
+        self._last_results = {}
+        self.parsers[0].restore_state(state)
+
+    def stats(self) -> Dict[str, Any]:
+        num_lookups = self.num_parses + self.num_shared_parses
+        return {
+            'parses': self.num_parses,
+            'shared_parses': self.num_shared_parses,
+            'forks': self.num_forks,
+            'share_rate': self.num_shared_parses / num_lookups if num_lookups > 0 else 0.0,
+        }
+
+    def share(self, partial_codes: List[str], rows: Optional[List[int]]=None):
+        """
+        Assigns the rows to the parsers for the next step so that the rows with the same code are parsed by the same parser. It should be called before parsing the codes of the step.
+
+        A group of rows with the same code keeps a parser that one of its rows was parsed with, if no other group has taken it. Otherwise the group gets a free parser that copies the state of the parser of its first row. All the copies are made before any parser of the step parses, so they are the states after the previous step.
+
+        Args:
+            partial_codes (List[str]): The codes of the rows in the step.
+            rows (List[int], optional): The rows of the codes if only some rows of the batch are parsed in the step. Defaults to None, i.e., the first len(partial_codes) rows.
+        """
+        if rows is None:
+            rows = list(range(len(partial_codes)))
+        groups: Dict[str, List[int]] = {}
+        for idx, code in zip(rows, partial_codes):
+            groups.setdefault(code, []).append(idx)
+
+        # The parsers of the rows that are not in this step keep their state
+        step_rows = set(rows)
+        taken = {self.row_to_parser[idx] for idx in range(len(self.row_to_parser)) if idx not in step_rows}
+        group_parsers: List[Optional[int]] = []
+        for group_rows in groups.values():
+            parser_idx = next((self.row_to_parser[idx] for idx in group_rows if self.row_to_parser[idx] not in taken), None)
+            if parser_idx is not None:
+                taken.add(parser_idx)
+            group_parsers.append(parser_idx)
+
+        free_parsers = [parser_idx for parser_idx in range(len(self.parsers)) if parser_idx not in taken]
+        for group_idx, group_rows in enumerate(groups.values()):
+            if group_parsers[group_idx] is None:
+                parser_idx = free_parsers.pop()
+                self.fork(parser_idx, self.row_to_parser[group_rows[0]])
+                group_parsers[group_idx] = parser_idx
+
+        for group_rows, parser_idx in zip(groups.values(), group_parsers):
+            for idx in group_rows:
+                self.row_to_parser[idx] = parser_idx
+
+    def fork(self, parser_idx: int, src_parser_idx: int):
+        """
+        Makes the parser continue from the state of the source parser.
+        """
+        self.num_forks += 1
+        self.parsers[parser_idx].copy_state_from(self.parsers[src_parser_idx])
+        self._last_results.pop(parser_idx, None)
+
+    def get_acceptable_next_terminals(self, idx: int, partial_code: str) -> ParseResult:
+        """
+        Returns the parse result of the partial code of the row. If the parser of the row has just parsed the same code for another row, the result is reused.
+        """
+        parser_idx = self.row_to_parser[idx]
+        last_result = self._last_results.get(parser_idx)
+        if last_result is not None and last_result[0] == partial_code:
+            self.num_shared_parses += 1
+            return last_result[1]
+
+        self.num_parses += 1
+        self._last_results.pop(parser_idx, None)
+        r = self.parsers[parser_idx].get_acceptable_next_terminals(partial_code)
+        self._last_results[parser_idx] = (partial_code, r)
+        return r
@@ -0,0 +1,85 @@
+import sys
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class ParserStateCache:
+    """
+    LRU cache of incremental parser states (IncrementalParser.save_state()) that is kept across requests, e.g., for the prompts that start with the same few-shot examples or system prompt.
+
+    The entries are evicted in the LRU order when the estimated size of the cached states exceeds the memory budget. The estimate counts the containers that each state owns (the dictionary of the parser snapshots and the lexer tokens) and the snapshots in it, but not the persistent stacks that the states share with each other.
+
+    Args:
+        max_size (int, optional): Memory budget in bytes. Defaults to 64MB.
+    """
+    # Approximate size of a snapshot in cur_pos_to_parser_state apart from the dictionary entry: the tuple, the parser state and the stack node that it adds
+    SNAPSHOT_SIZE = 200
+
+    def __init__(self, max_size: int=64 * 2**20):
+        self.max_size = max_size
+        self._cache: OrderedDict = OrderedDict() # key -> (state, size)
+        self.size = 0
+
+        # Statistics
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.num_tokens = 0 # Number of prompt tokens in the lookups
+        self.num_reused_tokens = 0 # Number of prompt tokens that were not parsed again
+
+    def get(self, key: Hashable) -> Optional[dict]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        self._cache.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, state: dict):
+        if key in self._cache:
+            self.size -= self._cache.pop(key)[1]
+        size = self.state_size(state)
+        if size > self.max_size:
+            return
+        self._cache[key] = (state, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self._cache.popitem(last=False)
+            self.size -= evicted_size
+            self.num_evictions += 1
+
+    def record_lookup(self, num_reused_tokens: int, num_tokens: int):
+        """
+        Records the lookup of the longest cached prefix of a prompt with num_tokens tokens, of which num_reused_tokens were cached.
+        """
+        if num_reused_tokens > 0:
+            self.num_hits += 1
+        else:
+            self.num_misses += 1
+        self.num_tokens += num_tokens
+        self.num_reused_tokens += num_reused_tokens
+
+    def clear(self):
+        self._cache = OrderedDict()
+        self.size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        num_lookups = self.num_hits + self.num_misses
+        return {
+            'entries': len(self._cache),
+            'size': self.size,
+            'hits': self.num_hits,
+            'misses': self.num_misses,
+            'hit_rate': self.num_hits / num_lookups if num_lookups > 0 else 0.0,
+            'evictions': self.num_evictions,
+            'reused_token_rate': self.num_reused_tokens / self.num_tokens if self.num_tokens > 0 else 0.0,
+        }
+
+    @staticmethod
+    def state_size(state: dict) -> int:
+        snapshots = state['cur_pos_to_parser_state']
+        checkpoint = state['lexer_checkpoint']
+        # The lexer tokens before the checkpoint are a prefix of a list shared with the later states of the same parser, so the list is counted up to the checkpoint
+        return (sys.getsizeof(state)
+            + sys.getsizeof(snapshots) + len(snapshots) * ParserStateCache.SNAPSHOT_SIZE
+            + sys.getsizeof([None] * len(state['prev_lexer_tokens']))
+            + sys.getsizeof(checkpoint.code))
@@ -0,0 +1,256 @@
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+from syncode.larkm.exceptions import UnexpectedToken
+from syncode.larkm.lexer import Token
+from syncode.larkm.parsers.lalr_analysis import Shift
+from syncode.larkm.parsers.lalr_parser_state import ParserState
+
+
+class PersistentStack:
+    """
+    Immutable stack stored as a linked list of nodes with shared tails.
+
+    push() and pop() return a new stack and never modify the existing one. Hence, a snapshot of the stack is just a reference to it and all the snapshots taken while parsing share the common bottom of the stack. This makes storing and restoring the parser state O(1) instead of copying the whole stack for every lexer token.
+    """
+    __slots__ = ('_head', '_tail', '_size')
+
+    def __init__(self):
+        # Creates an empty stack
+        self._head: Any = None
+        self._tail: Optional['PersistentStack'] = None
+        self._size = 0
+
+    @staticmethod
+    def from_iterable(values: Iterable[Any]) -> 'PersistentStack':
+        """
+        Creates a stack by pushing the values in order, so the last value is on the top.
+        """
+        stack = PersistentStack()
+        for value in values:
+            stack = stack.push(value)
+        return stack
+
+    def push(self, value) -> 'PersistentStack':
+        node = PersistentStack.__new__(PersistentStack)
+        node._head, node._tail, node._size = value, self, self._size + 1
+        return node
+
+    def peek(self):
+        """
+        Returns the value on the top of the stack.
+        """
+        if self._size == 0:
+            raise IndexError('peek from empty stack')
+        return self._head
+
+    def pop(self) -> Tuple[Any, 'PersistentStack']:
+        """
+        Returns the value on the top of the stack and the rest of the stack.
+        """
+        if self._size == 0:
+            raise IndexError('pop from empty stack')
+        return self._head, self._tail
+
+    def pop_n(self, n: int) -> Tuple[List[Any], 'PersistentStack']:
+        """
+        Returns the top n values (bottom to top order, as in list slicing stack[-n:]) and the rest of the stack.
+        """
+        if n > self._size:
+            raise IndexError('pop from empty stack')
+        values = [None] * n
+        node = self
+        for i in range(n-1, -1, -1):
+            values[i] = node._head
+            node = node._tail
+        return values, node
+
+    def drop(self, n: int) -> 'PersistentStack':
+        """
+        Returns the stack without its top n values.
+        """
+        if n > self._size:
+            raise IndexError('pop from empty stack')
+        node = self
+        for _ in range(n):
+            node = node._tail
+        return node
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[Any]:
+        """
+        Iterates from the bottom to the top of the stack like a list.
+        """
+        return iter(self.to_list())
+
+    def __reversed__(self) -> Iterator[Any]:
+        node = self
+        while node._size > 0:
+            yield node._head
+            node = node._tail
+
+    def __getitem__(self, index: int):
+        if not isinstance(index, int):
+            raise TypeError('PersistentStack indices must be integers')
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError('stack index out of range')
+        node = self
+        for _ in range(self._size - 1 - index):
+            node = node._tail
+        return node._head
+
+    def to_list(self) -> list:
+        values = list(reversed(self))
+        values.reverse()
+        return values
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, PersistentStack):
+            return NotImplemented
+        if self._size != other._size:
+            return False
+        a, b = self, other
+        while a is not b and a._size > 0:
+            if a._head != b._head:
+                return False
+            a, b = a._tail, b._tail
+        return True
+
+    def __repr__(self):
+        return f'PersistentStack({self.to_list()!r})'
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class PersistentParserState(ParserState):
+    """
+    ParserState whose state and value stacks are PersistentStacks.
+
+    feed_token() replaces the stacks instead of modifying them in place, so copy() is O(1) and the copies share their stacks with the original. The values on the value stack are shared between the copies and are not deep-copied.
+    """
+    __slots__ = ()
+
+    def __init__(self, parse_conf, lexer, state_stack=None, value_stack=None):
+        self.parse_conf = parse_conf
+        self.lexer = lexer
+        self.state_stack = state_stack if state_stack is not None else PersistentStack().push(parse_conf.start_state)
+        self.value_stack = value_stack if value_stack is not None else PersistentStack()
+
+    @staticmethod
+    def from_parser_state(parser_state: ParserState) -> 'PersistentParserState':
+        return PersistentParserState(
+            parser_state.parse_conf,
+            parser_state.lexer,
+            PersistentStack.from_iterable(parser_state.state_stack),
+            PersistentStack.from_iterable(parser_state.value_stack)
+        )
+
+    @property
+    def position(self):
+        return self.state_stack.peek()
+
+    def __copy__(self):
+        return type(self)(
+            self.parse_conf,
+            self.lexer,
+            self.state_stack,
+            self.value_stack,
+        )
+
+    def feed_token(self, token: Token, is_end=False) -> Any:
+        states = self.parse_conf.states
+        end_state = self.parse_conf.end_state
+        callbacks = self.parse_conf.callbacks
+
+        while True:
+            state = self.state_stack.peek()
+            try:
+                action, arg = states[state][token.type]
+            except KeyError:
+                expected = {s for s in states[state].keys() if s.isupper()}
+                raise UnexpectedToken(token, expected, state=self, interactive_parser=None)
+
+            assert arg != end_state
+
+            if action is Shift:
+                # shift once and return
+                assert not is_end
+                self.state_stack = self.state_stack.push(arg)
+                self.value_stack = self.value_stack.push(token if token.type not in callbacks else callbacks[token.type](token))
+                return
+            else:
+                # reduce+shift as many times as necessary
+                rule = arg
+                size = len(rule.expansion)
+                state_stack, value_stack = self.state_stack, self.value_stack
+                if size:
+                    s, value_stack = value_stack.pop_n(size)
+                    state_stack = state_stack.drop(size)
+                else:
+                    s = []
+
+                value = callbacks[rule](s) if callbacks else s
+
+                _action, new_state = states[state_stack.peek()][rule.origin.name]
+                assert _action is Shift
+                self.state_stack = state_stack.push(new_state)
+                self.value_stack = value_stack.push(value)
+
+                if is_end and new_state == end_state:
+                    return value
+
+
+class RecognizerParserState(PersistentParserState):
+    """
+    PersistentParserState that only recognizes the input. It keeps the state stack and does not build the value stack, so no callbacks are run and no tree or position metadata is created.
+
+    This is enough for computing the accepted terminals, but feeding '$END' does not return a parse tree.
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def from_parser_state(parser_state: ParserState) -> 'RecognizerParserState':
+        return RecognizerParserState(
+            parser_state.parse_conf,
+            parser_state.lexer,
+            PersistentStack.from_iterable(parser_state.state_stack)
+        )
+
+    def feed_token(self, token: Token, is_end=False) -> Any:
+        states = self.parse_conf.states
+        end_state = self.parse_conf.end_state
+        state_stack = self.state_stack
+
+        while True:
+            state = state_stack.peek()
+            try:
+                action, arg = states[state][token.type]
+            except KeyError:
+                self.state_stack = state_stack
+                expected = {s for s in states[state].keys() if s.isupper()}
+                raise UnexpectedToken(token, expected, state=self, interactive_parser=None)
+
+            assert arg != end_state
+
+            if action is Shift:
+                # shift once and return
+                assert not is_end
+                self.state_stack = state_stack.push(arg)
+                return
+            else:
+                # reduce+shift as many times as necessary
+                rule = arg
+                state_stack = state_stack.drop(len(rule.expansion))
+                _action, new_state = states[state_stack.peek()][rule.origin.name]
+                assert _action is Shift
+                state_stack = state_stack.push(new_state)
+
+                if is_end and new_state == end_state:
+                    self.state_stack = state_stack
+                    return None
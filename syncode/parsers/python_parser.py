@@ -1,12 +1,13 @@
-import copy, time, regex
+import time, regex
 from typing import Iterator
 import syncode.larkm as lark
 import syncode.common as common
 from syncode.larkm import Token
 from syncode.larkm.indenter import Indenter
-from syncode.parsers.incremental_parser import IncrementalParser
+from syncode.parsers.incremental_parser import IncrementalParser, LexerTokens
+from syncode.parsers.persistent_state import PersistentStack
 from syncode.parse_result import IndentationConstraint, ParseResult, RemainderState
-from typing import Optional, Iterable
+from typing import List, Optional, Iterable
 
 class PythonIncrementalParser(IncrementalParser):
     """
@@ -18,11 +19,26 @@ class PythonIncrementalParser(IncrementalParser):
         if partial_code is not None: # extract indentation type from partial code
             indenter.tab_len = self._get_indentation(partial_code)  # NOTE: tab_len is useful when \t and spaces are used for indentation in same code
         self.tab_len = indenter.tab_len
-        self.indent_level = [0] # Current indentation level
+        self.indent_level = PersistentStack().push(0) # Current indentation level
     
     def reset(self):
         super().reset()
-        self.indent_level = [0]
+        self.indent_level = PersistentStack().push(0)
+
+    def _restore_initial_parser_state(self):
+        super()._restore_initial_parser_state()
+        self.indent_level = PersistentStack().push(0)
+
+    def save_state(self) -> dict:
+        state = super().save_state()
+        state['tab_len'] = self.tab_len
+        state['indent_level'] = self.indent_level
+        return state
+
+    def restore_state(self, state: dict):
+        super().restore_state(state)
+        self.tab_len = state['tab_len']
+        self.indent_level = state['indent_level']
 
     def _get_indentation(self, partial_code) -> int:
         m = regex.match(r"(.*?):(.*?)\n(.*?)(?![ \t])", partial_code, flags=regex.DOTALL)
@@ -54,16 +70,16 @@ class PythonIncrementalParser(IncrementalParser):
 
                 if token.type == '_INDENT':
                     indent = token.count(' ') + token.count('\t') * self.tab_len
-                    self._update_indent_levels(self.indent_level, indent)            
+                    self.indent_level = self._update_indent_levels(self.indent_level, indent)
                 elif token.type == '_DEDENT': # Do not shoot dedent tokens unless there is some code on the next line
-                    self.dedent_queue.append(token)
+                    self.dedent_queue = self.dedent_queue.push(token)
                     continue
                 else:
-                    self.parsed_lexer_tokens.append(token) # parser_token_seq holds all tokens except _INDENT and _DEDENT
+                    self.parsed_lexer_tokens = self.parsed_lexer_tokens.push(token) # parser_token_seq holds all tokens except _INDENT and _DEDENT
 
                     while not len(self.dedent_queue)==0: # Shoot all the dedent tokens that are in the queue
-                        self.indent_level.pop()
-                        dedent_token = self.dedent_queue.pop()
+                        self.indent_level = self.indent_level.drop(1)
+                        dedent_token, self.dedent_queue = self.dedent_queue.pop()
                         interactive.feed_token(dedent_token)
                 
                 interactive.feed_token(token)
@@ -73,7 +89,7 @@ class PythonIncrementalParser(IncrementalParser):
                     self.cur_pos-1, 
                     interactive.parser_state.copy(), 
                     self._accepts(interactive),
-                    indent_levels=copy.copy(self.indent_level)
+                    indent_levels=self.indent_level
                 )
         except lark.exceptions.UnexpectedToken as e:
             self._handle_parsing_error(lexer_tokens, token)
@@ -93,14 +109,14 @@ class PythonIncrementalParser(IncrementalParser):
         else:
             # Although this is a complete terminal, it may happen that this may be just prefix of some other terminal
             # e.g., 'de' may seem like a variable name that is complete, but it may be just a prefix of 'def'
-            current_term_str = self.parsed_lexer_tokens[-1].value
+            current_term_str = self.parsed_lexer_tokens.peek().value
             remainder_state = RemainderState.MAYBE_COMPLETE
-            final_terminal = self.parsed_lexer_tokens[-1].type
+            final_terminal = self.parsed_lexer_tokens.peek().type
 
         next_ac_indents = None
         if remainder_state == RemainderState.MAYBE_COMPLETE or remainder_state == RemainderState.COMPLETE:
-            if self.parsed_lexer_tokens[-1].type == '_NL':
-                last_indent_str = self.parsed_lexer_tokens[-1].value.split('\n')[-1]
+            if self.parsed_lexer_tokens.peek().type == '_NL':
+                last_indent_str = self.parsed_lexer_tokens.peek().value.split('\n')[-1]
                 last_indent = last_indent_str.count(' ') + last_indent_str.count('\t') * self.tab_len
                 next_ac_indents = [indent-last_indent for indent in self.indent_level if indent >= last_indent]
 
@@ -111,9 +127,9 @@ class PythonIncrementalParser(IncrementalParser):
                 else:  
                     next_ac_indents = IndentationConstraint(accept_indents=next_ac_indents)  
 
-                # '_NL' is always accepted in this case
-                self.cur_ac_terminals.add('_NL')
-                self.next_ac_terminals.add('_NL') 
+                # '_NL' is always accepted in this case. The accept sets are shared with the stored parser states, so they are not modified in place
+                self.cur_ac_terminals = self.cur_ac_terminals | {'_NL'}
+                self.next_ac_terminals = self.next_ac_terminals | {'_NL'}
 
         else: # Since current terminal is incomplete, next token should add to current terminal
             self.cur_ac_terminals = self.next_ac_terminals
@@ -121,30 +137,37 @@ class PythonIncrementalParser(IncrementalParser):
 
         return ParseResult.from_accept_terminals(self.cur_ac_terminals, self.next_ac_terminals, current_term_str, remainder_state, next_ac_indents=next_ac_indents, final_terminal=final_terminal, ignore_terminals=self.base_parser.lexer_conf.ignore)
 
-    def _update_indent_levels(self, indent_level, indent):
+    def _update_indent_levels(self, indent_level: PersistentStack, indent) -> PersistentStack:
         # if self.cur_pos != len(lexer_tokens): # Store previous indentation levels except the last one
-        if indent > indent_level[-1]:
-            indent_level.append(indent)
+        if indent > indent_level.peek():
+            indent_level = indent_level.push(indent)
         else:
-            while indent < indent_level[-1]:
-                indent_level.pop()
+            while indent < indent_level.peek():
+                indent_level = indent_level.drop(1)
+        return indent_level
 
-    def _lex_code(self, code: str) -> Iterable[Token]:
+    def _lex_code(self, code: str) -> LexerTokens:
         # Collect Lexer tokens
-        lexer_tokens: Iterable[Token] = []
         interactive = self.base_parser.parse_interactive(code)
         lexer_state = interactive.lexer_thread.state
         indenter: PythonIndenter = self.base_parser.lexer_conf.postlex
+        # PostLexConnector -> BasicLexer
+        blexer = interactive.lexer_thread.lexer.lexer
 
-        # Reset the indentation level
+        # Resume from the lexer checkpoint with the indentation level at the checkpoint
         lexing_start_time = time.time()
-        indenter.indent_level, indenter.paren_level = [0], 0
+        checkpoint = self._resume_lexing(code, lexer_state)
+        lexer_tokens = checkpoint.tokens.prefix(len(checkpoint.tokens))
+        lexed_tokens = [] # (start position, token, number of lexer tokens, indenter state) for the tokens lexed after the checkpoint
+        if checkpoint.postlex_state is not None:
+            indent_level, paren_level = checkpoint.postlex_state
+            indenter.indent_level, indenter.paren_level = list(indent_level), paren_level
+        else:
+            indenter.indent_level, indenter.paren_level = [0], 0
 
         try:
             while lexer_state.line_ctr.char_pos < len(lexer_state.text):
-                # PostLexConnector -> BasicLexer
-                blexer = interactive.lexer_thread.lexer.lexer
-                
+                start_pos = lexer_state.line_ctr.char_pos
                 token = blexer.next_token(lexer_state)
                 self.lexer_pos = lexer_state.line_ctr.char_pos
                 
@@ -158,11 +181,13 @@ class PythonIncrementalParser(IncrementalParser):
                 elif token.type in indenter.CLOSE_PAREN_types:
                         indenter.paren_level -= 1
                         assert indenter.paren_level >= 0
+                lexed_tokens.append((start_pos, token, len(lexer_tokens), (tuple(indenter.indent_level), indenter.paren_level)))
         except lark.exceptions.UnexpectedCharacters as e: 
             pass # This may happen when the partial code has an ignore terminal
         except EOFError as e:
             pass
 
+        self._advance_lexer_checkpoint(code, blexer, lexer_tokens, lexed_tokens)
         self.logger.log_time(f'Time taken for lexing:{time.time() - lexing_start_time}')
         return lexer_tokens
 
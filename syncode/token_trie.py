@@ -0,0 +1,66 @@
+from typing import Dict, Iterable, List, Tuple
+
+
+class TokenTrie:
+    """
+    Prefix trie over a set of strings (usually the tokenizer vocabulary). Each string is stored with an integer id (usually the token id).
+
+    The trie is used to walk a DFA over all the strings at once. The walk is shared by all strings with a common prefix and once the DFA reaches a dead state, the whole subtree below the current node can be skipped.
+    """
+    def __init__(self, strings: Iterable[Tuple[int, str]]):
+        self.strings: Dict[int, str] = {}
+        self.children: List[Dict[str, int]] = [{}] # children[node] maps a character to the child node
+        self.depth: List[int] = [0] # Length of the prefix represented by the node
+        self.ends_at: List[List[int]] = [[]] # Ids of the strings that end exactly at the node
+
+        for idx, s in strings:
+            self.strings[idx] = s
+            node = self.root
+            for ch in s:
+                child = self.children[node].get(ch)
+                if child is None:
+                    child = len(self.children)
+                    self.children[node][ch] = child
+                    self.children.append({})
+                    self.depth.append(self.depth[node] + 1)
+                    self.ends_at.append([])
+                node = child
+            self.ends_at[node].append(idx)
+
+        self._compute_subtree_ranges()
+
+    @property
+    def root(self) -> int:
+        return 0
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+    def num_nodes(self) -> int:
+        return len(self.children)
+
+    def _compute_subtree_ranges(self):
+        """
+        Lays out the string ids in DFS order so that the strings of any subtree are a contiguous slice.
+        """
+        num_nodes = len(self.children)
+        self._dfs_order: List[int] = []
+        self._start: List[int] = [0] * num_nodes
+        self._end: List[int] = [0] * num_nodes
+
+        stack = [(self.root, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                self._end[node] = len(self._dfs_order)
+                continue
+            self._start[node] = len(self._dfs_order)
+            self._dfs_order.extend(self.ends_at[node])
+            stack.append((node, True))
+            stack.extend((child, False) for child in self.children[node].values())
+
+    def subtree_strings(self, node: int) -> List[int]:
+        """
+        Returns the ids of all strings that have the prefix represented by the node.
+        """
+        return self._dfs_order[self._start[node]:self._end[node]]
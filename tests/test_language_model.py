@@ -1,4 +1,4 @@
-import sys, os
+import sys, os, threading, time
 from typing import Dict
 import torch
 from transformers import BatchEncoding
@@ -6,7 +6,9 @@ from transformers import BatchEncoding
 from syncode.infer import Syncode
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
 import syncode.common as common
-from syncode.language_model import HuggingFaceModel
+from syncode.language_model import HuggingFaceModel, KeywordsStoppingCriteria
+from syncode.grammar_decoder import GrammarDecoder
+from syncode.parsers import create_parser
 from syncode.parsers.grammars.grammar import Grammar
 from transformers.generation.utils import GenerationMode
 from transformers.generation.configuration_utils import  PretrainedConfig
@@ -19,9 +21,11 @@ class TestModel(GenerationMixin):
     def __init__(self) -> None:
         self.device = 'cpu'
         self.config = PretrainedConfig()
+        self.attention_mask = None # Attention mask of the last call
     
     def __call__(self, input_ids: torch.Tensor, attention_mask:torch.Tensor=None, past_key_values=None) -> CausalLMOutputWithPast:
-        output_logits = torch.randn(1, 1, 20)
+        self.attention_mask = attention_mask
+        output_logits = torch.randn(input_ids.size(0), 1, 20)
         return CausalLMOutputWithPast(
             logits=output_logits,
             past_key_values=None,
@@ -34,6 +38,24 @@ class TestModel(GenerationMixin):
     def _get_generation_mode(self, a, b) -> GenerationMode:
         return GenerationMode.GREEDY_SEARCH
 
+class TestDeterministicModel(TestModel):
+    """
+    TestModel whose logits only depend on the input ids of the row, so the greedy completions do not depend on the number of calls.
+    """
+    def __init__(self, delay: float = 0) -> None:
+        super().__init__()
+        self.num_calls = 0
+        self.delay = delay # Time of the forward pass in seconds
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask:torch.Tensor=None, past_key_values=None) -> CausalLMOutputWithPast:
+        self.num_calls += 1
+        time.sleep(self.delay)
+        output_logits = torch.stack([torch.randn(1, 20, generator=torch.Generator().manual_seed(hash(tuple(ids.tolist())) % 2**31)) for ids in input_ids])
+        return CausalLMOutputWithPast(
+            logits=output_logits,
+            past_key_values=None,
+            )
+
 class TestTokenizer:
     def __init__(self) -> None:
         vocab = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '+', '-', '*', '/', '(', ')', ' ', '\n', '\t', '=']
@@ -50,10 +72,26 @@ class TestTokenizer:
     
     def decode(self, token_ids, skip_special_tokens=False):
         return ''.join([self.vocab[i] for i in token_ids])
+
+    def batch_decode(self, token_ids, skip_special_tokens=False):
+        return [self.decode(ids, skip_special_tokens=skip_special_tokens) for ids in token_ids]
     
     def get_vocab(self) -> Dict[str, int]:
         return {v: i for i, v in enumerate(self.vocab)}
 
+class TestMaskTokenizer(TestTokenizer):
+    """
+    TestTokenizer with the attributes needed for creating the DFA mask store.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.vocab_size = len(self.vocab)
+        self.eos_token_id = self.vocab.index('=')
+        self.name_or_path = 'TestMaskTokenizer'
+
+    def encode(self, s: str, return_tensors="pt"):
+        return torch.tensor([[self.vocab.index(c) for c in s]])
+
 class TestHuggingFaceModel(unittest.TestCase):
     def test_generate_batch_completion_grammar(self):
         torch.manual_seed(0)
@@ -76,6 +114,189 @@ class TestHuggingFaceModel(unittest.TestCase):
         self.assertEqual(len(output[0]), 15, "The output length does not match the expected value.")
         self.assertEqual(len(output[1]), 15, "The output length does not match the expected value.")
     
+    def test_keywords_stopping_criteria(self):
+        tokenizer = TestTokenizer()
+        stop_criterion = KeywordsStoppingCriteria(tokenizer, stop_words=['\n\n', '+1'])
+        input_ids = torch.tensor([[tokenizer.vocab.index(c) for c in code] for code in ['12\n\n', '1+12', '2+1\n', '\n\n12']])
+        is_done = stop_criterion(input_ids, None)
+        self.assertEqual(is_done.tolist(), [True, False, False, False])
+        is_done = stop_criterion(input_ids[:, :-1], None)
+        self.assertEqual(is_done.tolist(), [False, True, True, False])
+
+    def test_keywords_stopping_criteria_multi_byte(self):
+        # Stop words with multi-byte characters that are split over byte fallback tokens, also after other byte fallback tokens
+        import json
+        from tokenizers import Tokenizer, decoders, models, normalizers, trainers
+        from transformers import PreTrainedTokenizerFast
+        tokenizer = Tokenizer(models.BPE(byte_fallback=True, unk_token='<unk>'))
+        tokenizer.normalizer = normalizers.Sequence([normalizers.Prepend('▁'), normalizers.Replace(' ', '▁')])
+        tokenizer.decoder = decoders.Sequence([decoders.Replace('▁', ' '), decoders.ByteFallback(), decoders.Fuse(), decoders.Strip(' ', 1, 0)])
+        tokenizer.train_from_iterator(['def f(x):\n    return x + 1\n'] * 10, trainers.BpeTrainer(vocab_size=300, special_tokens=['<unk>', '<eos>'] + [f'<0x{i:02X}>' for i in range(256)]))
+        config = json.loads(tokenizer.to_str())
+        for added_token in config['added_tokens']:
+            added_token['special'] = added_token['content'] in ('<unk>', '<eos>')
+        tokenizer = PreTrainedTokenizerFast(tokenizer_object=Tokenizer.from_str(json.dumps(config)), eos_token='<eos>', unk_token='<unk>')
+
+        stop_words = ['終わり', '🎉', '\n\n']
+        stop_criterion = KeywordsStoppingCriteria(tokenizer, stop_words=stop_words)
+        for text in ['return x 你好世界終わり', 'def f(x): ö🎉 终 ', 'x + 1 😀😀\n\nreturn 終わ']:
+            token_ids = tokenizer.encode(text)
+            for n in range(1, len(token_ids)+1):
+                is_done = stop_criterion(torch.tensor([token_ids[:n]]), None)
+                full_text = tokenizer.decode(token_ids[:n], skip_special_tokens=True)
+                self.assertEqual(is_done.tolist(), [any(full_text.endswith(stop_word) for stop_word in stop_words)], full_text)
+        self.assertTrue(stop_criterion(torch.tensor([tokenizer.encode('你好世界終わり')]), None).item())
+
+    def test_generate_batch_stop_words(self):
+        torch.manual_seed(0)
+        model = TestModel()
+        tokenizer = TestMaskTokenizer()
+        logger = common.EmptyLogger()
+        lm = HuggingFaceModel(model, Grammar('calc'), logger, tokenizer, mode='original', max_new_tokens=15, device='cpu')
+        prompt = "113 + 235 + 17"
+        output = lm.generate_batch_completion_grammar(prompt, 4, stop_words=['\n'])
+        self.assertEqual(len(output), 4)
+        for completion in output:
+            # Each row stops at its first stop word or eos token '=' and the finished rows are padded with the eos token
+            end = min([completion.index(c)+1 for c in '\n=' if c in completion], default=len(completion))
+            self.assertTrue(all(c == '=' for c in completion[end:]))
+        self.assertTrue(any(completion.rstrip('=').endswith('\n') for completion in output))
+
+        # The padding is not attended to in the last forward pass
+        attention_mask = model.attention_mask
+        for row, completion in enumerate(output):
+            end = len(prompt) + min([completion.index(c)+1 for c in '\n=' if c in completion], default=len(completion))
+            self.assertTrue(attention_mask[row, :end].all())
+            self.assertFalse(attention_mask[row, end:].any())
+
+    def test_generate_batch_completion_grammar_mask(self):
+        torch.manual_seed(0)
+        model = TestModel()
+        tokenizer = TestMaskTokenizer()
+        logger = common.EmptyLogger()
+        grammar = Grammar('calc')
+        grammar_decoder = GrammarDecoder(grammar, tokenizer, logger, num_samples=3)
+        lm = HuggingFaceModel(model, grammar, logger, tokenizer, grammar_decoder=grammar_decoder, mode='grammar_mask', max_new_tokens=15, device='cpu')
+        prompt = "113 + 235 + 17"
+        output = lm.generate_batch_completion_grammar(prompt, 3)
+        self.assertEqual(len(output), 3)
+        for completion in output:
+            # The completions stop at the eos token '=' and the rest is syntactically valid
+            code = prompt + completion.split('=')[0]
+            inc_parser = create_parser(grammar)
+            inc_parser.get_acceptable_next_terminals(code)
+        self.assertGreater(grammar_decoder.parser_pool.num_parses, 0)
+
+    def test_jump_forward(self):
+        model = TestDeterministicModel()
+        tokenizer = TestMaskTokenizer()
+        logger = common.EmptyLogger()
+        # '+' and ')' are the only acceptable tokens after the numbers
+        grammar = Grammar('start: pair+\npair: "(" DIGIT "+" DIGIT ")"\nDIGIT: /[0-9]/\n')
+        grammar_decoder = GrammarDecoder(grammar, tokenizer, logger, num_samples=2)
+        prompt = "(1+2)"
+
+        lm = HuggingFaceModel(model, grammar, logger, tokenizer, grammar_decoder=grammar_decoder, mode='grammar_mask', max_new_tokens=15, device='cpu')
+        output = lm.generate_batch_completion_grammar(prompt, 2)
+        num_calls = model.num_calls
+
+        model.num_calls = 0
+        lm = HuggingFaceModel(model, grammar, logger, tokenizer, grammar_decoder=grammar_decoder, mode='grammar_mask', max_new_tokens=15, device='cpu', jump_forward=True)
+        jump_output = lm.generate_batch_completion_grammar(prompt, 2)
+
+        self.assertEqual(output, jump_output)
+        self.assertGreater(lm.num_saved_forward_passes, 0)
+        self.assertEqual(model.num_calls, num_calls - lm.num_saved_forward_passes)
+
+    def test_forced_tokens(self):
+        # The forced token of a row is the only token in its accept mask
+        tokenizer = TestMaskTokenizer()
+        logger = common.EmptyLogger()
+        grammar = Grammar('start: pair+\npair: "(" DIGIT "+" DIGIT ")"\nDIGIT: /[0-9]/\n')
+        codes = ['1', '1+', '1+2', '1+2)', '1+2)(', '1+2)(3', '1+2)(3+4)']
+        input_ids = [tokenizer.encode('(' + code)[0] for code in codes]
+        decoder = GrammarDecoder(grammar, tokenizer, logger, num_samples=len(codes))
+        decoder.reset('(')
+        forced_tokens = [decoder.get_forced_tokens(ids.unsqueeze(0), rows=[idx])[0] for idx, ids in enumerate(input_ids)]
+        for idx, ids in enumerate(input_ids):
+            decoder.reset('(')
+            accepted_tokens = torch.nonzero(torch.isfinite(decoder(ids.unsqueeze(0), torch.zeros(1, 20), rows=[idx])[0])).flatten().tolist()
+            self.assertEqual(forced_tokens[idx], accepted_tokens[0] if len(accepted_tokens) == 1 else None, codes[idx])
+        self.assertEqual([tokenizer.vocab[token] if token is not None else None for token in forced_tokens], ['+', None, ')', None, None, '+', None])
+
+    def test_overlap_masking(self):
+        model = TestDeterministicModel(delay=0.02)
+        tokenizer = TestMaskTokenizer()
+        logger = common.EmptyLogger()
+        grammar = Grammar('calc')
+        grammar_decoder = GrammarDecoder(grammar, tokenizer, logger, num_samples=2)
+        prompt = "113 + 235 + 17"
+
+        lm = HuggingFaceModel(model, grammar, logger, tokenizer, grammar_decoder=grammar_decoder, mode='grammar_mask', max_new_tokens=15, device='cpu')
+        output = lm.generate_batch_completion_grammar(prompt, 2)
+
+        lm = HuggingFaceModel(model, grammar, logger, tokenizer, grammar_decoder=grammar_decoder, mode='grammar_mask', max_new_tokens=15, device='cpu', overlap_masking=True)
+
+        num_threads = threading.active_count()
+        overlap_output = lm.generate_batch_completion_grammar(prompt, 2)
+
+        self.assertEqual(output, overlap_output)
+        # The masks of the rows whose greedy token is not valid were computed during the forward pass
+        self.assertGreater(grammar_decoder.num_prepared_mask_hits, 0)
+        # The worker thread does not outlive the generation
+        self.assertEqual(threading.active_count(), num_threads)
+
+    def test_prepare_masks_stop(self):
+        # The row that is parsed when the masks are needed is not prepared and it is masked as without prepare_masks
+        class StopAfterCalls(threading.Event):
+            def __init__(self, num_calls):
+                super().__init__()
+                self.num_calls = num_calls
+            def is_set(self):
+                self.num_calls -= 1
+                return self.num_calls < 0
+
+        tokenizer = TestMaskTokenizer()
+        logger = common.EmptyLogger()
+        input_ids = torch.tensor([[1, 10, 2], [1, 10, 14]])
+        scores = torch.randn(2, 20)
+        decoder = GrammarDecoder(Grammar('calc'), tokenizer, logger, num_samples=2)
+        decoder.reset('')
+        expected_scores = decoder(input_ids, scores.clone())
+
+        for num_calls, num_prepared_masks in [(0, 0), (1, 0), (2, 1), (3, 1), (4, 2)]:
+            decoder.reset('')
+            decoder.prepare_masks(input_ids, stop_event=StopAfterCalls(num_calls))
+            self.assertEqual(decoder.num_prepared_masks, num_prepared_masks)
+            self.assertTrue(torch.equal(decoder(input_ids, scores.clone()), expected_scores))
+            self.assertEqual((decoder.num_prepared_mask_hits, decoder.num_prepared_mask_misses), (num_prepared_masks, 2 - num_prepared_masks))
+
+    def test_grammar_decoder_batch_mask(self):
+        tokenizer = TestMaskTokenizer()
+        logger = common.EmptyLogger()
+        prompt = "1+"
+        input_ids = torch.tensor([[1, 10, 2], [1, 10, 14], [1, 10, 10], [1, 10, 2]])
+        # The scores are longer than the vocab as for the models with padded embeddings
+        scores = torch.randn(4, 24)
+
+        grammar_decoder = GrammarDecoder(Grammar('calc'), tokenizer, logger, num_samples=4, parse_output_only=True)
+        grammar_decoder.reset(prompt)
+        # The parse results of the masked rows are only logged in the dev mode, the rows without acceptable tokens are always reported
+        logged_codes = []
+        grammar_decoder._log_current_status = lambda partial_code, r: logged_codes.append(partial_code)
+        batch_scores = grammar_decoder(input_ids, scores.clone())
+        self.assertEqual(logged_codes, ['+'])
+
+        single_decoder = GrammarDecoder(Grammar('calc'), tokenizer, logger, num_samples=1, parse_output_only=True)
+        for idx in range(input_ids.size(0)):
+            single_decoder.reset(prompt)
+            row_scores = single_decoder(input_ids[idx:idx+1], scores[idx:idx+1].clone())
+            self.assertTrue(torch.equal(batch_scores[idx:idx+1], row_scores))
+
+        self.assertTrue(torch.isinf(batch_scores[0, 20:]).all())
+        # '1++' can not be parsed, so its scores are not masked
+        self.assertTrue(torch.equal(batch_scores[2], scores[2]))
+
     @unittest.skip("Only for local testing")
     def test_stop_word(self):
         torch.manual_seed(0)
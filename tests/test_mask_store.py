@@ -0,0 +1,256 @@
+import unittest
+import gc, sys, os, random, tempfile
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
+import interegular
+import torch
+from syncode.dfa_mask_store import _incomplete_lazy_stores, DFAMaskStore, DFAs, DFAState, LookupTable, RemainderDFAStates
+from syncode.parse_result import AcceptSequence, IndentationConstraint, RemainderState, ParseResult
+from syncode.parsers import create_base_parser
+from syncode.parsers.grammars.grammar import Grammar
+
+# Small vocabulary so that the naive construction is fast enough for the tests
+vocab = ['</s>', '', ' ', '  ', '    ', '\t', '\n', '\n\n', '\n\t', '\n    ', '(', ')', '()', '):', ':', ',', ', ', '.', '=', ' =', '==', '+', ' +', ' +=', '++', '-', '*', '**', '/', '//', '#', '# ', '"', '""', '"""', "'", "''", "'''", ' "', "'.", ' \'.',
+         '0', '1', '12', '1.', '.5', '0x', '1e', 'e1', 'a', 'b', 'x', ' x', 'ab', 'num', ' num', 'int', ' int', 'def', ' def', 'de', 'if', ' if', 'in', ' in', 'ing', 'for', ' for', 'return', ' return', 'ret', 'True', 'None', 'print', '(x', 'x)', 'a,', '[]', '[', ']', '{', '}', 'ab c', '\\', '\\n', ' \\', 'é', '∀']
+
+class TestLookupTable(unittest.TestCase):
+    def test_masks_union(self):
+        vocab = [str(i) for i in range(200)]
+        lookup = LookupTable(vocab, special_token_ids=[])
+        token_sets = [[0, 63, 64, 199], [1, 62, 63, 127, 128], [], [5], list(range(0, 200, 3))]
+        rows = [lookup._add_mask(lookup._tokens_to_words(tokens)) for tokens in token_sets]
+
+        for tokens, row in zip(token_sets, rows):
+            self.assertEqual(lookup.masks_union([row]).nonzero().flatten().tolist(), sorted(tokens))
+        self.assertFalse(lookup.masks_union([]).any())
+        for num_rows in range(1, len(rows) + 1):
+            # Repeated rows do not change the union
+            expected = sorted({token for tokens in token_sets[:num_rows] for token in tokens})
+            mask = lookup.masks_union(rows[:num_rows] + rows[:1])
+            self.assertEqual(mask.shape, (len(vocab),))
+            self.assertEqual(mask.nonzero().flatten().tolist(), expected)
+
+    def test_mask_dedup(self):
+        vocab = [str(i) for i in range(200)]
+        lookup = LookupTable(vocab, special_token_ids=[])
+        rows = [lookup._add_mask(lookup._tokens_to_words(tokens)) for tokens in [[1, 2], [3], [2, 1], [3], [], []]]
+        self.assertEqual(rows, [0, 1, 0, 1, 2, 2])
+        self.assertEqual(lookup.dedup_stats()['masks'], 6)
+        self.assertEqual(lookup.dedup_stats()['unique_masks'], 3)
+        self.assertEqual(lookup.dedup_stats()['dedup_ratio'], 2)
+
+
+class TestDFAs(unittest.TestCase):
+    @staticmethod
+    def _fsm_consume_prefix(dfa, state_id, input_str):
+        # Walks the interegular FSM directly
+        longest_accept_index = 0 if state_id in dfa.finals else -1
+        for i, symbol in enumerate(input_str):
+            if symbol not in dfa.alphabet:
+                symbol = interegular.fsm.anything_else
+            if symbol not in dfa.alphabet or dfa.alphabet[symbol] not in dfa.map.get(state_id, {}):
+                state_id = None
+                break
+            state_id = dfa.map[state_id][dfa.alphabet[symbol]]
+            if state_id in dfa.finals:
+                longest_accept_index = i+1
+        if longest_accept_index != -1:
+            return (True, input_str[longest_accept_index:]), state_id
+        if state_id is not None and dfa.islive(state_id):
+            return (True, ''), state_id
+        return (False, None), state_id
+
+    def test_dense_dfa_walks(self):
+        random.seed(0)
+        strings = vocab + [''.join(random.choices(vocab, k=3)) for _ in range(100)] + ['"""Docstring é ∀ """', "x = 'a\\'b'", '0x1f + 1e10']
+        for grammar_name in ['python', 'go']:
+            grammar = Grammar(grammar_name)
+            dfas = DFAs(create_base_parser(grammar).terminals, grammar.simplifications())
+            for s in strings:
+                expected_dfa_states = []
+                for terminal in dfas._terminals_to_dfa:
+                    dfa = dfas.dfa(terminal)
+                    _, state_id = self._fsm_consume_prefix(dfa, dfa.initial, s)
+                    # compute_dfa_states only stops at missing transitions
+                    if state_id is not None:
+                        expected_dfa_states.append(DFAState(terminal, state_id))
+                self.assertEqual(dfas.compute_dfa_states(s), expected_dfa_states, s)
+
+            for dfa_state in dfas.states():
+                dfa = dfas.dfa(dfa_state.terminal)
+                self.assertEqual(dfas.is_final(dfa_state), dfa_state.state_id in dfa.finals)
+                for s in strings:
+                    self.assertEqual(dfas.consume_prefix(dfa_state, s), self._fsm_consume_prefix(dfa, dfa_state.state_id, s)[0], (dfa_state, s))
+
+    def test_incremental_dfa_states(self):
+        grammar = Grammar('python')
+        dfas = DFAs(create_base_parser(grammar).terminals, grammar.simplifications())
+        prev = RemainderDFAStates()
+        # The remainder grows in a docstring and a name, and it is reset in between
+        remainders = ['"', '"""', '"""Ret', '"""Returns the', '"""Returns the sum é', '"""Returns the sum é\n', 'x', 'x_1', 'x_12', '1', '1.', '1.5e', 'x']
+        for remainder in remainders:
+            self.assertEqual(dfas.compute_dfa_states(remainder, prev), dfas.compute_dfa_states(remainder), remainder)
+        self.assertEqual(prev.num_full_walks, 4)
+        self.assertEqual(prev.num_incremental_walks, len(remainders) - 4)
+
+
+class TestMaskStoreConstruction(unittest.TestCase):
+    @staticmethod
+    def _build(grammar, **kwargs):
+        base_parser = create_base_parser(grammar)
+        return DFAMaskStore(base_parser.terminals, vocab, simplifications=grammar.simplifications(), special_token_ids=[0], ignore_terminals=base_parser.ignore_tokens, **kwargs)
+
+    def _assert_same_lookups(self, grammar_name, mode, num_workers=1, shard_cache_dir=None):
+        grammar = Grammar(grammar_name)
+        trie_lookup = self._build(grammar, mode=mode, num_workers=num_workers, shard_cache_dir=shard_cache_dir)._lookup_table
+        naive_lookup = self._build(grammar, mode=mode, use_trie=False)._lookup_table
+        self._assert_same_lookup_tables(trie_lookup, naive_lookup)
+
+    def _assert_same_lookup_tables(self, trie_lookup, naive_lookup):
+        for name in ['_dfa_state_and_next_terminal_to_tokens', '_exact_lookup', '_overapprox_lookup']:
+            trie_table, naive_table = getattr(trie_lookup, name), getattr(naive_lookup, name)
+            self.assertEqual(set(trie_table.keys()), set(naive_table.keys()), f"Keys of {name} do not match")
+            for key in naive_table:
+                self.assertTrue(torch.equal(trie_lookup.masks_union([trie_table[key]]), naive_lookup.masks_union([naive_table[key]])), f"{name}[{key}] does not match")
+
+    def test_trie_construction_calc(self):
+        self._assert_same_lookups('calc', 'grammar_mask')
+
+    def test_trie_construction_python(self):
+        self._assert_same_lookups('python', 'grammar_mask')
+
+    def test_trie_construction_python_strict(self):
+        self._assert_same_lookups('python', 'grammar_strict')
+
+    def test_trie_construction_go(self):
+        self._assert_same_lookups('go', 'grammar_mask')
+
+    def test_parallel_construction_python(self):
+        self._assert_same_lookups('python', 'grammar_mask', num_workers=3)
+
+    def test_terminal_shard_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self._assert_same_lookups('python', 'grammar_mask', shard_cache_dir=cache_dir + '/')
+            num_shards = len(os.listdir(cache_dir))
+            self.assertGreater(num_shards, 0)
+
+            # All shards are loaded from the cache, the strict mode uses the same shards
+            self._assert_same_lookups('python', 'grammar_mask', shard_cache_dir=cache_dir + '/')
+            self._assert_same_lookups('python', 'grammar_strict', shard_cache_dir=cache_dir + '/')
+            self.assertEqual(len(os.listdir(cache_dir)), num_shards)
+
+    def test_terminal_shard_cache_grammar_edit(self):
+        grammar = Grammar('calc')
+        edited_grammar = Grammar(grammar.ebnf.replace('?factor: NUMBER        -> number', '?factor: NUMBER        -> number\n       | HEX') + '\nHEX: /0x[0-9a-f]+/\n')
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self._build(grammar, shard_cache_dir=cache_dir + '/')
+            num_shards = len(os.listdir(cache_dir))
+
+            # Only the new terminal is built
+            lookup = self._build(edited_grammar, shard_cache_dir=cache_dir + '/')._lookup_table
+            self.assertEqual(len(os.listdir(cache_dir)), num_shards + 1)
+            self._assert_same_lookup_tables(lookup, self._build(edited_grammar, use_trie=False)._lookup_table)
+
+    def test_accept_mask(self):
+        grammar = Grammar('python')
+        base_parser = create_base_parser(grammar)
+        mask_store = DFAMaskStore(base_parser.terminals, vocab, simplifications=grammar.simplifications(), special_token_ids=[0], ignore_terminals=base_parser.ignore_tokens)
+        r = ParseResult({AcceptSequence(['NAME', 'LPAR'])}, 'print', RemainderState.MAYBE_COMPLETE)
+        ac_list = mask_store.get_accept_mask(r, get_list=True)
+        self.assertIn('()', ac_list)
+        self.assertIn('ing', ac_list)
+        self.assertNotIn(' num', ac_list)
+
+    def test_lazy_build_all_python(self):
+        grammar = Grammar('python')
+        lazy_mask_store = self._build(grammar, lazy=True)
+        self.assertEqual(len(lazy_mask_store._lookup_table._overapprox_lookup), 0)
+        self.assertIn(lazy_mask_store, _incomplete_lazy_stores)
+        lazy_mask_store.build_all()
+        # The complete store is not flushed again at exit
+        self.assertNotIn(lazy_mask_store, _incomplete_lazy_stores)
+        self._assert_same_lookup_tables(lazy_mask_store._lookup_table, self._build(grammar)._lookup_table)
+
+    def test_lazy_store_garbage_collected(self):
+        gc.collect()
+        num_stores = len(_incomplete_lazy_stores)
+        lazy_mask_store = self._build(Grammar('calc'), lazy=True)
+        self.assertEqual(len(_incomplete_lazy_stores), num_stores + 1)
+        del lazy_mask_store
+        gc.collect()
+        self.assertEqual(len(_incomplete_lazy_stores), num_stores)
+
+    def test_lazy_build_all_go_strict(self):
+        grammar = Grammar('go')
+        lazy_mask_store = self._build(grammar, mode='grammar_strict', lazy=True)
+        lazy_mask_store.build_all()
+        self._assert_same_lookup_tables(lazy_mask_store._lookup_table, self._build(grammar, mode='grammar_strict')._lookup_table)
+
+    def _assert_same_accept_masks(self, mask_store, expected_mask_store, parse_results):
+        for r in parse_results:
+            self.assertTrue(torch.equal(mask_store.get_accept_mask(r), expected_mask_store.get_accept_mask(r)), f"Accept masks do not match for {r}")
+
+    def test_lazy_accept_mask(self):
+        grammar = Grammar('python')
+        parse_results = [
+            ParseResult({AcceptSequence(['NAME', 'LPAR'])}, 'print', RemainderState.MAYBE_COMPLETE),
+            ParseResult({AcceptSequence(['NAME', 'LPAR']), AcceptSequence(['NAME', 'DOT'])}, 'x', RemainderState.MAYBE_COMPLETE),
+            ParseResult({AcceptSequence(['STRING'])}, '"abc', RemainderState.INCOMPLETE),
+            ParseResult({AcceptSequence(['DEC_NUMBER'])}, '12', RemainderState.MAYBE_COMPLETE),
+            ParseResult({AcceptSequence(['RPAR'])}, ')', RemainderState.COMPLETE),
+        ]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            lazy_mask_store = self._build(grammar, lazy=True, shard_cache_dir=cache_dir + '/', flush_interval=1)
+            eager_mask_store = self._build(grammar)
+            self._assert_same_accept_masks(lazy_mask_store, eager_mask_store, parse_results)
+            self.assertGreater(len(os.listdir(cache_dir)), 0)
+
+            # The walks are flushed to the cache, thus another lazy store does not walk the vocabulary again
+            lazy_mask_store = self._build(grammar, lazy=True, shard_cache_dir=cache_dir + '/')
+            self._assert_same_accept_masks(lazy_mask_store, eager_mask_store, parse_results)
+            self.assertIsNone(lazy_mask_store._walker)
+
+            # An eager store completes the partial shards
+            lookup = self._build(grammar, shard_cache_dir=cache_dir + '/')._lookup_table
+            self._assert_same_lookup_tables(lookup, eager_mask_store._lookup_table)
+
+    def test_save_and_load(self):
+        grammar = Grammar('python')
+        mask_store = self._build(grammar)
+        parse_results = [
+            ParseResult({AcceptSequence(['NAME', 'LPAR'])}, 'print', RemainderState.MAYBE_COMPLETE),
+            ParseResult({AcceptSequence(['STRING'])}, '"abc', RemainderState.INCOMPLETE),
+            ParseResult({AcceptSequence(['RPAR'])}, ')', RemainderState.COMPLETE),
+            ParseResult({AcceptSequence(['NAME'])}, 'x', RemainderState.MAYBE_COMPLETE, next_ac_indents=IndentationConstraint(accept_indents=[4])),
+        ]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = cache_dir + '/mask_store.bin'
+            mask_store.save(path)
+            loaded_mask_store = DFAMaskStore.load(path)
+            self._assert_same_lookup_tables(loaded_mask_store._lookup_table, mask_store._lookup_table)
+            self._assert_same_accept_masks(loaded_mask_store, mask_store, parse_results)
+            self.assertEqual(loaded_mask_store._vocab, vocab)
+            self.assertEqual(loaded_mask_store._lookup_table.dedup_stats(), mask_store._lookup_table.dedup_stats())
+            self.assertGreater(mask_store._lookup_table.dedup_stats()['dedup_ratio'], 1)
+
+            # Files with another version are rejected
+            with open(path, 'r+b') as f:
+                f.seek(8)
+                f.write((DFAMaskStore.FILE_VERSION + 1).to_bytes(4, 'little'))
+            with self.assertRaises(ValueError):
+                DFAMaskStore.load(path)
+
+    def test_accept_mask_cache(self):
+        grammar = Grammar('python')
+        mask_store = self._build(grammar, accept_mask_cache_size=2)
+        uncached_mask_store = self._build(grammar, accept_mask_cache_size=0)
+        r1 = ParseResult({AcceptSequence(['NAME', 'LPAR'])}, 'print', RemainderState.MAYBE_COMPLETE)
+        r2 = ParseResult({AcceptSequence(['NAME', 'LPAR'])}, 'len', RemainderState.MAYBE_COMPLETE) # Same DFA states as r1
+        r3 = ParseResult({AcceptSequence(['NAME'])}, 'x', RemainderState.MAYBE_COMPLETE, next_ac_indents=IndentationConstraint(accept_indents=[4, 0]))
+        r4 = ParseResult({AcceptSequence(['NAME'])}, 'x', RemainderState.MAYBE_COMPLETE, next_ac_indents=IndentationConstraint(accept_indents=[0, 4]))
+        r5 = ParseResult({AcceptSequence(['STRING'])}, '"abc', RemainderState.INCOMPLETE)
+
+        for r in [r1, r2, r3, r4, r5, r1]:
+            self.assertTrue(torch.equal(mask_store.get_accept_mask(r), uncached_mask_store.get_accept_mask(r)), r)
+        # r2 and r4 are hits, r1 is evicted by r3 and r5
+        self.assertEqual(mask_store.accept_mask_cache_stats(), {'size': 2, 'hits': 2, 'misses': 4, 'hit_rate': 2/6})
+        self.assertEqual(uncached_mask_store.accept_mask_cache_stats()['size'], 0)
@@ -6,8 +6,15 @@ import sys
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
 
 from syncode.parsers import create_parser
-from syncode.parse_result import AcceptSequence
+from syncode.parse_result import AcceptSequence, ParseResult, RemainderState, terminal_id
 from syncode.parsers.grammars.grammar import Grammar
+from syncode.parsers.persistent_state import PersistentStack, RecognizerParserState
+from syncode.parsers.dense_parse_table import DenseParseTable, DenseRecognizerState
+from syncode.parsers.parser_pool import ParserPool
+from syncode.parsers.parser_state_cache import ParserStateCache
+from syncode.larkm.exceptions import UnexpectedToken
+from syncode.larkm.lexer import Token
+from syncode.incremental_detokenizer import IncrementalDetokenizer
 
 class TestParserMisc(unittest.TestCase):
     def test_parser_calc(self):
@@ -52,3 +59,258 @@ Jokes(rina) ⊕ Unaware(rina) ::: Rina is either a person who jokes about being
         partial_code = f"""Predicates:\nPer"""
         r = inc_parser.get_acceptable_next_terminals(partial_code)
         print(r)
+
+    def test_persistent_stack(self):
+        stack = PersistentStack.from_iterable([1, 2, 3])
+        stack2 = stack.push(4)
+        value, stack3 = stack2.pop()
+        self.assertEqual(value, 4)
+        self.assertIs(stack3, stack)
+        self.assertEqual(stack.to_list(), [1, 2, 3])
+        self.assertEqual(list(stack2), [1, 2, 3, 4])
+        self.assertEqual((stack2[-1], stack2[0], len(stack2)), (4, 1, 4))
+        values, rest = stack2.pop_n(3)
+        self.assertEqual((values, rest.to_list()), ([2, 3, 4], [1]))
+        self.assertEqual(stack2.drop(4), PersistentStack())
+        self.assertEqual(stack, PersistentStack.from_iterable([1, 2, 3]))
+        with self.assertRaises(IndexError):
+            PersistentStack().pop()
+
+    def test_parser_snapshots_are_independent(self):
+        # Going back to a shorter prefix restores a stored snapshot that shares its stacks with the later states
+        inc_parser = create_parser(Grammar('python'))
+        codes = ["def f(a):\n    return a", "def f(a):\n    return a + 1\n", "def f(a):\n    if a:\n        return 1\n    return 2\n", "def f(a):\n    return a", "def f(a):\n    if a:\n        return 1\n    "]
+        for code in codes:
+            r = inc_parser.get_acceptable_next_terminals(code)
+            fresh_parser = create_parser(Grammar('python'))
+            r2 = fresh_parser.get_acceptable_next_terminals(code)
+            self.assertEqual(r.accept_sequences, r2.accept_sequences)
+            self.assertEqual(r.remainder, r2.remainder)
+            self.assertEqual(r.remainder_state, r2.remainder_state)
+            self.assertEqual(r.next_ac_indents, r2.next_ac_indents)
+
+    def test_accepts_table(self):
+        # The accepted terminals from the accepts table are the same as trial-feeding the terminals to the parser
+        codes = {
+            'python': 'def f(a, b=1):\n    if a and not b:\n        return [x ** 2 for x in a]\n    return b\n',
+            'go': 'package main\n\nfunc main() {\n\tx := []int{1, 2}\n\tfor i := range x {\n\t\tx[i]++\n\t}\n}\n',
+            'json': '{"a": [1, 2.5, {"b": null}], "c": "d"}',
+            'calc': '113 + 235 * (17 - 2) / 4',
+        }
+        for grammar, code in codes.items():
+            inc_parser = create_parser(Grammar(grammar))
+            inc_parser.get_acceptable_next_terminals(code)
+            interactive = inc_parser.interactive
+            self.assertGreater(len(inc_parser.cur_pos_to_parser_state), 10)
+            for _, parser_state, _, _, _, _ in inc_parser.cur_pos_to_parser_state.values():
+                interactive.parser_state = parser_state.copy()
+                self.assertEqual(inc_parser.accepts_table.accepts(parser_state.state_stack), interactive.accepts())
+            self.assertGreater(inc_parser.accepts_table.num_misses, 0)
+
+    def test_dense_parse_table_cache(self):
+        # A truncated cache file of the dense parse table is replaced by a complete one
+        import glob, pickle
+        import syncode.common as common
+        grammar = Grammar('sql')
+        create_parser(grammar, recognizer=True)
+        dense_cache_filename, = glob.glob(common.SYNCODE_CACHE + f'parsers/{grammar}_lalr_{grammar.hash()}_dense_table.pkl')
+        with open(dense_cache_filename, 'r+b') as f:
+            f.truncate(10)
+        inc_parser = create_parser(grammar, recognizer=True)
+        self.assertIsNotNone(inc_parser.dense_table)
+        with open(dense_cache_filename, 'rb') as f:
+            self.assertIn('base_parser_hash', pickle.load(f))
+        self.assertEqual(glob.glob(dense_cache_filename + '.*.tmp'), [])
+
+    def test_recognizer_parser(self):
+        # The recognizer gives the same results as the parser that builds the parse tree
+        codes = {
+            'python': 'def f(a, b=1):\n    if a and not b:\n        return [x ** 2 for x in a]\n    return b\n',
+            'go': 'package main\n\nfunc main() {\n\tx := []int{1, 2}\n\tfor i := range x {\n\t\tx[i]++\n\t}\n}\n',
+            'sql': 'SELECT a, count(*) FROM t WHERE x > 3 GROUP BY a;',
+        }
+        for grammar, code in codes.items():
+            recognizer, parser = create_parser(Grammar(grammar), recognizer=True), create_parser(Grammar(grammar))
+            for i in range(1, len(code)+1, 3):
+                r, r2 = recognizer.get_acceptable_next_terminals(code[:i]), parser.get_acceptable_next_terminals(code[:i])
+                self.assertEqual((r.accept_sequences, r.remainder, r.remainder_state), (r2.accept_sequences, r2.remainder, r2.remainder_state))
+            self.assertEqual(len(recognizer.interactive.parser_state.value_stack), 0)
+            self.assertGreater(len(parser.interactive.parser_state.value_stack), 0)
+
+    def test_dense_parse_table(self):
+        # The driver on the dense parse table goes through the same parser states as the parse table of the base parser
+        code = 'def f(a, b=1):\n    if a and not b:\n        return [x ** 2 for x in a]\n    return b\n'
+        for parser in ['lalr', 'lr']:
+            inc_parser = create_parser(Grammar('python'), parser=parser, recognizer=True)
+            self.assertIsInstance(inc_parser.interactive.parser_state, DenseRecognizerState)
+            dense_table = DenseParseTable.deserialize(inc_parser.dense_table.serialize())
+            dense_state = DenseRecognizerState.from_parser_state(inc_parser.interactive.parser_state, dense_table)
+            parser_state = RecognizerParserState.from_parser_state(inc_parser.interactive.parser_state)
+            for token in inc_parser._lex_code(code):
+                dense_state.feed_token(token)
+                parser_state.feed_token(token)
+                self.assertEqual(dense_state.state_stack, parser_state.state_stack)
+            with self.assertRaises(UnexpectedToken):
+                dense_state.feed_token(Token('RPAR', ')'))
+
+    def test_parse_result_bits(self):
+        # The accept sequences and the terminal id bitsets of a ParseResult describe the same sequences
+        code = 'def f(a, b=1):\n    if a and not b:\n        return [x ** 2 for x in a]\n    return b\n'
+        inc_parser = create_parser(Grammar('python'))
+        for i in range(1, len(code)+1, 2):
+            r = inc_parser.get_acceptable_next_terminals(code[:i])
+            r2 = ParseResult(set(r.accept_sequences), r.remainder, r.remainder_state)
+            self.assertEqual((r.first_bits, r.single_bits, r.pair_bits), (r2.first_bits, r2.single_bits, r2.pair_bits))
+            self.assertEqual(r.first_bits, sum(1 << terminal_id(t) for t in {seq[0] for seq in r.accept_sequences}))
+
+        r = ParseResult.from_accept_terminals({'NAME', 'LPAR'}, {'DOT', 'EQUAL'}, 'x', RemainderState.MAYBE_COMPLETE, final_terminal='NAME', ignore_terminals=['COMMENT'])
+        self.assertEqual(r.accept_sequences, {AcceptSequence(['LPAR']), AcceptSequence(['COMMENT']), AcceptSequence(['NAME', 'DOT']), AcceptSequence(['NAME', 'EQUAL']), AcceptSequence(['NAME', 'COMMENT'])})
+        self.assertEqual(r.pair_bits, {terminal_id('NAME'): (1 << terminal_id('DOT')) | (1 << terminal_id('EQUAL')) | (1 << terminal_id('COMMENT'))})
+
+    def test_parser_pool(self):
+        # The parsers of the pool give the same results as a separate parser for every sample while the samples share the parsers until they diverge
+        prompt = 'def f(a, b=1):\n    if a and not b:\n'
+        completions = [
+            '        return [x ** 2 for x in a]\n    return b\n',
+            '        return [x ** 2 for x in a]\n    return b\n',
+            '        return [x ** 2 for y in b]\n    return a\n',
+            '        x = a\n    return b\n',
+        ]
+        pool = ParserPool([create_parser(Grammar('python'), recognizer=True) for _ in completions])
+        parsers = [create_parser(Grammar('python'), recognizer=True) for _ in completions]
+        for i in range(1, max(len(c) for c in completions)+1, 2):
+            codes = [prompt + c[:i] for c in completions]
+            pool.share(codes)
+            for idx, code in enumerate(codes):
+                r, r2 = pool.get_acceptable_next_terminals(idx, code), parsers[idx].get_acceptable_next_terminals(code)
+                self.assertEqual((r.accept_sequences, r.remainder, r.remainder_state, r.next_ac_indents), (r2.accept_sequences, r2.remainder, r2.remainder_state, r2.next_ac_indents))
+            self.assertEqual(pool.row_to_parser[0], pool.row_to_parser[1])
+        self.assertEqual(len(set(pool.row_to_parser)), 3)
+        self.assertEqual(pool.num_forks, 2)
+        self.assertGreater(pool.stats()['shared_parses'], pool.stats()['parses'] // 2)
+
+    def test_parser_state_cache(self):
+        # A parser continues from a cached state of another parser as if it had parsed the prefix itself
+        preamble = 'def f(a, b=1):\n    if a and not b:\n        return [x ** 2 for x in a]\n    return b\n\n'
+        codes = [preamble + 'def g(x):\n    return x\n', preamble + 'class C:\n    y = 2\n']
+        cache = ParserStateCache()
+        parser = create_parser(Grammar('python'), recognizer=True)
+        parser.get_acceptable_next_terminals(preamble)
+        cache.put('preamble', parser.save_state())
+        parser.get_acceptable_next_terminals(codes[0])
+        cache.put('code', parser.save_state())
+
+        for code in codes:
+            fresh_parser = create_parser(Grammar('python'), recognizer=True)
+            parser.restore_state(cache.get('preamble'))
+            for i in range(len(preamble), len(code)+1):
+                r, r2 = parser.get_acceptable_next_terminals(code[:i]), fresh_parser.get_acceptable_next_terminals(code[:i])
+                self.assertEqual((r.accept_sequences, r.remainder, r.remainder_state, r.next_ac_indents), (r2.accept_sequences, r2.remainder, r2.remainder_state, r2.next_ac_indents))
+        self.assertEqual(cache.stats()['entries'], 2)
+
+        # The least recently used states are evicted when the memory budget is exceeded
+        size = cache.state_size(cache.get('code'))
+        cache.max_size = size + 100
+        cache.put('code2', parser.save_state())
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertIsNone(cache.get('preamble'))
+        self.assertLessEqual(cache.size, cache.max_size)
+
+    def test_snapshot_retention(self):
+        # The parser that keeps a bounded number of snapshots gives the same results as the parser that keeps all of them, also after going back far
+        function = 'def f{i}(a, b=1):\n    if a and not b:\n        return [x ** 2 for x in a]\n    return b\n\n'
+        code = ''.join(function.format(i=i) for i in range(8))
+        parser = create_parser(Grammar('python'), recognizer=True, snapshot_window=8, max_snapshots=32)
+        full_parser = create_parser(Grammar('python'), recognizer=True, snapshot_window=None)
+        ends = list(range(1, len(code)+1, 3)) + [len(code) // 3, len(code) // 2, len(code)]
+        for i in ends:
+            r, r2 = parser.get_acceptable_next_terminals(code[:i]), full_parser.get_acceptable_next_terminals(code[:i])
+            self.assertEqual((r.accept_sequences, r.remainder, r.remainder_state, r.next_ac_indents), (r2.accept_sequences, r2.remainder, r2.remainder_state, r2.next_ac_indents))
+            self.assertLessEqual(len(parser.cur_pos_to_parser_state), 32)
+        self.assertGreater(len(full_parser.cur_pos_to_parser_state), 200)
+        self.assertGreater(parser.snapshot_stats()['pruned'], 0)
+        self.assertGreater(parser.snapshot_stats()['deep_restores'], 0)
+        self.assertGreater(parser.snapshot_stats()['reparsed_tokens'], 0)
+
+    def test_first_token_changed(self):
+        # The parser goes back to its initial state when the first lexer token changes, e.g., 'd' -> 'def'
+        for grammar, codes in [('python', ['d', 'd = 1\n', 'def f():\n    return 1\n']), ('sql', ['S', 'S1', 'SELECT a FROM t'])]:
+            parser = create_parser(Grammar(grammar))
+            for code in codes:
+                for i in range(1, len(code)+1):
+                    fresh_parser = create_parser(Grammar(grammar))
+                    r, r2 = parser.get_acceptable_next_terminals(code[:i]), fresh_parser.get_acceptable_next_terminals(code[:i])
+                    self.assertEqual((r.accept_sequences, r.remainder, r.remainder_state), (r2.accept_sequences, r2.remainder, r2.remainder_state))
+
+    def test_incremental_lexing(self):
+        # Lexing that resumes from the lexer checkpoint gives the same tokens as lexing the whole code
+        codes = {
+            'python': 'def f(numbers: list) -> bool:\n    """ Check if in given list of numbers,\n    are any two numbers equal. """\n    x = 1e5 + 3.14 # comment\n    for idx in (1,\n                2):\n        s = "abc" + \'\'\'d\n e\'\'\'\n    return x\n',
+            'go': 'package main\n\nimport "fmt"\n\n// main function\nfunc main() {\n\tx := 1e5\n\ts := `raw\nstring`\n\tfmt.Println("hello", s, x)\n}\n',
+            'sql': 'SELECT a, b FROM t1\nLEFT\n OUTER JOIN t2 ON t1.x = t2.y -- comment\nWHERE a = "str"\n',
+        }
+        for grammar, code in codes.items():
+            inc_parser, fresh_parser = create_parser(Grammar(grammar)), create_parser(Grammar(grammar))
+            for i in range(1, len(code)+1):
+                fresh_parser.reset()
+                tokens, fresh_tokens = inc_parser._lex_code(code[:i]), fresh_parser._lex_code(code[:i])
+                if grammar == 'python':
+                    tokens, fresh_tokens = (tokens, None), (fresh_tokens, None)
+                self.assertEqual([(t.type, t.value, t.start_pos, t.line, t.column) for t in tokens[0]], [(t.type, t.value, t.start_pos, t.line, t.column) for t in fresh_tokens[0]])
+                self.assertEqual((tokens[1], inc_parser.lexer_pos), (fresh_tokens[1], fresh_parser.lexer_pos))
+            self.assertGreater(len(inc_parser.lexer_checkpoint.tokens), 0)
+
+    def test_lexer_tokens_shared_by_forks(self):
+        # Parser states that share the lexer checkpoint lex different continuations without changing each other's tokens
+        inc_parser, fresh_parser = create_parser(Grammar('go')), create_parser(Grammar('go'))
+        prefix = 'package main\n\nfunc main() {\n\tx := 1\n'
+        inc_parser._lex_code(prefix)
+        state = inc_parser.save_state()
+        lexed = {}
+        for suffix in ['\ty := x + 2\n\tz := y\n', '\tfmt.Println(x)\n}\n', '\ty := x + 2\n\tz := y\n']:
+            inc_parser.restore_state(state)
+            fresh_parser.reset()
+            tokens = [(t.type, t.value, t.start_pos) for t in inc_parser._lex_code(prefix + suffix)[0]]
+            self.assertEqual(tokens, [(t.type, t.value, t.start_pos) for t in fresh_parser._lex_code(prefix + suffix)[0]])
+            self.assertEqual(tokens, lexed.setdefault(suffix, tokens))
+        inc_parser.restore_state(state)
+        self.assertEqual(len(inc_parser.lexer_checkpoint.tokens), len(state['lexer_checkpoint'].tokens))
+
+
+class TestIncrementalDetokenizer(unittest.TestCase):
+    corpus = ['def f(x):\n    return x + 1  # 你好世界 😀\n', 'for i in range(10):\n    print("héllo wörld", i)\n', "x = [1, 2, 3] . , ! ? it's"] * 10
+
+    def byte_level_tokenizer(self):
+        from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+        from transformers import PreTrainedTokenizerFast
+        tokenizer = Tokenizer(models.BPE())
+        tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+        tokenizer.decoder = decoders.ByteLevel()
+        tokenizer.train_from_iterator(self.corpus, trainers.BpeTrainer(vocab_size=300, special_tokens=['<eos>'], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+        return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token='<eos>')
+
+    def sentencepiece_tokenizer(self):
+        # Llama style tokenizer with prefix spaces and byte fallback tokens
+        import json
+        from tokenizers import Tokenizer, decoders, models, normalizers, trainers
+        from transformers import PreTrainedTokenizerFast
+        tokenizer = Tokenizer(models.BPE(byte_fallback=True, unk_token='<unk>'))
+        tokenizer.normalizer = normalizers.Sequence([normalizers.Prepend('▁'), normalizers.Replace(' ', '▁')])
+        tokenizer.decoder = decoders.Sequence([decoders.Replace('▁', ' '), decoders.ByteFallback(), decoders.Fuse(), decoders.Strip(' ', 1, 0)])
+        tokenizer.train_from_iterator(self.corpus, trainers.BpeTrainer(vocab_size=400, special_tokens=['<unk>', '<eos>'] + [f'<0x{i:02X}>' for i in range(256)]))
+        config = json.loads(tokenizer.to_str())
+        for added_token in config['added_tokens']:
+            added_token['special'] = added_token['content'] in ('<unk>', '<eos>')
+        return PreTrainedTokenizerFast(tokenizer_object=Tokenizer.from_str(json.dumps(config)), eos_token='<eos>', unk_token='<unk>')
+
+    def test_incremental_decode(self):
+        for tokenizer in [self.byte_level_tokenizer(), self.sentencepiece_tokenizer()]:
+            token_ids = tokenizer.encode(''.join(self.corpus[:3]) + '終わり 🎉')
+            token_ids.insert(5, tokenizer.eos_token_id)
+            token_ids += [(17 * k) % len(tokenizer) for k in range(100)] # Random tokens e.g., incomplete multi-byte characters
+            detokenizer = IncrementalDetokenizer(tokenizer)
+            for n in range(len(token_ids)):
+                # Decodes n+1 tokens for checking the next token and then n tokens as in the opportunistic mode
+                for m in [n+1, n]:
+                    self.assertEqual(detokenizer.decode(token_ids[:m]), tokenizer.decode(token_ids[:m], skip_special_tokens=True))
+            self.assertGreater(detokenizer.num_incremental_decodes, 10 * detokenizer.num_full_decodes)